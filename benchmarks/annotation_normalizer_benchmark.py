@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Time spent preparing the annotations of a batch before storing them, with the
+previous multi-pass loops of createAnnotationS and with normalizeAnnotationList
+(human storage) or normalizeAnnotations (large storage), for batch formats 0
+and 1. Does not require MongoDB.
+
+Most of the large storage time is spent generating the id of each
+annotation, and timings vary a lot between runs: use several repeats.
+
+Usage:
+    python benchmarks/annotation_normalizer_benchmark.py [nb_annotations] [repeat]
+"""
+
+import copy
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bson.objectid import ObjectId
+
+from jass.annotations_manager import normalizeAnnotations, normalizeAnnotationList
+
+DOC_ID = "59f0a7c3e1382307a3b8a1f1"
+
+
+def makeBatch(nbAnnotations, batchFormat):
+    common = {"@context": "http://example.org/context.json", "annotationSetId": "speech"}
+    data = [{"begin": i * 10, "end": i * 10 + 9, "label": "speaker_{0}".format(i % 7)}
+            for i in range(nbAnnotations)]
+    if batchFormat == 1:
+        return {"common": common, "data": data}
+    for anno in data:
+        anno.update(common)
+    return {"data": data}
+
+
+def multiPass(jsonBatch, batchFormat, largeStorage):
+    """
+    Loops of createAnnotationS before normalizeAnnotations.
+    """
+    batchData = jsonBatch['data']
+    if batchFormat == 1 and 'common' in jsonBatch:
+        batchCommon = jsonBatch['common']
+        for anno in batchData:
+            for common in batchCommon:
+                anno[common] = batchCommon[common]
+    for anno in batchData:
+        if '_id' in anno:
+            del anno["_id"]
+    for anno in batchData:
+        anno['doc_id'] = DOC_ID
+    batchDoc = {}
+    if largeStorage:
+        for anno in batchData:
+            if batchDoc == {}:
+                for attrib in anno:
+                    batchDoc[attrib] = anno[attrib]
+            for attrib in anno:
+                if str(attrib) in batchDoc:
+                    if anno[attrib] != batchDoc[str(attrib)]:
+                        del batchDoc[attrib]
+            anno["id"] = str(ObjectId())
+    return batchData, batchDoc
+
+
+def singlePass(jsonBatch, batchFormat, largeStorage):
+    """
+    Preparation done by createAnnotationS.
+    """
+    batchCommon = jsonBatch.get('common') if batchFormat == 1 else None
+    if not largeStorage:
+        return normalizeAnnotationList(jsonBatch['data'], DOC_ID, batchCommon), {}
+    batchDoc = {}
+    return list(normalizeAnnotations(jsonBatch['data'], DOC_ID, batchCommon, batchDoc)), batchDoc
+
+
+def measure(function, batch, batchFormat, largeStorage, repeat):
+    best = None
+    for i in range(repeat):
+        jsonBatch = copy.deepcopy(batch)
+        # As timeit does, so that collecting the copies is not measured.
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function(jsonBatch, batchFormat, largeStorage)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(nbAnnotations, repeat):
+    for batchFormat in [0, 1]:
+        batch = makeBatch(nbAnnotations, batchFormat)
+        for largeStorage in [False, True]:
+            # Both produce the same batch document.
+            assert multiPass(copy.deepcopy(batch), batchFormat, largeStorage)[1] == \
+                singlePass(copy.deepcopy(batch), batchFormat, largeStorage)[1]
+            before = measure(multiPass, batch, batchFormat, largeStorage, repeat)
+            after = measure(singlePass, batch, batchFormat, largeStorage, repeat)
+            print("batchFormat={0} storageType={1}: multi-pass {2:.3f}s, single pass {3:.3f}s ({4:.0%})".format(
+                batchFormat, 2 if largeStorage else 1, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Size and read/write throughput of large storage batch chunks for each
+encoding and compression codec. Chunks are encoded and decoded in memory the
+same way they are written to and read from GridFS.
+
+Usage:
+    python benchmarks/batch_compression_benchmark.py [nb_annotations] [chunk_size]
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import jass.batch_storage as batch_storage
+import jass.columnar as columnar
+import jass.json_stream as json_stream
+
+
+def makeAnnotations(nbAnnotations):
+    return [{"@context": "http://example.org/context.json",
+             "doc_id": "59f0a7c3e1382307a3b8a1f1",
+             "annotationSetId": "speech",
+             "begin": i * 10,
+             "end": i * 10 + 9,
+             "label": "speaker_{0}".format(i % 7),
+             "confidence": round((i % 100) / 100, 2)} for i in range(nbAnnotations)]
+
+
+def write(annotations, chunkSize, compression, encoding):
+    return [batch_storage.compressChunk(batch_storage.encodeChunk(annotations[i:i + chunkSize], encoding),
+                                        compression)
+            for i in range(0, len(annotations), chunkSize)]
+
+
+def read(chunks, compression, encoding):
+    count = 0
+    for chunk in chunks:
+        fileObj = batch_storage.openChunk(io.BytesIO(chunk), compression)
+        if encoding == batch_storage.COLUMNAR_ENCODING:
+            annotations = columnar.decode(fileObj.read())
+        else:
+            annotations = json_stream.iterJsonArray(fileObj)
+        for anno in annotations:
+            count += 1
+    return count
+
+
+def main(nbAnnotations, chunkSize):
+    annotations = makeAnnotations(nbAnnotations)
+    rawSize = None
+    for encoding in batch_storage.ENCODINGS:
+        for compression in batch_storage.COMPRESSIONS:
+            name = "{0}/{1}".format(encoding, compression)
+            if not batch_storage.isCompressionSupported(compression):
+                print("{0:>13}: not available".format(name))
+                continue
+            start = time.perf_counter()
+            chunks = write(annotations, chunkSize, compression, encoding)
+            writeTime = time.perf_counter() - start
+            start = time.perf_counter()
+            assert read(chunks, compression, encoding) == nbAnnotations
+            readTime = time.perf_counter() - start
+            size = sum(len(chunk) for chunk in chunks)
+            if rawSize is None:
+                rawSize = size
+            print("{0:>13}: {1:6.1f} MB ({2:6.1%}), write {3:7.0f} annotations/s, read {4:7.0f} annotations/s".format(
+                name, size / 2 ** 20, size / rawSize, nbAnnotations / writeTime, nbAnnotations / readTime))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else batch_storage.DEFAULT_CHUNK_SIZE)
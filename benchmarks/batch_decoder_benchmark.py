@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Peak memory and time used to decode a large synthetic batch file, with
+json.loads on the whole file and with the incremental decoder.
+
+Usage:
+    python benchmarks/batch_decoder_benchmark.py [nb_annotations]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from jass.json_stream import iterJsonArray
+
+
+def writeBatch(path, nbAnnotations):
+    with open(path, "w") as f:
+        f.write("[")
+        for i in range(nbAnnotations):
+            if i:
+                f.write(",")
+            json.dump({"@context": "http://example.org/context.json",
+                       "doc_id": "59f0a7c3e1382307a3b8a1f1",
+                       "annotationSetId": "speech",
+                       "begin": i * 10,
+                       "end": i * 10 + 9,
+                       "label": "speaker_{0}".format(i % 7),
+                       "confidence": 0.5}, f)
+        f.write("]")
+
+
+def loadAll(path):
+    with open(path, "rb") as f:
+        return sum(1 for anno in json.loads(f.read()))
+
+
+def loadIncremental(path):
+    with open(path, "rb") as f:
+        return sum(1 for anno in iterJsonArray(f))
+
+
+def measure(function, path):
+    # Time and memory are measured separately since tracing slows down decoding.
+    start = time.perf_counter()
+    count = function(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def main(nbAnnotations):
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        writeBatch(path, nbAnnotations)
+        print("Batch of {0} annotations, {1:.1f} MB".format(nbAnnotations, os.path.getsize(path) / 2 ** 20))
+        for name, function in [("json.loads", loadAll), ("iterJsonArray", loadIncremental)]:
+            count, elapsed, peak = measure(function, path)
+            print("{0:>14}: {1} annotations in {2:.2f}s, peak memory {3:.1f} MB".format(
+                name, count, elapsed, peak / 2 ** 20))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Latency of GET /document/<id>/annotations under concurrent clients, with
+sync gunicorn workers (one request at a time per worker), with threaded
+(gthread) workers, as started by jass_startup.sh, and with the asynchronous
+app (jass.async_rest, aiohttp workers). Requires gunicorn and a running
+MongoDB configured in the given config file.
+
+Usage:
+    python benchmarks/concurrent_clients_benchmark.py [config_path] [nb_clients] [nb_requests]
+"""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+BIND = "127.0.0.1:5099"
+URL = "http://" + BIND
+ASYNC_BIND = "127.0.0.1:5098"
+WORKERS = 4
+THREADS = 8
+
+
+def request(method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(URL + path, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as res:
+        content = res.read()
+    return json.loads(content.decode()) if content else None
+
+
+def startServer(config_path, workerOptions, app="jass.simple_rest:APP", bind=BIND, readyPath="/info"):
+    env = dict(os.environ, JASS_CONFIG_PATH=os.path.abspath(config_path))
+    server = subprocess.Popen(["gunicorn", "-w", str(WORKERS)] + workerOptions +
+                              ["-b", bind, app],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            urllib.request.urlopen("http://" + bind + readyPath).read()
+            return server
+        except urllib.error.HTTPError:
+            # Answered, with an error.
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def timedGet(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as res:
+        res.read()
+    return time.perf_counter() - start
+
+
+def run(url, nbClients, nbRequests):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nbClients) as executor:
+        list(executor.map(timedGet, [url] * nbClients))  # warm up
+        start = time.perf_counter()
+        latencies = sorted(executor.map(timedGet, [url] * nbRequests))
+        elapsed = time.perf_counter() - start
+    return (nbRequests / elapsed, latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)], latencies[int(len(latencies) * 0.99)])
+
+
+def main(config_path, nbClients, nbRequests):
+    # The asynchronous app only serves reads, annotations are written by the Flask app.
+    modes = [("sync", ["-k", "sync"], False),
+             ("gthread", ["-k", "gthread", "--threads", str(THREADS)], False),
+             ("async", ["-k", "sync"], True)]
+    for name, workerOptions, isAsync in modes:
+        server = startServer(config_path, workerOptions)
+        asyncServer = None
+        docId = None
+        try:
+            docId = request("POST", "/document", {"@context": "benchmark"})["id"]
+            path = "/document/{0}/annotations".format(docId)
+            request("POST", path, {"data": [{"begin": i, "end": i + 1, "label": "benchmark"}
+                                            for i in range(100)]})
+            url = URL + path
+            if isAsync:
+                asyncServer = startServer(config_path, ["-k", "aiohttp.worker.GunicornWebWorker"],
+                                          "jass.async_rest:APP", ASYNC_BIND, path)
+                url = "http://" + ASYNC_BIND + path
+            print("{0} ({1} workers): {2:.1f} requests/s, p50 {3:.1f} ms, p95 {4:.1f} ms, p99 {5:.1f} ms".format(
+                name, WORKERS, *[value * (1000 if i else 1)
+                                 for i, value in enumerate(run(url, nbClients, nbRequests))]))
+        finally:
+            if docId is not None:
+                request("DELETE", "/document/{0}".format(docId))
+            for process in [server, asyncServer]:
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join("configs", "dev", "config.ini"),
+         int(sys.argv[2]) if len(sys.argv) > 2 else 32,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
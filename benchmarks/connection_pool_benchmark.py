@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Requests per second of GET /document/<id> with and without the shared client
+pool. Requires a running MongoDB configured in the given config file.
+
+Usage:
+    python benchmarks/connection_pool_benchmark.py [config_path] [nb_requests]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import jass.settings as settings
+import jass.mongo_pool as mongo_pool
+from jass.simple_rest import APP
+
+
+def run(client, url, nbRequests):
+    start = time.perf_counter()
+    for i in range(nbRequests):
+        res = client.get(url)
+        assert res.status_code == 200, res.status_code
+    return nbRequests / (time.perf_counter() - start)
+
+
+def main(config_path, nbRequests):
+    settings.Settings.Instance().LoadConfig(config_path)
+    client = APP.test_client()
+    res = client.post("/document", json={"@context": "benchmark"})
+    url = "/document/{0}".format(res.get_json()["id"])
+
+    try:
+        for pooling in ["false", "true"]:
+            os.environ["MongoConnectionPooling"] = pooling
+            mongo_pool.resetClient()
+            run(client, url, 10)  # warm up
+            print("pooling={0}: {1:.1f} requests/s".format(pooling, run(client, url, nbRequests)))
+    finally:
+        client.delete(url)
+        del os.environ["MongoConnectionPooling"]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join("configs", "dev", "config.ini"),
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Insertion throughput of human storage annotations, with one ordered insert of
+the whole batch (previous behaviour) and with sub-batches of unordered
+insert_many, sequential and in parallel. Requires a running MongoDB
+configured in the given config file. The benchmark collection is dropped.
+
+Usage:
+    python benchmarks/human_insert_benchmark.py [config_path] [batch_sizes]
+
+batch_sizes is a comma separated list, by default 10000,100000,1000000.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import jass.settings as settings
+import jass.mongo_pool as mongo_pool
+import jass.bulk_insert as bulk_insert
+
+COLLECTION = "humanInsertBenchmark"
+
+
+def makeAnnotations(nbAnnotations):
+    return [{"@context": "http://example.org/context.json",
+             "doc_id": "59f0a7c3e1382307a3b8a1f1",
+             "begin": i * 10,
+             "end": i * 10 + 9,
+             "label": "speaker_{0}".format(i % 7)} for i in range(nbAnnotations)]
+
+
+def singleInsert(coll, annotations):
+    return len(coll.insert_many(annotations).inserted_ids)
+
+
+def subBatches(batchSize, workers):
+    def insert(coll, annotations):
+        return bulk_insert.insertMany(coll, annotations, batchSize, workers).nInserted
+    return insert
+
+
+def main(config_path, batchSizes):
+    settings.Settings.Instance().LoadConfig(config_path)
+    client = mongo_pool.createClient()
+    coll = client[settings.GetConfigValue("ServiceStockageAnnotations", "MongoDb")][COLLECTION]
+    strategies = [("single insert", singleInsert),
+                  ("1000 x 1 worker", subBatches(1000, 1)),
+                  ("1000 x 4 workers", subBatches(1000, 4)),
+                  ("10000 x 4 workers", subBatches(10000, 4))]
+    try:
+        for nbAnnotations in batchSizes:
+            for name, insert in strategies:
+                coll.drop()
+                annotations = makeAnnotations(nbAnnotations)
+                start = time.perf_counter()
+                assert insert(coll, annotations) == nbAnnotations
+                elapsed = time.perf_counter() - start
+                print("{0:>8} annotations, {1:>17}: {2:6.2f}s, {3:8.0f} annotations/s".format(
+                    nbAnnotations, name, elapsed, nbAnnotations / elapsed))
+    finally:
+        coll.drop()
+        client.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join("configs", "dev", "config.ini"),
+         [int(size) for size in (sys.argv[2] if len(sys.argv) > 2 else "10000,100000,1000000").split(",")])
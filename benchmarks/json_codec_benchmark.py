@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Encode and decode throughput of a synthetic annotation batch with each
+available json_codec backend, compared to json.dumps/json.loads as used
+before. Does not require MongoDB.
+
+Usage:
+    python benchmarks/json_codec_benchmark.py [nb_annotations] [repeat]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import jass.json_codec as json_codec
+
+
+def makeAnnotations(nbAnnotations):
+    return [{"@context": "http://example.org/context.json",
+             "doc_id": "59f0a7c3e1382307a3b8a1f1",
+             "annotationSetId": "speech",
+             "begin": i * 10,
+             "end": i * 10 + 9,
+             "label": "speaker_{0}".format(i % 7),
+             "confidence": round((i % 100) / 100, 2),
+             "text": "Bonjour, ceci est l'énoncé numéro {0}".format(i)} for i in range(nbAnnotations)]
+
+
+def best(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(nbAnnotations, repeat):
+    annotations = makeAnnotations(nbAnnotations)
+    data = json.dumps(annotations).encode("UTF-8")
+    size = len(data) / 2 ** 20
+    print("{0} annotations, {1:.1f} MB".format(nbAnnotations, size))
+
+    results = [("json module", lambda: json.dumps(annotations).encode("UTF-8"),
+                lambda: json.loads(data.decode("UTF-8")))]
+    for codec in [json_codec.STDLIB, json_codec.ORJSON]:
+        os.environ["JsonCodec"] = codec
+        json_codec.resetCodec()
+        if json_codec.getCodec() != codec:
+            print("{0:>12}: not available".format(codec))
+            continue
+        results.append((codec, lambda: json_codec.dumpb(annotations), lambda: json_codec.loads(data)))
+
+    for name, encode, decode in results:
+        os.environ["JsonCodec"] = name if name in json_codec.CODECS else json_codec.STDLIB
+        json_codec.resetCodec()
+        encodeTime = best(encode, repeat)
+        decodeTime = best(decode, repeat)
+        print("{0:>12}: encode {1:7.1f} MB/s, decode {2:7.1f} MB/s".format(
+            name, size / encodeTime, size / decodeTime))
+    del os.environ["JsonCodec"]
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 5)
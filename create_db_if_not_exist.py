@@ -9,23 +9,32 @@ import subprocess
 import time
 from pymongo.errors import ConnectionFailure
 
+import jass.settings
+import jass.indexes as indexes
 
-# Will also create an index if not none.
-def createCollIfNotExist(db, collName, index):
-    coll = None
-    if db.system.namespaces.find({"name": {"$regex": "{0}.{1}".format(db, collName)}}) == 0:
-        coll = db.create_collection(collName)
-    else:
-        coll = db[collName]
-    if index != None:
-        coll.create_index(index)
-    return coll
+
+def createCollIfNotExist(db, collName):
+    if collName not in db.collection_names():
+        return db.create_collection(collName)
+    return db[collName]
+
+
+def printDriftReport(report):
+    for index in report["created"]:
+        print("Created index {0}.{1}".format(index["collection"], index["name"]))
+    for index in report["different"]:
+        print("Index {0}.{1} differs from its specification: {2}".format(
+            index["collection"], index["name"], ", ".join(index["differences"])))
+    for index in report["extra"]:
+        print("Index {0}.{1} is not specified".format(index["collection"], index["name"]))
 
 
 def createDbIfNotExist(config_path):
     # print "Reading config from {0}".format(config_path)
     SETTINGS = configparser.ConfigParser()
     SETTINGS.read(config_path)
+    jass.settings.Settings.Instance().LoadConfig(config_path)
+    specs = indexes.loadIndexSpecs()
 
     retryTimes = 0
     MC = None
@@ -45,13 +54,15 @@ def createDbIfNotExist(config_path):
             # Now create all the needed collections
 
             createCollIfNotExist(db, SETTINGS.get("ServiceStockageAnnotations",
-                                                  "DocumentCollection"), None)
+                                                  "DocumentCollection"))
             createCollIfNotExist(db, SETTINGS.get("ServiceStockageAnnotations",
-                                                  "SchemaCollection"), "doc_id")
+                                                  "SchemaCollection"))
             createCollIfNotExist(db, SETTINGS.get("ServiceStockageAnnotations",
-                                                  "HumanAnnotationCollection"), "doc_id")
+                                                  "HumanAnnotationCollection"))
             createCollIfNotExist(db, SETTINGS.get("ServiceStockageAnnotations",
-                                                  "BatchAnnotationCollection"), "doc_id")
+                                                  "BatchAnnotationCollection"))
+            # And their indexes (see [Indexes] in the configuration)
+            printDriftReport(indexes.applyIndexes(db, specs))
             MC.close()
             # print "MongoBD creation Successful"
             break
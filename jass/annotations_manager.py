@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 # coding:utf-8
 
+import jass.batch_storage as batch_storage
+import jass.bulk_insert as bulk_insert
+import jass.jobs as jobs
+import jass.json_stream as json_stream
 import jass.mongo_utils as mongo_utils
+import jass.query_guard as query_guard
 import jass.settings as settings
 import jass.custom_logger as logger
 from jass.storage_exception import *
 from bson.errors import *
-from jass.storage_manager import StorageManager
+from jass.storage_manager import StorageManager, DELETE_SLICE_SIZE
 from bson.objectid import ObjectId
+from bson.son import SON
 import gridfs
-import json
+import pymongo.errors
 
 
 # MongoDB: some interesting performance statistics
@@ -20,6 +26,220 @@ import json
 
 # I will have to check the python driver for unique object ids.
 
+# Background job deleting the GridFS files of deleted batches.
+DELETE_FILES_JOB = "deleteFiles"
+
+
+def normalizeAnnotations(batchData, strDocId, batchCommon=None, batchDoc=None):
+    """
+    Yields the annotations of a batch ready to be stored, modifying them in a
+    single pass:
+        - attributes of batchCommon are copied in each annotation,
+        - _id specified by the client is removed,
+        - doc_id is set to strDocId.
+
+    :param batchData: Iterable of annotations.
+    :param batchCommon: "common" section of a batch (COMPACT_BATCH_FORMAT).
+    :param batchDoc: If not None (large storage), a dict which is filled with
+                     the attributes common to the annotations as they are
+                     yielded, and each annotation gets a new "id". Attributes
+                     for which an annotation has a different value are
+                     removed. It is only complete once all the annotations
+                     have been consumed.
+    """
+    # The loop runs for every annotation, thus it is kept free of calls and
+    # copies: the attributes of the batch document are only copied again
+    # when one of them is removed, which seldom happens after the first
+    # annotations.
+    candidates = None
+    for anno in batchData:
+        if batchCommon:
+            anno.update(batchCommon)
+        # We don't want the client to specify an id.
+        anno.pop('_id', None)
+        # make each annotation reference its document
+        anno['doc_id'] = strDocId
+        if batchDoc is not None:
+            if candidates is None:
+                # Possible common attributes between annotations.
+                batchDoc.update(anno)
+                candidates = list(batchDoc.items())
+            else:
+                # Batch attributes are usually far fewer than the annotation
+                # attributes, thus only them are compared. Missing attributes
+                # are kept.
+                removed = False
+                for attrib, value in candidates:
+                    if anno.get(attrib, value) != value:
+                        del batchDoc[attrib]
+                        removed = True
+                if removed:
+                    candidates = list(batchDoc.items())
+            # Same as str(ObjectId()).
+            anno["id"] = ObjectId().binary.hex()
+        yield anno
+
+
+def normalizeAnnotationList(batchData, strDocId, batchCommon=None):
+    """
+    Same as normalizeAnnotations for human storage, with a plain loop over a
+    list instead of a generator.
+
+    :return: batchData, whose annotations are modified in place.
+    """
+    for anno in batchData:
+        if batchCommon:
+            anno.update(batchCommon)
+        anno.pop('_id', None)
+        anno['doc_id'] = strDocId
+    return batchData
+
+
+def touchAnnotations(db, strDocIds):
+    """
+    Increments the change counter of the annotations of documents. Called
+    after each write of annotations: a reader gets the counter before the
+    annotations, thus never tags new annotations with an old counter.
+
+    Counters are kept apart from the documents (AnnotationVersionCollection
+    setting), which are replaced as a whole when updated.
+    """
+    coll = db[_getAnnotationVersionCollection()]
+    for strDocId in set(str(docId) for docId in strDocIds):
+        try:
+            coll.update_one({"_id": strDocId}, {"$inc": {"version": 1}}, upsert=True)
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Touch Annotations", strDocId, e)
+
+
+def _getAnnotationVersionCollection():
+    return settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "AnnotationVersionCollection",
+                                            "annotation_versions")
+
+
+def validateDocumentIds(documentIds):
+    """
+    :@param documentIds: List of documents containing the annotations.
+                         Raises an exception if documentIds contains an
+                         invalid Id
+                         (Invalid Format, not whenever it exists or not).
+    :@return: 0 if documentIds is empty.
+    """
+    if not (type(documentIds) is list):
+        return 0
+
+    if (len(documentIds) == 0):
+        return 0
+
+    for docId in documentIds:
+        if (not mongo_utils.isObjectId(docId)):
+            logger.logInfo(AnnotationException(3, docId))
+            raise AnnotationException(3, docId)
+
+    return 1
+
+
+def setDocIdToJsonSelect(documentIds, jsonSelect):
+    """
+    set a filter by doc id
+    """
+    if "doc_id" in jsonSelect:
+        del jsonSelect["doc_id"]
+
+    for field in batch_storage.RESERVED_FIELDS:
+        if field in jsonSelect:
+            del jsonSelect[field]
+
+    docs = []
+    for docId in documentIds:
+        docs.append(str(docId))
+
+    try:
+        jsonSelect["doc_id"] = {"$in": docs}
+    except Exception as e:
+        logger.logUnknownError("Annotation Storage Get Doc Id", "Failed Delete Query", e)
+
+
+def getProjection(fields):
+    """
+    :return: MongoDB projection returning only fields (and _id), or None
+             if fields is None.
+    """
+    if fields is None:
+        return None
+    if (not isinstance(fields, list) or
+            any(not isinstance(field, str) or not field or field.startswith("$") or
+                "" in field.split(".") for field in fields)):
+        logger.logInfo(AnnotationException(15, fields))
+        raise AnnotationException(15, fields)
+    return {field: 1 for field in fields}
+
+
+def getBatchFields(fields):
+    """
+    :return: Top level fields kept in batch annotations, None to keep
+             them all.
+    """
+    if fields is None:
+        return None
+    batchFields = ["id"]
+    for field in fields:
+        field = field.split(".")[0]
+        if field not in batchFields:
+            batchFields.append(field)
+    return batchFields
+
+
+def getPageSize(pageSize):
+    maxPageSize = int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "MaxPageSize", 1000))
+    if pageSize is None:
+        return maxPageSize
+    return max(1, min(int(pageSize), maxPageSize))
+
+
+def decodeContinuationToken(token, requiredFields):
+    position = mongo_utils.decodeContinuationToken(token)
+    if (position is None or
+            any(field not in position for field in requiredFields) or
+            not mongo_utils.isObjectId(position["id"]) or
+            not isinstance(position.get("p", 0), int) or position.get("p", 0) < 0):
+        logger.logInfo(AnnotationException(12, token))
+        raise AnnotationException(12, token)
+    return position
+
+
+def validateStorageByType(storageCollections, storageType):
+    if (storageType < AnnotationManager.ALL_STORAGE or
+                storageType > AnnotationManager.BATCH_STORAGE):
+        logger.logError(AnnotationException(7, storageType))
+        raise AnnotationException(7, storageType)
+
+    # Check for all storage types requirements.
+    if (storageType == AnnotationManager.ALL_STORAGE):
+        for storageType in [AnnotationManager.HUMAN_STORAGE,
+                            AnnotationManager.BATCH_STORAGE]:
+            if storageType not in storageCollections:
+                logger.logError(AnnotationException(6, storageType))
+                raise AnnotationException(6, storageType)
+    else:
+        if storageType not in storageCollections:
+            logger.logError(AnnotationException(6, storageType))
+            raise AnnotationException(6, storageType)
+
+
+def deleteFilesJob(job):
+    """
+    Runs a DELETE_FILES_JOB: deletes the GridFS files listed in the items of the job.
+    """
+    for item in job.iterItems():
+        batch_storage.deleteFilesBulk(job.db, item["ids"])
+        job.itemDone(item)
+        job.report(done=job.progress.get("done", 0) + len(item["ids"]))
+
+
+jobs.register(DELETE_FILES_JOB, deleteFilesJob)
+
+
 class AnnotationManager(StorageManager):
     ALL_STORAGE = 0  # Use all storage
     # Storage for human annotations. Every annotations is stored as a record
@@ -56,6 +276,9 @@ class AnnotationManager(StorageManager):
     # Use an unlikely annotation field name to avoid collision
     SCORE_FIELD_NAME = "%textScore"
 
+    # Annotations are client data, they are not versioned like documents.
+    versioned = False
+
     def addStorageCollection(self, storageType, collectionName):
         """
         Since we may have different collections depending on the type of
@@ -78,7 +301,7 @@ class AnnotationManager(StorageManager):
         For the rest check createMongoDocument(self,jsonDoc,coll).
         """
 
-        self.__validateStorageByType(storageType)
+        validateStorageByType(self.storageCollections, storageType)
 
         if not mongo_utils.isObjectId(strDocId):
             logger.logInfo(AnnotationException(1, strDocId))
@@ -88,8 +311,11 @@ class AnnotationManager(StorageManager):
             raise MongoDocumentException(2)
 
         jsonDoc['doc_id'] = strDocId
-        return self.createMongoDocument(jsonDoc,
-                                        self.storageCollections[storageType])
+        try:
+            return self.createMongoDocument(jsonDoc,
+                                            self.storageCollections[storageType])
+        finally:
+            self.__touchAnnotations([strDocId])
 
     def getAnnotation(self, strAnnoId, storageType=1):
         """
@@ -106,14 +332,30 @@ class AnnotationManager(StorageManager):
 
         See deleteMongoDocument(self,strDocId,coll) for more info.
         """
-        return self.deleteMongoDocument(strAnnoId,
-                                        self.storageCollections[storageType])
+        if not mongo_utils.isObjectId(strAnnoId):
+            return 0
+        if not self.isConnected():
+            raise StorageException(1)
+        try:
+            coll = self.client[self.mongoDb][self.storageCollections[storageType]]
+            # Returns the document of the annotation, whose counter changes.
+            anno = coll.find_one_and_delete({"_id": ObjectId(strAnnoId)}, projection={"doc_id": 1})
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Delete Document", "", e)
+            raise MongoDocumentException(0)
+        if anno is None:
+            return 0
+        self.__touchAnnotations([anno.get("doc_id")])
+        return 1
 
     def updateAnnotation(self, jsonDoc, strDocId, storageType=1):
         """
         This function updates an annotation.
         Currently this only works for annotations in storageType = 1.
 
+        The annotations of strDocId and of the document the annotation
+        belonged to (read before replacing it) are touched.
+
         @Preconditions:
             documentId : A valid storage id. (we don't check that it exists
                          however). strDocId will be added to the annotation
@@ -127,14 +369,32 @@ class AnnotationManager(StorageManager):
         if (jsonDoc is None):
             raise MongoDocumentException(2)
 
+        validateStorageByType(self.storageCollections, storageType)
+        collection = self.storageCollections[storageType]
         jsonDoc['doc_id'] = strDocId
-        return self.updateMongoDocument(jsonDoc)
+        touched = [strDocId]
+        try:
+            if self.isConnected() and mongo_utils.isObjectId(jsonDoc.get('_id')):
+                try:
+                    coll = self.client[self.mongoDb][collection]
+                    anno = coll.find_one({"_id": ObjectId(str(jsonDoc['_id']))}, {"doc_id": 1})
+                except Exception as e:
+                    logger.logUnknownError("Annotation Storage Update Document", "", e)
+                    raise MongoDocumentException(0)
+                if anno is not None and anno.get("doc_id"):
+                    touched.append(anno["doc_id"])
+            return self.updateMongoDocument(jsonDoc, collection)
+        finally:
+            self.__touchAnnotations(touched)
 
     def createAnnotationS(self,
                           jsonBatch,
                           strDocId,
                           batchFormat=1,
-                          storageType=1):
+                          storageType=1,
+                          compression=None,
+                          encoding=None,
+                          atomic=None):
         """
         Inserts annotations by batch. All annotations must be valid. Raises an
         error if there is even a single invalid annotation.
@@ -157,6 +417,22 @@ class AnnotationManager(StorageManager):
         :@param batchFormat : Describes the format of the elements to input.
                               Supports: 0,1
 
+        :@param compression : Codec used to compress the annotations of a
+                              batch (storageType 2). Supports: none, gzip,
+                              zstd. Defaults to the BatchCompression setting.
+
+        :@param encoding : Encoding of the annotations of a batch
+                           (storageType 2). Supports: json, columnar.
+                           Defaults to the BatchEncoding setting.
+
+        :@param atomic : If True, annotations of human storage (storageType 1)
+                         are deleted if one of them can not be inserted.
+                         Defaults to the HumanInsertAtomic setting. See
+                         jass.bulk_insert.
+
+        If some annotations of human storage can not be inserted, raises
+        AnnotationException 8 (13 if rolled back) having the attributes
+        nInserted and errors (list of {index, code, message}).
 
         @return: Number of created annotations.
 
@@ -165,7 +441,7 @@ class AnnotationManager(StorageManager):
             logger.logInfo(AnnotationException(1, strDocId))
             raise AnnotationException(1, strDocId)
 
-        self.__validateStorageByType(storageType)
+        validateStorageByType(self.storageCollections, storageType)
 
         # We do not support you can not create in all storages.
         if (storageType == AnnotationManager.ALL_STORAGE):
@@ -181,74 +457,88 @@ class AnnotationManager(StorageManager):
             logger.logInfo(AnnotationException(5, batchFormat))
             raise AnnotationException(5, batchFormat)
 
+        if (storageType == AnnotationManager.BATCH_STORAGE):
+            compression = self.__validateCompression(compression)
+            encoding = self.__validateEncoding(encoding)
+
         batchData = jsonBatch['data']
+        batchCommon = None
         if (batchFormat == AnnotationManager.COMPACT_BATCH_FORMAT):
-            if 'common' in jsonBatch:
-                batchCommon = jsonBatch['common']
-                # Optimisations later
-                for anno in batchData:
-                    for common in batchCommon:
-                        anno[common] = batchCommon[common]
-
-        for anno in batchData:
-            # We don't want the client to specify an id.
-            if '_id' in anno:
-                del anno["_id"]
+            batchCommon = jsonBatch.get('common')
 
         if (self.isConnected()):
             try:
-                # make each annotation reference its document
-                for anno in batchData:
-                    anno['doc_id'] = strDocId
-
-                db = self.client[self.mongoDb]
-                coll = db[self.storageCollections[storageType]]
                 if (storageType == 1):
-                    # Insert annotations one by one.
-                    nbAnnoToInsert = len(batchData)
-                    nbInserted = len(coll.insert(batchData))
-                    if (nbAnnoToInsert != nbInserted):
-                        # TODO: Delete all annotations if this happens
-                        raise AnnotationException(8, nbInserted, nbAnnoToInsert)
-
-                    return nbInserted
+                    batchData = normalizeAnnotationList(batchData, strDocId, batchCommon)
+                    return self.__insertHumanAnnotations(batchData, atomic, bulk_insert.insertMany)
                 else:  # Batch storage, save as files
-                    fs = gridfs.GridFS(db)
-                    batchDoc = {}
-                    for anno in batchData:
-                        if (batchDoc == {}):  # Possible common attributes between annotations.
-                            for attrib in anno:
-                                batchDoc[attrib] = anno[attrib]
-
-                        # IF an annotation have a different value for an attribute, then the
-                        # common attribute, the common attribute must be deleted.
-                        for attrib in anno:
-                            if (str(attrib) in batchDoc):
-                                if (anno[attrib] != batchDoc[str(attrib)]):
-                                    del batchDoc[attrib]
-
-                        # Add id
-                        anno["id"] = str(ObjectId())
-
-                    jsonDump = json.dumps(batchData).encode("UTF-8")
-                    annoFileID = fs.put(jsonDump)
-                    nbInserted = len(batchData)
-                    if 'common' in jsonBatch:
-                        batchCommon = jsonBatch['common']
-                        for common in batchCommon:
-                            batchDoc[common] = batchCommon[common]
-
-                    batchDoc['doc_id'] = str(strDocId)
-                    batchDoc['file_fs_id_batch'] = annoFileID
-                    try:
-                        batch_id = coll.insert(batchDoc)
-                    except Exception as e:
-                        # clean up file info so we dont have garbage in our db
-                        logger.logUnknownError("Annotation Storage Create Annotations", "", e)
-                        fs.delete(annoFileID)
-                        raise MongoDocumentException(0)
-
-                    return nbInserted
+                    return self.__insertBatch(batchData, strDocId, batchCommon, jsonBatch.get('common'),
+                                              compression, encoding)
+            except AnnotationException as e:
+                logger.logError(e)
+                raise e
+
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Create Annotations",
+                                       "", e)
+                raise MongoDocumentException(0)
+            finally:
+                self.__touchAnnotations([strDocId])
+        else:
+            raise StorageException(1)
+
+    def createAnnotationStream(self,
+                               annotations,
+                               strDocId,
+                               storageType=1,
+                               batchCommon=None,
+                               compression=None,
+                               encoding=None,
+                               atomic=None):
+        """
+        Inserts annotations read from an iterable, ex: an upload decoded line
+        by line (see json_stream.iterNdjson), without holding them all in
+        memory:
+            - human storage (storageType 1) annotations are inserted by
+              sub-batches of HumanInsertBatchSize (see
+              bulk_insert.insertStream),
+            - batch storage (storageType 2) annotations are written to GridFS
+              chunk by chunk, as they are read.
+
+        Errors are reported as by createAnnotationS. If the iterable raises
+        json_stream.JsonStreamError (invalid line), AnnotationException 16 is
+        raised: annotations of human storage inserted before are kept unless
+        atomic, the chunks of a batch are deleted.
+
+        :@param annotations: Iterable of annotations.
+        :@param batchCommon: Attributes copied in each annotation.
+        :@return: Number of created annotations.
+        """
+        if (not mongo_utils.isObjectId(strDocId)):
+            logger.logInfo(AnnotationException(1, strDocId))
+            raise AnnotationException(1, strDocId)
+
+        validateStorageByType(self.storageCollections, storageType)
+
+        if (storageType == AnnotationManager.ALL_STORAGE):
+            logger.logError(AnnotationException(7, storageType))
+            raise AnnotationException(7, storageType)
+
+        if (storageType == AnnotationManager.BATCH_STORAGE):
+            compression = self.__validateCompression(compression)
+            encoding = self.__validateEncoding(encoding)
+
+        if (self.isConnected()):
+            try:
+                if (storageType == 1):
+                    return self.__insertHumanAnnotations(normalizeAnnotations(annotations, strDocId, batchCommon),
+                                                         atomic, bulk_insert.insertStream)
+                else:
+                    return self.__insertBatch(annotations, strDocId, batchCommon, batchCommon,
+                                              compression, encoding)
+            except json_stream.JsonStreamError as e:
+                logger.logInfo(AnnotationException(16, e))
+                raise AnnotationException(16, e)
             except AnnotationException as e:
                 logger.logError(e)
                 raise e
@@ -257,13 +547,17 @@ class AnnotationManager(StorageManager):
                 logger.logUnknownError("Annotation Storage Create Annotations",
                                        "", e)
                 raise MongoDocumentException(0)
+            finally:
+                self.__touchAnnotations([strDocId])
         else:
             raise StorageException(1)
 
     def replaceAnnotationsInLargeStorage(self,
                                          jsonBatch,
                                          strDocId,
-                                         batchFormat=1):
+                                         batchFormat=1,
+                                         compression=None,
+                                         encoding=None):
         """
         Create or replace batch annotations. Only works for batches present in large storage.
         This will first delete any batches (either the default batch, or batches returned by
@@ -280,9 +574,128 @@ class AnnotationManager(StorageManager):
 
         self.deleteAnnotationS([strDocId], jsonSelect, AnnotationManager.BATCH_STORAGE)
         return self.createAnnotationS(jsonBatch, strDocId, batchFormat,
-                                      AnnotationManager.BATCH_STORAGE)
+                                      AnnotationManager.BATCH_STORAGE, compression, encoding)
+
+    def appendAnnotationsInLargeStorage(self,
+                                        jsonBatch,
+                                        strDocId,
+                                        batchFormat=1):
+        """
+        Append annotations to a batch present in large storage. The batch is
+        the one matching the "common" section. If there is no such batch, it
+        is created.
+
+        Batch attributes for which a new annotation has a different value are
+        removed from the batch, so they can no longer be used to search it.
+        Appended annotations are encoded and compressed like the rest of the
+        batch.
+
+        see createAnnotationS for more details.
+
+        @return: Number of appended annotations.
+        """
+        if (not mongo_utils.isObjectId(strDocId)):
+            logger.logInfo(AnnotationException(1, strDocId))
+            raise AnnotationException(1, strDocId)
+
+        validateStorageByType(self.storageCollections, AnnotationManager.BATCH_STORAGE)
+
+        if 'data' not in jsonBatch:
+            return 0
+
+        batchCommon = {}
+        if (batchFormat == AnnotationManager.COMPACT_BATCH_FORMAT):
+            batchCommon = jsonBatch.get('common', {})
+        elif (batchFormat != AnnotationManager.BASIC_BATCH_FORMAT):
+            logger.logInfo(AnnotationException(5, batchFormat))
+            raise AnnotationException(5, batchFormat)
+
+        if not self.isConnected():
+            raise StorageException(1)
 
-    def search_annotations(self, query: str, skip: int, limit: int) -> dict:
+        jsonSelect = dict(batchCommon)
+        setDocIdToJsonSelect([strDocId], jsonSelect)
+        db = self.client[self.mongoDb]
+        coll = db[self.storageCollections[AnnotationManager.BATCH_STORAGE]]
+        fs = gridfs.GridFS(db)
+        try:
+            batchDoc = coll.find_one(jsonSelect)
+            if batchDoc is None:
+                return self.createAnnotationS(jsonBatch, strDocId, batchFormat,
+                                              AnnotationManager.BATCH_STORAGE)
+
+            if batch_storage.LEGACY_FILE_FIELD in batchDoc:
+                # A single file batch is a batch with only one chunk.
+                count = batch_storage.countBatchAnnotations(fs, batchDoc)
+                chunks = [{"file_id": batchDoc[batch_storage.LEGACY_FILE_FIELD], "offset": 0, "count": count}]
+                coll.update_one({"_id": batchDoc["_id"]},
+                                {"$set": {batch_storage.CHUNKS_FIELD: chunks,
+                                          batch_storage.COUNT_FIELD: count},
+                                 "$unset": {batch_storage.LEGACY_FILE_FIELD: ""}})
+            elif batch_storage.COUNT_FIELD not in batchDoc:
+                # New annotations are positioned after those of the chunks.
+                count = sum(chunk["count"] for chunk in batchDoc.get(batch_storage.CHUNKS_FIELD, []))
+                coll.update_one({"_id": batchDoc["_id"], batch_storage.COUNT_FIELD: {"$exists": False}},
+                                {"$set": {batch_storage.COUNT_FIELD: count}})
+            else:
+                count = batchDoc[batch_storage.COUNT_FIELD]
+
+            batchData = jsonBatch['data']
+            unset = {}
+            for anno in batchData:
+                for common in batchCommon:
+                    anno[common] = batchCommon[common]
+                if '_id' in anno:
+                    del anno["_id"]
+                anno['doc_id'] = strDocId
+                for attrib in anno:
+                    if (attrib in batchDoc and attrib not in unset and
+                            attrib not in batch_storage.RESERVED_FIELDS and
+                            anno[attrib] != batchDoc[attrib]):
+                        unset[attrib] = ""
+                anno["id"] = str(ObjectId())
+
+            # Chunks are written before their positions are known, then
+            # added with the count they were positioned after. A concurrent
+            # append changes the count, the chunks are then positioned again:
+            # positions are never reserved, thus never lost if writing fails.
+            nbAppended = len(batchData)
+            chunks = batch_storage.writeChunks(fs, batchData, self.__getBatchChunkSize(), 0,
+                                               batch_storage.getCompression(batchDoc),
+                                               batch_storage.getEncoding(batchDoc))
+            try:
+                while True:
+                    headers = [dict(chunk, offset=count + chunk["offset"]) for chunk in chunks]
+                    update = {"$push": {batch_storage.CHUNKS_FIELD: {"$each": headers}},
+                              "$inc": {batch_storage.COUNT_FIELD: nbAppended}}
+                    if unset:
+                        update["$unset"] = unset
+                    if coll.update_one({"_id": batchDoc["_id"], batch_storage.COUNT_FIELD: count},
+                                       update).matched_count == 1:
+                        return nbAppended
+                    current = coll.find_one({"_id": batchDoc["_id"]}, {batch_storage.COUNT_FIELD: 1})
+                    if current is None:
+                        break
+                    count = current[batch_storage.COUNT_FIELD]
+            except Exception:
+                batch_storage.deleteFilesBulk(db, [chunk["file_id"] for chunk in chunks])
+                raise
+
+            # The batch was deleted while the chunks were written: its
+            # deletion did not see them. The annotations make a new batch.
+            batch_storage.deleteFilesBulk(db, [chunk["file_id"] for chunk in chunks])
+            return self.createAnnotationS(jsonBatch, strDocId, batchFormat,
+                                          AnnotationManager.BATCH_STORAGE)
+        except AnnotationException as e:
+            logger.logError(e)
+            raise e
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Append Annotations", "", e)
+            raise MongoDocumentException(0)
+        finally:
+            self.__touchAnnotations([strDocId])
+
+    def search_annotations(self, query: str, skip: int, limit: int, fields: list = None) -> dict:
         """
         Search manual annotations (storageType 1)
         The body of the request is a JSON query passed to MongoDb collection find method.
@@ -292,11 +705,14 @@ class AnnotationManager(StorageManager):
         :param query: JSON query passed to MongoDb find
         :param skip: The number of result to skip.
         :param limit: The maximum number of results to return
+        :param fields: If not None, annotations only contain these fields (and id).
         :return: Array of results containing the annotation and score matching the query, sorted descending by score.
         """
         text_score = {self.SCORE_FIELD_NAME: {"$meta": "textScore"}}
+        projection = dict(text_score)
+        projection.update(getProjection(fields) or {})
         cursor = self.getMongoDocumentS(query, self.storageCollections[AnnotationManager.HUMAN_STORAGE],
-                                        projection=text_score,
+                                        projection=projection,
                                         sort=list(text_score.items()),
                                         skip=skip,
                                         limit=limit)
@@ -311,6 +727,60 @@ class AnnotationManager(StorageManager):
 
         return results
 
+    def search_annotations_page(self, query: dict, page_size: int = None, continuation_token: str = None,
+                                fields: list = None) -> dict:
+        """
+        Same as search_annotations, but returns one page of results. Pages are delimited by the position of their
+        last result (score then id for text searches, id otherwise) instead of a number of results to skip, thus
+        the cost of a page does not depend on its depth.
+
+        :param query: JSON query passed to MongoDb $match
+        :param page_size: The maximum number of results to return. Capped by the MaxPageSize setting.
+        :param continuation_token: Token returned with the previous page. None for the first page.
+        :param fields: If not None, annotations only contain these fields (and id).
+        :return: {"data": results, "next": token of the next page or None for the last page}
+        """
+        projection = getProjection(fields)
+        page_size = getPageSize(page_size)
+        after = decodeContinuationToken(continuation_token, ["id"]) if continuation_token else None
+
+        text_search = "$text" in query
+        pipeline = [{"$match": query}]
+        if text_search:
+            pipeline.append({"$addFields": {self.SCORE_FIELD_NAME: {"$meta": "textScore"}}})
+            sort = SON([(self.SCORE_FIELD_NAME, -1), ("_id", 1)])
+        else:
+            sort = SON([("_id", 1)])
+        if after is not None:
+            after_id = ObjectId(after["id"])
+            if text_search:
+                pipeline.append({"$match": {"$or": [{self.SCORE_FIELD_NAME: {"$lt": after.get("score")}},
+                                                    {self.SCORE_FIELD_NAME: after.get("score"),
+                                                     "_id": {"$gt": after_id}}]}})
+            else:
+                pipeline.append({"$match": {"_id": {"$gt": after_id}}})
+        pipeline += [{"$sort": sort}, {"$limit": page_size + 1}]
+        if projection is not None:
+            projection[self.SCORE_FIELD_NAME] = 1
+            pipeline.append({"$project": projection})
+
+        cursor = self.aggregate(pipeline, self.storageCollections[AnnotationManager.HUMAN_STORAGE])
+        results = []
+        next_token = None
+        for annotation in cursor:
+            if len(results) == page_size:
+                last = results[-1]
+                next_token = mongo_utils.encodeContinuationToken({"score": last["score"],
+                                                                  "id": last["annotation"]["id"]})
+                break
+            annotation["id"] = str(annotation['_id'])
+            del annotation["_id"]
+            score = annotation.pop(self.SCORE_FIELD_NAME, None)
+            results.append({"score": score, "annotation": annotation})
+        cursor.close()
+
+        return {"data": results, "next": next_token}
+
     def get_text_index_fields(self) -> list:
         if self.isConnected():
             try:
@@ -332,7 +802,7 @@ class AnnotationManager(StorageManager):
         else:
             raise StorageException(1)
 
-    def grouped_search_annotations(self, query: str, skip: int, limit: int) -> dict:
+    def grouped_search_annotations(self, query: str, skip: int, limit: int, fields: list = None) -> dict:
         """
         Search manual annotations(storageType 1) and group them by timeline.
         The body of the request is a JSON query passed to MongoDb collection aggregate method.
@@ -342,14 +812,18 @@ class AnnotationManager(StorageManager):
         :param query: JSON query passed to MongoDb $match (Should be a $text search
         :param skip: The number of result to skip.
         :param limit: The maximum number of results to return
+        :param fields: If not None, annotations only contain these fields (and id).
 
         :return: Array of annotation matches grouped by timeline (annotationSetId). Each match contains the annotation and score matching the query, sorted descending by score. Groups are also sorted descending by score.
         """
         annotation_filter = self.grouped_annotation_filter(limit, skip)
+        annotation = "$$ROOT"
+        if getProjection(fields) is not None:
+            annotation = self.__getProjectionExpression(fields)
         pipeline = [
             {"$match": query},
-            {"$project": {"score": {"$meta": "textScore"}, "annotationSetId": "$annotationSetId", "annotation": "$$ROOT",
-                          "_id": 0}},
+            {"$project": {"score": {"$meta": "textScore"}, "annotationSetId": "$annotationSetId",
+                          "annotation": annotation, "_id": 0}},
             {"$sort": {"score": -1}},  # Annotations descending order of score
             {"$group": {"_id": "$annotationSetId", "score": {"$sum": "$score"},
                         "annotations": {"$push": "$$ROOT"}}},
@@ -375,7 +849,8 @@ class AnnotationManager(StorageManager):
                        documentIds,
                        jsonSelect={},
                        batchFormat=0,
-                       storageType=0):
+                       storageType=0,
+                       fields=None):
         """
         Returns annotations respecting search criteria
 
@@ -387,44 +862,304 @@ class AnnotationManager(StorageManager):
 
         :@param batchFormat: Describes how the elements would be returned Supports : 0
 
+        :@param fields: If not None, annotations only contain these fields (and id). Human storage only returns
+                        them from MongoDB. Batches with columnar encoding only decode these fields, other batches
+                        are filtered once decoded. Fields of batch annotations can not be nested (a.b).
+
         :@return: Documents found. Return format is described by batchFormat.
         """
-        if not (self.__validateDocumentIds(documentIds)):
-            return {"data": []}
+        return {"data": list(self.iterAnnotationS(documentIds, jsonSelect, storageType, fields))}
+
+    def iterAnnotationS(self,
+                        documentIds,
+                        jsonSelect={},
+                        storageType=0,
+                        fields=None,
+                        skip=0,
+                        limit=None):
+        """
+        Same as getAnnotationS, but returns an iterator yielding annotations
+        one by one as they are read from the storage, instead of building the
+        whole list. Arguments are validated before the iterator is returned.
+
+        The manager must stay connected until the iterator is exhausted.
+
+        :@param skip: Number of annotations to skip. Human storage annotations come first. Batches whose annotations
+                      are all skipped are not read.
+
+        :@param limit: Maximum number of annotations to return.
+
+        :@return: Iterator of annotations.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return iter([])
 
-        # This will change later on.
-        arr = []
+        getProjection(fields)
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        self.__guardQuery(storageType, jsonSelect)
+        return self.__iterAnnotationS(documentIds, jsonSelect, storageType, fields, skip or 0, limit)
 
+    def explainAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        Explains how the annotations respecting search criteria would be found. The query is only run if it passes
+        the query guard (see jass.query_guard), within the time budget of the request.
+
+        See getAnnotationS for the parameters.
+
+        :@return: {"humanStorage": report, "batchStorage": report} for the storage searched, where report is
+                  described in query_guard.explainQuery.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {}
+        validateStorageByType(self.storageCollections, storageType)
+        if not self.isConnected():
+            raise StorageException(1)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        db = self.client[self.mongoDb]
+        res = {}
+        try:
+            for storage, name in [(AnnotationManager.HUMAN_STORAGE, "humanStorage"),
+                                  (AnnotationManager.BATCH_STORAGE, "batchStorage")]:
+                if storageType == AnnotationManager.ALL_STORAGE or storageType == storage:
+                    res[name] = query_guard.explainQuery(db, self.storageCollections[storage], jsonSelect,
+                                                         self.maxTimeMS)
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Explain", "", e)
+            raise MongoDocumentException(0)
+        return res
+
+    def countAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        Counts the annotations respecting search criteria without reading them. Human storage annotations are
+        counted by MongoDB, batch annotations from the count kept in each batch document (only legacy batches,
+        which have no count, are read).
+
+        See getAnnotationS for the parameters.
+
+        :@return: {"count": total, "humanStorage": count, "batchStorage": count} for the storage searched.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {"count": 0}
+        validateStorageByType(self.storageCollections, storageType)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        self.__guardQuery(storageType, jsonSelect)
+        res = {"count": 0}
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.HUMAN_STORAGE):
+            res["humanStorage"] = self.countMongoDocumentS(jsonSelect,
+                                                           self.storageCollections[AnnotationManager.HUMAN_STORAGE])
+            res["count"] += res["humanStorage"]
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.BATCH_STORAGE):
+            # Chunk headers are not needed to count.
+            batches = self.getMongoDocumentS(jsonSelect,
+                                             self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                             projection={batch_storage.CHUNKS_FIELD: 0})
+            try:
+                fs = gridfs.GridFS(self.client[self.mongoDb])
+                res["batchStorage"] = sum(batch_storage.countBatchAnnotations(fs, batch) for batch in batches)
+            finally:
+                batches.close()
+            res["count"] += res["batchStorage"]
+        return res
+
+    def hasAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        Checks whether an annotation respects search criteria, with at most one indexed lookup per storage.
+
+        See getAnnotationS for the parameters.
+
+        :@return: True if an annotation is found.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return False
+        validateStorageByType(self.storageCollections, storageType)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        self.__guardQuery(storageType, jsonSelect)
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.HUMAN_STORAGE):
+            if self.countMongoDocumentS(jsonSelect, self.storageCollections[AnnotationManager.HUMAN_STORAGE],
+                                        limit=1):
+                return True
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.BATCH_STORAGE):
+            # Legacy batches have no count, they are assumed not empty.
+            notEmpty = {"$or": [{batch_storage.COUNT_FIELD: {"$gt": 0}},
+                                {batch_storage.COUNT_FIELD: {"$exists": False}}]}
+            if self.countMongoDocumentS({"$and": [jsonSelect, notEmpty]},
+                                        self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                        limit=1):
+                return True
+        return False
+
+    # ~ Private
+    def __iterAnnotationS(self, documentIds, jsonSelect, storageType, fields, skip, limit):
+        if limit is not None and limit <= 0:
+            return
         # Used to add a prefix to indicate BATCH_STORAGE, but removed it, since
         # It is the user job to manage them.
         if (storageType == AnnotationManager.ALL_STORAGE or
                     storageType == AnnotationManager.HUMAN_STORAGE):
-            self.__setDocIdToJsonSelect(documentIds, jsonSelect)
+            setDocIdToJsonSelect(documentIds, jsonSelect)
             cursor = self.getMongoDocumentS(jsonSelect,
-                                            self.storageCollections[AnnotationManager.HUMAN_STORAGE])
-            for anno in cursor:
-                anno["id"] = str(anno['_id'])
-                del anno["_id"]
-                arr.append(anno)
+                                            self.storageCollections[AnnotationManager.HUMAN_STORAGE],
+                                            projection=getProjection(fields),
+                                            skip=skip, limit=limit)
+            try:
+                nbReturned = 0
+                for anno in cursor:
+                    anno["id"] = str(anno['_id'])
+                    del anno["_id"]
+                    nbReturned += 1
+                    yield anno
+                if nbReturned:
+                    skip = 0
+                elif skip:
+                    # Everything may have been skipped, the rest is skipped in batches.
+                    skip = max(0, skip - cursor.count())
+                if limit is not None:
+                    limit -= nbReturned
+                    if limit <= 0:
+                        return
+            finally:
+                cursor.close()
         if (storageType == AnnotationManager.ALL_STORAGE or
                     storageType == AnnotationManager.BATCH_STORAGE):
-            self.__setDocIdToJsonSelect(documentIds, jsonSelect)
+            setDocIdToJsonSelect(documentIds, jsonSelect)
             cursor = self.getMongoDocumentS(jsonSelect,
                                             self.storageCollections[AnnotationManager.BATCH_STORAGE])
-            for batch in cursor:
+            try:
                 db = self.client[self.mongoDb]
                 fs = gridfs.GridFS(db)
-                annotations = {}
-                if (fs.exists(batch["file_fs_id_batch"])):
-                    annotations = json.loads(fs.get(batch["file_fs_id_batch"]).read())
-                arr += annotations
+                for batch in cursor:
+                    if skip:
+                        count = batch_storage.countBatchAnnotations(fs, batch)
+                        if skip >= count:
+                            skip -= count
+                            continue
+                    for anno in batch_storage.iterBatchAnnotations(fs, batch, skip, limit,
+                                                                   getBatchFields(fields),
+                                                                   self.maxTimeMS):
+                        if limit is not None:
+                            limit -= 1
+                        yield anno
+                    skip = 0
+                    if limit is not None and limit <= 0:
+                        return
+            finally:
+                cursor.close()
+
+    def getAnnotationPage(self,
+                          documentIds,
+                          jsonSelect={},
+                          storageType=0,
+                          pageSize=None,
+                          continuationToken=None,
+                          fields=None):
+        """
+        Returns one page of annotations respecting search criteria.
+
+        Annotations are ordered by position: human storage annotations by id, then batch annotations by batch id
+        and position in the batch. A page starts at the position stored in the continuation token instead of
+        skipping the previous annotations, thus the cost of a page does not depend on its depth.
+
+        :@param pageSize: Maximum number of annotations in the page. Capped by the MaxPageSize setting.
 
-        return {"data": arr}
+        :@param continuationToken: Token returned with the previous page. None for the first page.
+
+        See getAnnotationS for the other parameters.
+
+        :@return: {"data": annotations, "next": token of the next page or None for the last page}
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {"data": [], "next": None}
+
+        pageSize = getPageSize(pageSize)
+        getProjection(fields)
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        self.__guardQuery(storageType, jsonSelect)
+        start = None
+        if continuationToken:
+            start = decodeContinuationToken(continuationToken, ["s", "id"])
+            if (start["s"] not in [AnnotationManager.HUMAN_STORAGE, AnnotationManager.BATCH_STORAGE] or
+                    (storageType != AnnotationManager.ALL_STORAGE and start["s"] != storageType)):
+                logger.logInfo(AnnotationException(12, continuationToken))
+                raise AnnotationException(12, continuationToken)
+
+        data = []
+        nextToken = None
+        annotations = self.__iterFromPosition(documentIds, jsonSelect, storageType, fields, start, pageSize + 1)
+        try:
+            for position, anno in annotations:
+                if len(data) == pageSize:
+                    nextToken = mongo_utils.encodeContinuationToken(position)
+                    break
+                data.append(anno)
+        finally:
+            annotations.close()
+
+        return {"data": data, "next": nextToken}
+
+    # ~ Private
+    def __iterFromPosition(self, documentIds, jsonSelect, storageType, fields, start, limit):
+        """
+        Yields (position, annotation) tuples, starting at position start.
+        """
+        if (start is None or start["s"] == AnnotationManager.HUMAN_STORAGE) and \
+                (storageType == AnnotationManager.ALL_STORAGE or storageType == AnnotationManager.HUMAN_STORAGE):
+            setDocIdToJsonSelect(documentIds, jsonSelect)
+            query = jsonSelect
+            if start is not None:
+                query = {"$and": [jsonSelect, {"_id": {"$gte": ObjectId(start["id"])}}]}
+            cursor = self.getMongoDocumentS(query,
+                                            self.storageCollections[AnnotationManager.HUMAN_STORAGE],
+                                            projection=getProjection(fields),
+                                            sort=[("_id", 1)], limit=limit)
+            try:
+                for anno in cursor:
+                    position = {"s": AnnotationManager.HUMAN_STORAGE, "id": str(anno['_id'])}
+                    anno["id"] = str(anno['_id'])
+                    del anno["_id"]
+                    yield position, anno
+            finally:
+                cursor.close()
+            start = None
+
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                    storageType == AnnotationManager.BATCH_STORAGE):
+            setDocIdToJsonSelect(documentIds, jsonSelect)
+            query = jsonSelect
+            if start is not None:
+                query = {"$and": [jsonSelect, {"_id": {"$gte": ObjectId(start["id"])}}]}
+            cursor = self.getMongoDocumentS(query,
+                                            self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                            sort=[("_id", 1)])
+            try:
+                fs = gridfs.GridFS(self.client[self.mongoDb])
+                for batch in cursor:
+                    index = 0
+                    if start is not None and str(batch["_id"]) == start["id"]:
+                        index = start.get("p", 0)
+                    for anno in batch_storage.iterBatchAnnotations(fs, batch, index, None,
+                                                                   getBatchFields(fields),
+                                                                   self.maxTimeMS):
+                        yield {"s": AnnotationManager.BATCH_STORAGE, "id": str(batch["_id"]), "p": index}, anno
+                        index += 1
+            finally:
+                cursor.close()
 
     def deleteAnnotationS(self, documentIds, jsonSelect={}, storageType=1):
         """
         Delete multiple annotations.
 
+        Batch documents are deleted first, then the GridFS files of all the deleted batches by slices (see
+        batch_storage.deleteFilesBulk).
+
         :@param documentIds: List of documents containing the annotations.
 
         :@param jsonSelect: Additional query parameters, which can restrict the search: See: http://docs.mongodb.org/manual/reference/operator/query/ for options
@@ -435,98 +1170,238 @@ class AnnotationManager(StorageManager):
 
         :@return: Number of documents deleted.
         """
-        if not (self.__validateDocumentIds(documentIds)):
-            return 0
+        return self.__deleteAnnotationS(documentIds, jsonSelect, storageType, False)[0]
+
+    def deleteAnnotationSInBackground(self, documentIds, jsonSelect={}, storageType=1):
+        """
+        Same as deleteAnnotationS, but the GridFS files of the deleted batches are deleted by a background job (see
+        jass.jobs). Annotations are not visible anymore once this method returns.
+
+        :@return: {"nDeleted": number of documents deleted, "jobId": id of the job deleting the files, or None if
+                  there is no file to delete}
+        """
+        count, jobId = self.__deleteAnnotationS(documentIds, jsonSelect, storageType, True)
+        return {"nDeleted": count, "jobId": jobId}
 
-        self.__validateStorageByType(storageType)
+    # ~ Private
+    def __deleteAnnotationS(self, documentIds, jsonSelect, storageType, inBackground):
+        """
+        :return: (number of documents deleted, id of the job deleting files or None)
+        """
+        if not (validateDocumentIds(documentIds)):
+            return 0, None
 
-        # This will change later on.
+        validateStorageByType(self.storageCollections, storageType)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        self.__guardQuery(storageType, jsonSelect)
+        try:
+            count, jobId = self.__deleteFromStorages(jsonSelect, storageType, inBackground)
+        finally:
+            self.__touchAnnotations(documentIds)
+        return count, jobId
+
+    # ~ Private
+    def __deleteFromStorages(self, jsonSelect, storageType, inBackground):
+        """
+        :return: (number of documents deleted, id of the job deleting files or None)
+        """
         count = 0
-        self.__setDocIdToJsonSelect(documentIds, jsonSelect)
-        # print jsonSelect
+        jobId = None
         if (storageType == AnnotationManager.HUMAN_STORAGE or
                     storageType == AnnotationManager.ALL_STORAGE):
             count += self.deleteMongoDocumentS(jsonSelect,
                                                self.storageCollections[AnnotationManager.HUMAN_STORAGE])
         if (storageType == AnnotationManager.BATCH_STORAGE or
                     storageType == AnnotationManager.ALL_STORAGE):
-            # find all batches, delete batch content, then delete batch.
-            batchDocs = self.getMongoDocumentS(jsonSelect,
-                                               self.storageCollections[AnnotationManager.BATCH_STORAGE])
-            # print jsonSelect
-            db = self.client[self.mongoDb]
-            fs = gridfs.GridFS(db)
-            # delete all the files
+            batchCollection = self.storageCollections[AnnotationManager.BATCH_STORAGE]
+            # Only the file ids are needed.
+            batchDocs = self.getMongoDocumentS(jsonSelect, batchCollection,
+                                               projection={batch_storage.LEGACY_FILE_FIELD: 1,
+                                                           batch_storage.CHUNKS_FIELD + ".file_id": 1})
+            batchIds = []
+            fileIds = []
             for batch in batchDocs:
+                batchIds.append(batch["_id"])
+                fileIds += batch_storage.getBatchFileIds(batch)
+            # Batches are deleted first, so that no batch refers to deleted files.
+            for i in range(0, len(batchIds), DELETE_SLICE_SIZE):
+                count += self.deleteMongoDocumentS({"_id": {"$in": batchIds[i:i + DELETE_SLICE_SIZE]}},
+                                                   batchCollection)
+            db = self.client[self.mongoDb]
+            if inBackground and fileIds:
+                jobId = jobs.submit(db, DELETE_FILES_JOB, items=fileIds,
+                                    progress={"done": 0, "total": len(fileIds)})
+            else:
                 try:
-                    annoFileID = batch["file_fs_id_batch"]
-                    if (fs.exists(annoFileID)):
-                        fs.delete(annoFileID)
+                    batch_storage.deleteFilesBulk(db, fileIds)
                 except Exception as e:
-                    # clean up file info so we dont have garbage in our db
+                    # Batches are already deleted, files are left as garbage.
                     logger.logUnknownError("Annotation Storage Delete Annotations", "", e)
-            # delete all the batches
-            count += self.deleteMongoDocumentS(jsonSelect,
-                                               self.storageCollections[AnnotationManager.BATCH_STORAGE])
 
-        return count
+        return count, jobId
 
-    # ~ Private
-    def __setDocIdToJsonSelect(self, documentIds, jsonSelect):
+    def getAnnotationsVersion(self, strDocId):
         """
-        set a filter by doc id
+        :@return: Change counter of the annotations of a document, incremented by each write of its annotations.
+                  0 if they were never written.
         """
-        if "doc_id" in jsonSelect:
-            del jsonSelect["doc_id"]
+        if not self.isConnected():
+            raise StorageException(1)
+        doc = self.getMongoDocumentS({"_id": str(strDocId)}, _getAnnotationVersionCollection()).limit(-1)
+        try:
+            doc = next(doc, None)
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+        return doc["version"] if doc is not None else 0
 
-        if "file_fs_id_batch" in jsonSelect:
-            del jsonSelect["file_fs_id_batch"]
+    # ~ Private
+    def __touchAnnotations(self, strDocIds):
+        if self.isConnected():
+            touchAnnotations(self.client[self.mongoDb], strDocIds)
 
-        docs = []
-        for docId in documentIds:
-            docs.append(str(docId))
+    # ~ Private
+    def __validateCompression(self, compression):
+        """
+        :return: The codec to use for a new batch.
+        """
+        if compression is None:
+            compression = settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "BatchCompression",
+                                                           batch_storage.NO_COMPRESSION)
+        if not batch_storage.isCompressionSupported(compression):
+            logger.logInfo(AnnotationException(10, compression))
+            raise AnnotationException(10, compression)
+        return compression
 
-        try:
-            jsonSelect["doc_id"] = {"$in": docs}
-        except Exception as e:
-            logger.logUnknownError("Annotation Storage Get Doc Id", "Failed Delete Query", e)
+    # ~ Private
+    def __validateEncoding(self, encoding):
+        """
+        :return: The encoding to use for a new batch.
+        """
+        if encoding is None:
+            encoding = settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "BatchEncoding",
+                                                        batch_storage.JSON_ENCODING)
+        if encoding not in batch_storage.ENCODINGS:
+            logger.logInfo(AnnotationException(11, encoding))
+            raise AnnotationException(11, encoding)
+        return encoding
 
     # ~ Private
-    def __validateDocumentIds(self, documentIds):
+    def __getProjectionExpression(self, fields):
         """
-        :@param documentIds: List of documents containing the annotations.
-                             Raises an exception if documentIds contains an
-                             invalid Id
-                             (Invalid Format, not whenever it exists or not).
-        :@return: 0 if documentIds is empty.
+        :return: Aggregation expression building an annotation containing
+                 only fields (and id) from the current document.
         """
-        if not (type(documentIds) is list):
-            return 0
+        expression = {"_id": "$_id"}
+        for field in fields:
+            parent = expression
+            parts = field.split(".")
+            for part in parts[:-1]:
+                parent = parent.setdefault(part, {})
+                if not isinstance(parent, dict):
+                    break
+            else:
+                parent[parts[-1]] = "$" + field
+        return expression
 
-        if (len(documentIds) == 0):
-            return 0
+    # ~ Private
+    def __guardQuery(self, storageType, jsonSelect):
+        """
+        Applies the query guard to a client query, for each storage searched.
+        """
+        if not self.isConnected():
+            raise StorageException(1)
+        db = self.client[self.mongoDb]
+        for storage in [AnnotationManager.HUMAN_STORAGE, AnnotationManager.BATCH_STORAGE]:
+            if storageType == AnnotationManager.ALL_STORAGE or storageType == storage:
+                try:
+                    query_guard.checkQuery(db, self.storageCollections[storage], jsonSelect)
+                except (AnnotationException, StorageException):
+                    raise
+                except Exception as e:
+                    logger.logUnknownError("Annotation Storage Query Guard", "", e)
+                    raise MongoDocumentException(0)
 
-        for docId in documentIds:
-            if (not mongo_utils.isObjectId(docId)):
-                logger.logInfo(AnnotationException(3, docId))
-                raise AnnotationException(3, docId)
+    # ~ Private
+    def __insertHumanAnnotations(self, annotations, atomic, insert):
+        """
+        Inserts normalized annotations in human storage.
 
-        return 1
+        :param insert: bulk_insert.insertMany or bulk_insert.insertStream.
+        :return: Number of inserted annotations.
+        """
+        coll = self.client[self.mongoDb][self.storageCollections[AnnotationManager.HUMAN_STORAGE]]
+        batchSize, workers, atomic = self.__getInsertOptions(atomic)
+        result = insert(coll, annotations, batchSize, workers, atomic)
+        if result.errors:
+            if result.rolledBack:
+                e = AnnotationException(13, len(result.errors), result.nDocuments)
+            else:
+                e = AnnotationException(8, result.nInserted, result.nDocuments)
+            e.nInserted = result.nInserted
+            e.errors = result.errors
+            raise e
+        return result.nInserted
 
-    def __validateStorageByType(self, storageType):
-        if (storageType < AnnotationManager.ALL_STORAGE or
-                    storageType > AnnotationManager.BATCH_STORAGE):
-            logger.logError(AnnotationException(7, storageType))
-            raise AnnotationException(7, storageType)
+    # ~ Private
+    def __insertBatch(self, batchData, strDocId, batchCommon, common, compression, encoding):
+        """
+        Writes annotations in GridFS chunks as they are read, then creates
+        their batch.
+
+        :param batchData: Iterable of annotations, normalized as they are
+                          encoded.
+        :param batchCommon: Attributes copied in each annotation.
+        :param common: Attributes of the batch document.
+        :return: Number of inserted annotations.
+        """
+        db = self.client[self.mongoDb]
+        coll = db[self.storageCollections[AnnotationManager.BATCH_STORAGE]]
+        fs = gridfs.GridFS(db)
+        batchDoc = {}
+        chunks = batch_storage.writeChunks(fs, normalizeAnnotations(batchData, strDocId, batchCommon, batchDoc),
+                                           self.__getBatchChunkSize(),
+                                           compression=compression, encoding=encoding)
+        nbInserted = sum(chunk["count"] for chunk in chunks)
+        if common:
+            for attrib in common:
+                batchDoc[attrib] = common[attrib]
+
+        batchDoc['doc_id'] = str(strDocId)
+        for field in batch_storage.RESERVED_FIELDS:
+            batchDoc.pop(field, None)
+        batchDoc[batch_storage.CHUNKS_FIELD] = chunks
+        batchDoc[batch_storage.COUNT_FIELD] = nbInserted
+        if compression != batch_storage.NO_COMPRESSION:
+            batchDoc[batch_storage.COMPRESSION_FIELD] = compression
+        if encoding != batch_storage.JSON_ENCODING:
+            batchDoc[batch_storage.ENCODING_FIELD] = encoding
+        try:
+            coll.insert(batchDoc)
+        except Exception as e:
+            # clean up file info so we dont have garbage in our db
+            logger.logUnknownError("Annotation Storage Create Annotations", "", e)
+            batch_storage.deleteFiles(fs, [chunk["file_id"] for chunk in chunks])
+            raise MongoDocumentException(0)
+        return nbInserted
+
+    # ~ Private
+    def __getInsertOptions(self, atomic):
+        """
+        :return: (sub-batch size, number of workers, atomic) used to insert
+                 annotations in human storage.
+        """
+        batchSize = int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "HumanInsertBatchSize",
+                                                         bulk_insert.DEFAULT_BATCH_SIZE))
+        workers = int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "HumanInsertWorkers",
+                                                       bulk_insert.DEFAULT_WORKERS))
+        if atomic is None:
+            atomic = str(settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "HumanInsertAtomic",
+                                                          "false")).strip().lower() in ("1", "true", "yes", "on")
+        return batchSize, workers, atomic
+
+    # ~ Private
+    def __getBatchChunkSize(self):
+        return int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations", "BatchChunkSize",
+                                                    batch_storage.DEFAULT_CHUNK_SIZE))
 
-        # Check for all storage types requirements.
-        if (storageType == AnnotationManager.ALL_STORAGE):
-            for storageType in [AnnotationManager.HUMAN_STORAGE,
-                                AnnotationManager.BATCH_STORAGE]:
-                if storageType not in self.storageCollections:
-                    logger.logError(AnnotationException(6, storageType))
-                    raise AnnotationException(6, storageType)
-        else:
-            if storageType not in self.storageCollections:
-                logger.logError(AnnotationException(6, storageType))
-                raise AnnotationException(6, storageType)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Asynchronous counterpart of annotations_manager, used by the asynchronous
+app (async_rest). Only reads are implemented, writes are served by the Flask
+app.
+
+Batch files are read with the GridFS bucket of motor, whole, then decoded
+like the synchronous managers do (see batch_storage.decodeChunk). The query
+guard and explain are run by the synchronous implementation, in the default
+executor: the throttling policy may wait.
+"""
+
+import asyncio
+import time
+
+import gridfs.errors
+import motor.motor_asyncio
+import pymongo.errors
+
+import jass.annotations_manager as annotations_manager
+import jass.batch_storage as batch_storage
+import jass.json_stream as json_stream
+import jass.mongo_pool as mongo_pool
+import jass.mongo_utils as mongo_utils
+import jass.query_guard as query_guard
+import jass.time_budget as time_budget
+import jass.custom_logger as logger
+from jass.storage_exception import *
+from jass.annotations_manager import AnnotationManager
+from jass.annotations_manager import validateDocumentIds, setDocIdToJsonSelect, getProjection, getBatchFields
+from jass.annotations_manager import getPageSize, decodeContinuationToken, validateStorageByType
+from jass.async_storage_manager import AsyncStorageManager
+from bson.objectid import ObjectId
+
+
+async def readFile(bucket, fileId, budgetMS=None):
+    """
+    Reads a GridFS file by pieces.
+
+    :param bucket: AsyncIOMotorGridFSBucket instance.
+    :param budgetMS: If not None, raises ExecutionTimeout once reading takes
+                     more than budgetMS milliseconds (see
+                     time_budget.DeadlineReader).
+    :return: The content of the file.
+    """
+    deadline = None if not budgetMS else time.monotonic() + budgetMS / 1000.0
+    gridOut = await bucket.open_download_stream(fileId)
+    pieces = []
+    while True:
+        if deadline is not None and time.monotonic() > deadline:
+            raise pymongo.errors.ExecutionTimeout("GridFS read exceeded its time budget",
+                                                  time_budget.EXCEEDED_TIME_LIMIT)
+        piece = await gridOut.read(json_stream.DEFAULT_READ_SIZE)
+        if not piece:
+            return b"".join(pieces)
+        pieces.append(piece)
+
+
+async def iterBatchAnnotations(bucket, batchDoc, skip=0, limit=None, fields=None, budgetMS=None):
+    """
+    Same as batch_storage.iterBatchAnnotations, as an asynchronous
+    generator.
+
+    :param bucket: AsyncIOMotorGridFSBucket instance.
+    """
+    compression = batch_storage.getCompression(batchDoc)
+    encoding = batch_storage.getEncoding(batchDoc)
+    end = None if limit is None else skip + limit
+    for header in batch_storage.getChunkHeaders(batchDoc):
+        offset = header["offset"]
+        if end is not None and offset >= end:
+            return
+        if header["count"] is not None and offset + header["count"] <= skip:
+            continue
+        try:
+            data = await readFile(bucket, header["file_id"], budgetMS)
+        except gridfs.errors.NoFile:
+            if batch_storage.LEGACY_FILE_FIELD in batchDoc:
+                return
+            raise
+        position = offset
+        for anno in batch_storage.decodeChunk(data, header, compression, encoding, fields):
+            if end is not None and position >= end:
+                return
+            if position >= skip:
+                yield anno
+            position += 1
+
+
+async def countBatchAnnotations(bucket, batchDoc):
+    """
+    Same as batch_storage.countBatchAnnotations.
+    """
+    if batch_storage.COUNT_FIELD in batchDoc:
+        return batchDoc[batch_storage.COUNT_FIELD]
+    count = 0
+    async for anno in iterBatchAnnotations(bucket, batchDoc):
+        count += 1
+    return count
+
+
+class AsyncAnnotationManager(AsyncStorageManager):
+    """
+    Asynchronous annotation manager. Operations have the same arguments,
+    results and exceptions as the ones of AnnotationManager, whose storage
+    types are used.
+    """
+
+    def addStorageCollection(self, storageType, collectionName):
+        """
+        See AnnotationManager.addStorageCollection.
+        """
+        if not hasattr(self, 'storageCollections'):
+            self.storageCollections = {}
+
+        self.storageCollections[storageType] = collectionName
+
+    async def getAnnotation(self, strAnnoId, storageType=1):
+        """
+        See AnnotationManager.getAnnotation.
+        """
+        return await self.getMongoDocument(strAnnoId,
+                                           self.storageCollections[storageType])
+
+    async def getAnnotationS(self,
+                             documentIds,
+                             jsonSelect={},
+                             batchFormat=0,
+                             storageType=0,
+                             fields=None):
+        """
+        See AnnotationManager.getAnnotationS.
+        """
+        annotations = await self.iterAnnotationS(documentIds, jsonSelect, storageType, fields)
+        return {"data": [anno async for anno in annotations]}
+
+    async def iterAnnotationS(self,
+                              documentIds,
+                              jsonSelect={},
+                              storageType=0,
+                              fields=None,
+                              skip=0,
+                              limit=None):
+        """
+        See AnnotationManager.iterAnnotationS. Arguments are validated
+        (and the query guarded) when awaited.
+
+        :@return: Asynchronous iterator of annotations. Call its aclose if
+                  it is not exhausted.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return self.__iterNothing()
+
+        getProjection(fields)
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        await self.__guardQuery(storageType, jsonSelect)
+        return self.__iterAnnotationS(documentIds, jsonSelect, storageType, fields, skip or 0, limit)
+
+    async def explainAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        See AnnotationManager.explainAnnotationS.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {}
+        validateStorageByType(self.storageCollections, storageType)
+        if not self.isConnected():
+            raise StorageException(1)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        db = mongo_pool.getClient()[self.mongoDb]
+        res = {}
+        try:
+            for storage, name in [(AnnotationManager.HUMAN_STORAGE, "humanStorage"),
+                                  (AnnotationManager.BATCH_STORAGE, "batchStorage")]:
+                if storageType == AnnotationManager.ALL_STORAGE or storageType == storage:
+                    res[name] = await self.__runInExecutor(query_guard.explainQuery, db,
+                                                           self.storageCollections[storage], jsonSelect,
+                                                           self.maxTimeMS)
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Explain", "", e)
+            raise MongoDocumentException(0)
+        return res
+
+    async def countAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        See AnnotationManager.countAnnotationS.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {"count": 0}
+        validateStorageByType(self.storageCollections, storageType)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        await self.__guardQuery(storageType, jsonSelect)
+        res = {"count": 0}
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.HUMAN_STORAGE):
+            res["humanStorage"] = await self.countMongoDocumentS(
+                jsonSelect, self.storageCollections[AnnotationManager.HUMAN_STORAGE])
+            res["count"] += res["humanStorage"]
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.BATCH_STORAGE):
+            # Chunk headers are not needed to count.
+            batches = self.getMongoDocumentS(jsonSelect,
+                                             self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                             projection={batch_storage.CHUNKS_FIELD: 0})
+            try:
+                bucket = self.__getBucket()
+                res["batchStorage"] = 0
+                async for batch in batches:
+                    res["batchStorage"] += await countBatchAnnotations(bucket, batch)
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            finally:
+                await batches.close()
+            res["count"] += res["batchStorage"]
+        return res
+
+    async def hasAnnotationS(self, documentIds, jsonSelect={}, storageType=0):
+        """
+        See AnnotationManager.hasAnnotationS.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return False
+        validateStorageByType(self.storageCollections, storageType)
+
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        await self.__guardQuery(storageType, jsonSelect)
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.HUMAN_STORAGE):
+            if await self.countMongoDocumentS(jsonSelect,
+                                              self.storageCollections[AnnotationManager.HUMAN_STORAGE],
+                                              limit=1):
+                return True
+        if (storageType == AnnotationManager.ALL_STORAGE or
+                storageType == AnnotationManager.BATCH_STORAGE):
+            # Legacy batches have no count, they are assumed not empty.
+            notEmpty = {"$or": [{batch_storage.COUNT_FIELD: {"$gt": 0}},
+                                {batch_storage.COUNT_FIELD: {"$exists": False}}]}
+            if await self.countMongoDocumentS({"$and": [jsonSelect, notEmpty]},
+                                              self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                              limit=1):
+                return True
+        return False
+
+    async def getAnnotationPage(self,
+                                documentIds,
+                                jsonSelect={},
+                                storageType=0,
+                                pageSize=None,
+                                continuationToken=None,
+                                fields=None):
+        """
+        See AnnotationManager.getAnnotationPage.
+        """
+        if not (validateDocumentIds(documentIds)):
+            return {"data": [], "next": None}
+
+        pageSize = getPageSize(pageSize)
+        getProjection(fields)
+        setDocIdToJsonSelect(documentIds, jsonSelect)
+        await self.__guardQuery(storageType, jsonSelect)
+        start = None
+        if continuationToken:
+            start = decodeContinuationToken(continuationToken, ["s", "id"])
+            if (start["s"] not in [AnnotationManager.HUMAN_STORAGE, AnnotationManager.BATCH_STORAGE] or
+                    (storageType != AnnotationManager.ALL_STORAGE and start["s"] != storageType)):
+                logger.logInfo(AnnotationException(12, continuationToken))
+                raise AnnotationException(12, continuationToken)
+
+        data = []
+        nextToken = None
+        annotations = self.__iterFromPosition(documentIds, jsonSelect, storageType, fields, start, pageSize + 1)
+        try:
+            async for position, anno in annotations:
+                if len(data) == pageSize:
+                    nextToken = mongo_utils.encodeContinuationToken(position)
+                    break
+                data.append(anno)
+        finally:
+            await annotations.aclose()
+
+        return {"data": data, "next": nextToken}
+
+    async def getAnnotationsVersion(self, strDocId):
+        """
+        See AnnotationManager.getAnnotationsVersion.
+        """
+        if not self.isConnected():
+            raise StorageException(1)
+        coll = self.client[self.mongoDb][annotations_manager._getAnnotationVersionCollection()]
+        try:
+            doc = await coll.find_one({"_id": str(strDocId)}, max_time_ms=self.maxTimeMS)
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+        return doc["version"] if doc is not None else 0
+
+    # ~ Private
+    async def __iterNothing(self):
+        return
+        yield
+
+    # ~ Private
+    async def __iterAnnotationS(self, documentIds, jsonSelect, storageType, fields, skip, limit):
+        if limit is not None and limit <= 0:
+            return
+        try:
+            if (storageType == AnnotationManager.ALL_STORAGE or
+                    storageType == AnnotationManager.HUMAN_STORAGE):
+                setDocIdToJsonSelect(documentIds, jsonSelect)
+                humanCollection = self.storageCollections[AnnotationManager.HUMAN_STORAGE]
+                cursor = self.getMongoDocumentS(jsonSelect, humanCollection,
+                                                projection=getProjection(fields),
+                                                skip=skip, limit=limit)
+                try:
+                    nbReturned = 0
+                    async for anno in cursor:
+                        anno["id"] = str(anno['_id'])
+                        del anno["_id"]
+                        nbReturned += 1
+                        yield anno
+                    if nbReturned:
+                        skip = 0
+                    elif skip:
+                        # Everything may have been skipped, the rest is skipped in batches.
+                        skip = max(0, skip - await self.countMongoDocumentS(jsonSelect, humanCollection))
+                    if limit is not None:
+                        limit -= nbReturned
+                        if limit <= 0:
+                            return
+                finally:
+                    await cursor.close()
+            if (storageType == AnnotationManager.ALL_STORAGE or
+                    storageType == AnnotationManager.BATCH_STORAGE):
+                setDocIdToJsonSelect(documentIds, jsonSelect)
+                cursor = self.getMongoDocumentS(jsonSelect,
+                                                self.storageCollections[AnnotationManager.BATCH_STORAGE])
+                try:
+                    bucket = self.__getBucket()
+                    async for batch in cursor:
+                        if skip:
+                            count = await countBatchAnnotations(bucket, batch)
+                            if skip >= count:
+                                skip -= count
+                                continue
+                        async for anno in iterBatchAnnotations(bucket, batch, skip, limit,
+                                                               getBatchFields(fields),
+                                                               self.maxTimeMS):
+                            if limit is not None:
+                                limit -= 1
+                            yield anno
+                        skip = 0
+                        if limit is not None and limit <= 0:
+                            return
+                finally:
+                    await cursor.close()
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+
+    # ~ Private
+    async def __iterFromPosition(self, documentIds, jsonSelect, storageType, fields, start, limit):
+        """
+        Yields (position, annotation) tuples, starting at position start.
+        """
+        try:
+            if (start is None or start["s"] == AnnotationManager.HUMAN_STORAGE) and \
+                    (storageType == AnnotationManager.ALL_STORAGE or storageType == AnnotationManager.HUMAN_STORAGE):
+                setDocIdToJsonSelect(documentIds, jsonSelect)
+                query = jsonSelect
+                if start is not None:
+                    query = {"$and": [jsonSelect, {"_id": {"$gte": ObjectId(start["id"])}}]}
+                cursor = self.getMongoDocumentS(query,
+                                                self.storageCollections[AnnotationManager.HUMAN_STORAGE],
+                                                projection=getProjection(fields),
+                                                sort=[("_id", 1)], limit=limit)
+                try:
+                    async for anno in cursor:
+                        position = {"s": AnnotationManager.HUMAN_STORAGE, "id": str(anno['_id'])}
+                        anno["id"] = str(anno['_id'])
+                        del anno["_id"]
+                        yield position, anno
+                finally:
+                    await cursor.close()
+                start = None
+
+            if (storageType == AnnotationManager.ALL_STORAGE or
+                    storageType == AnnotationManager.BATCH_STORAGE):
+                setDocIdToJsonSelect(documentIds, jsonSelect)
+                query = jsonSelect
+                if start is not None:
+                    query = {"$and": [jsonSelect, {"_id": {"$gte": ObjectId(start["id"])}}]}
+                cursor = self.getMongoDocumentS(query,
+                                                self.storageCollections[AnnotationManager.BATCH_STORAGE],
+                                                sort=[("_id", 1)])
+                try:
+                    bucket = self.__getBucket()
+                    async for batch in cursor:
+                        index = 0
+                        if start is not None and str(batch["_id"]) == start["id"]:
+                            index = start.get("p", 0)
+                        async for anno in iterBatchAnnotations(bucket, batch, index, None,
+                                                               getBatchFields(fields),
+                                                               self.maxTimeMS):
+                            yield {"s": AnnotationManager.BATCH_STORAGE, "id": str(batch["_id"]), "p": index}, anno
+                            index += 1
+                finally:
+                    await cursor.close()
+        except pymongo.errors.ExecutionTimeout:
+            raise StorageException(4, self.maxTimeMS)
+
+    # ~ Private
+    def __getBucket(self):
+        return motor.motor_asyncio.AsyncIOMotorGridFSBucket(self.client[self.mongoDb])
+
+    # ~ Private
+    async def __guardQuery(self, storageType, jsonSelect):
+        """
+        Applies the query guard to a client query, for each storage searched.
+        """
+        if not self.isConnected():
+            raise StorageException(1)
+        if query_guard.getPolicy() == query_guard.POLICY_OFF:
+            return
+        db = mongo_pool.getClient()[self.mongoDb]
+        for storage in [AnnotationManager.HUMAN_STORAGE, AnnotationManager.BATCH_STORAGE]:
+            if storageType == AnnotationManager.ALL_STORAGE or storageType == storage:
+                try:
+                    await self.__runInExecutor(query_guard.checkQuery, db, self.storageCollections[storage],
+                                               jsonSelect)
+                except (AnnotationException, StorageException):
+                    raise
+                except Exception as e:
+                    logger.logUnknownError("Annotation Storage Query Guard", "", e)
+                    raise MongoDocumentException(0)
+
+    # ~ Private
+    def __runInExecutor(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
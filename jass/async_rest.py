@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Asynchronous app serving the read routes of the REST API (see simple_rest)
+on aiohttp and motor. A worker serves many requests waiting on MongoDB with
+a single thread, instead of one thread per request.
+
+Routes, parameters, responses and error codes are the ones of simple_rest,
+whose documentation applies:
+
+    ============================================  ==========
+    Route                                         Methods
+    ============================================  ==========
+    /document/<document_id>                       GET
+    /annotationSchema/<schema_id>                 GET
+    /document/<document_id>/annotations           GET, HEAD
+    /document/<document_id>/annotations/count     GET
+    /document/<document_id>/annotation/<id>       GET
+    /annotations/bulk                             POST
+    ============================================  ==========
+
+Writes are served by the Flask app only: the reverse proxy sends the routes
+above (GET and HEAD, and POST /annotations/bulk) to this app, the others to
+simple_rest. Errors are always returned as JSON.
+
+Served by gunicorn:
+::
+
+    gunicorn -k aiohttp.worker.GunicornWebWorker jass.async_rest:APP
+"""
+
+# -- Standard lib ------------------------------------------------------------
+import asyncio
+import collections
+import http
+import optparse
+import os
+import zlib
+
+# -- 3rd party ---------------------------------------------------------------
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+# -- Project specific --------------------------------------------------------
+from jass.storage_exception import *
+from jass.annotations_manager import AnnotationManager
+from jass.storage_manager import VERSION_FIELD
+from jass.async_storage_manager import AsyncStorageManager
+from jass.async_annotations_manager import AsyncAnnotationManager
+from jass.utility_rest import NDJSON_MIMETYPE
+import jass.custom_logger as logger
+import jass.json_codec as json_codec
+import jass.rest_errors as rest_errors
+import jass.time_budget as time_budget
+import jass.settings as settings
+
+JSON_MIMETYPE = "application/json"
+
+
+# ============================================================
+#  Private
+# ===========================================================
+
+
+def _getBudgetMS(request):
+    """
+    Budget of the route (see time_budget). Routes have the names of the
+    Flask endpoints, thus the same budgets.
+    """
+    return time_budget.getBudgetMS(request.match_info.route.resource.name)
+
+
+def _jsonResponse(res, status=http.HTTPStatus.OK, etag=None):
+    response = web.Response(body=json_codec.dumpb(res), status=int(status), content_type=JSON_MIMETYPE)
+    if etag is not None:
+        response.headers["ETag"] = quote_etag(etag)
+    return response
+
+
+def _errorResponse(e):
+    """
+    Same as the JSON error responses of simple_rest (see rest_errors).
+    """
+    status, message, code, moreInfo = rest_errors.getError(e)
+    if not moreInfo:
+        res = {'Status': int(status), 'Message': message}
+    else:
+        # Line break doesn't make sense in JSON
+        res = {'Status': int(status),
+               'Message': message,
+               'Code': code,
+               'More_info': moreInfo.replace("\\n", " ")}
+    return _jsonResponse(res, status)
+
+
+def _wantsNdjson(request):
+    """
+    See utility_rest.request_wants_ndjson.
+    """
+    if request.query.get('format') == 'ndjson':
+        return True
+    accept = parse_accept_header(request.headers.get("Accept"), MIMEAccept)
+    best = accept.best_match([NDJSON_MIMETYPE, JSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE and accept[best] > accept[JSON_MIMETYPE]
+
+
+def _notModified(request, etag):
+    """
+    See simple_rest._notModified.
+    """
+    ifNoneMatch = request.headers.get("If-None-Match")
+    if etag is None or not ifNoneMatch:
+        return None
+    if not parse_etags(ifNoneMatch).contains_weak(etag):
+        return None
+    return web.Response(status=http.HTTPStatus.NOT_MODIFIED, headers={"ETag": quote_etag(etag)})
+
+
+async def _annotationsETag(request, man, document_id):
+    """
+    See simple_rest._annotationsETag. The tags of both apps are the same.
+    """
+    params = "{0}?{1}|{2}".format(request.path, request.query_string, "ndjson" if _wantsNdjson(request) else "json")
+    return "{0}-{1:08x}".format(await man.getAnnotationsVersion(document_id),
+                                zlib.crc32(params.encode("UTF-8")))
+
+
+async def _ndjsonResponse(request, annotations, etag=None):
+    """
+    Streams annotations as newline delimited JSON, one annotation per line.
+    Reading is abandoned if the client goes away.
+    """
+    response = web.StreamResponse()
+    response.content_type = NDJSON_MIMETYPE
+    if etag is not None:
+        response.headers["ETag"] = quote_etag(etag)
+    await response.prepare(request)
+    try:
+        async for anno in annotations:
+            await response.write(json_codec.dumpb(anno) + b"\n")
+    except (asyncio.CancelledError, ConnectionResetError):
+        logger.logUnknownDebug("Annotation Storage Stream Annotations",
+                               "Client went away, reading is abandoned")
+        raise
+    except Exception as e:
+        # Status is already sent, the client will get a truncated stream.
+        logger.logUnknownError("Annotation Storage Stream Annotations", "", e)
+    finally:
+        await annotations.aclose()
+    return response
+
+
+def _parseFields(fields):
+    """
+    See simple_rest._parseFields.
+    """
+    if fields is None or isinstance(fields, list):
+        return fields
+    if not isinstance(fields, str):
+        raise (StorageRestExceptions(5))
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def _convStorageIdToDocId(doc):
+    if '_id' in doc:
+        doc["id"] = doc["_id"]
+        del doc["_id"]
+
+
+def _createAnnotationManager(request):
+    man = AsyncAnnotationManager()
+    man.addStorageCollection(AnnotationManager.HUMAN_STORAGE,
+                             settings.GetConfigValue("ServiceStockageAnnotations",
+                                                     "HumanAnnotationCollection"))
+    man.addStorageCollection(AnnotationManager.BATCH_STORAGE,
+                             settings.GetConfigValue("ServiceStockageAnnotations",
+                                                     "BatchAnnotationCollection"))
+    man.connect(_getBudgetMS(request))
+    return man
+
+
+async def _getVersionedDocument(request, collectionKey, strDocId):
+    """
+    GET of a document or schema, see simple_rest.document.
+    """
+    man = AsyncStorageManager()
+    try:
+        man.setCollection(settings.GetConfigValue("ServiceStockageAnnotations",
+                                                  collectionKey))
+        man.connect(_getBudgetMS(request))
+        version = None
+        if request.headers.get("If-None-Match"):
+            version = await man.getMongoDocumentVersion(strDocId)
+            notModified = _notModified(request, version)
+            if notModified is not None:
+                return notModified
+        # Not older than the version just compared.
+        doc = await man.getMongoDocument(strDocId, version=version)
+        if (doc is None):
+            raise (StorageRestExceptions(2))
+        _convStorageIdToDocId(doc)
+        return _jsonResponse(doc, etag=doc.get(VERSION_FIELD))
+    except Exception as e:
+        return _errorResponse(e)
+    finally:
+        man.disconnect()
+
+
+# -- Routes ------------------------------------------------------------------
+
+
+@web.middleware
+async def log_request(request, handler):
+    if logger.isDebugEnabled():
+        logger.logUnknownDebug("Annotation Storage Request", "{0} {1} type: {2} length: {3} arguments: {4}",
+                               request.method, request.url, request.content_type, request.content_length,
+                               dict(request.query))
+    return await handler(request)
+
+
+async def document(request):
+    """
+    :route: **/document/<document_id>** (GET), see simple_rest.document.
+    """
+    logger.logUnknownDebug("Get Document", "Id: {0}", request.match_info["document_id"])
+    return await _getVersionedDocument(request, "documentCollection", request.match_info["document_id"])
+
+
+async def annotationSchema(request):
+    """
+    :route: **/annotationSchema/<schema_id>** (GET), see
+    simple_rest.annotationSchema.
+    """
+    logger.logUnknownDebug("Get Schema", "Id: {0}", request.match_info["schema_id"])
+    return await _getVersionedDocument(request, "SchemaCollection", request.match_info["schema_id"])
+
+
+async def documentAnnotationS(request):
+    """
+    :route: **/document/<document_id>/annotations** (GET, HEAD), see
+    simple_rest.documentAnnotationS.
+    """
+    document_id = request.match_info["document_id"]
+    man = None
+    try:
+        man = _createAnnotationManager(request)
+        try:
+            jsonSelect = request.query.get('jsonSelect')
+            jsonSelect = json_codec.loads(jsonSelect) if jsonSelect else {}
+            storageType = int(request.query.get('storageType') or 0)
+            batchFormat = int(request.query.get('batchFormat') or 0)
+            pageSize = request.query.get('pageSize')
+            if pageSize:
+                pageSize = int(pageSize)
+            continuationToken = request.query.get('continuationToken')
+            fields = _parseFields(request.query.get('fields'))
+            explain = request.query.get('explain', '').strip().lower() in ("1", "true", "yes", "on")
+        except Exception as e:
+            raise (StorageRestExceptions(5))
+
+        if request.method == 'HEAD':
+            found = await man.hasAnnotationS([document_id], jsonSelect, storageType)
+            return web.Response(status=http.HTTPStatus.OK if found else http.HTTPStatus.NOT_FOUND)
+        if explain:
+            return _jsonResponse(await man.explainAnnotationS([document_id], jsonSelect, storageType))
+        # The counter is read before the annotations, see touchAnnotations.
+        etag = await _annotationsETag(request, man, document_id)
+        notModified = _notModified(request, etag)
+        if notModified is not None:
+            return notModified
+        if pageSize or continuationToken:
+            page = await man.getAnnotationPage([document_id], jsonSelect, storageType,
+                                               pageSize, continuationToken, fields)
+            return _jsonResponse(page, etag=etag)
+        elif _wantsNdjson(request):
+            annotations = await man.iterAnnotationS([document_id], jsonSelect, storageType, fields)
+            return await _ndjsonResponse(request, annotations, etag)
+        else:
+            batch = await man.getAnnotationS([document_id], jsonSelect, batchFormat,
+                                             storageType, fields)
+            return _jsonResponse(batch, etag=etag)
+    except Exception as e:
+        return _errorResponse(e)
+    finally:
+        if man is not None:
+            man.disconnect()
+
+
+async def documentAnnotationSCount(request):
+    """
+    :route: **/document/<document_id>/annotations/count** (GET), see
+    simple_rest.documentAnnotationSCount.
+    """
+    man = None
+    try:
+        man = _createAnnotationManager(request)
+        try:
+            jsonSelect = json_codec.loads(request.query.get('jsonSelect') or '{}')
+            storageType = int(request.query.get('storageType') or 0)
+            if not isinstance(jsonSelect, dict):
+                raise ValueError()
+        except Exception as e:
+            raise (StorageRestExceptions(5))
+
+        return _jsonResponse(await man.countAnnotationS([request.match_info["document_id"]],
+                                                        jsonSelect, storageType))
+    except Exception as e:
+        return _errorResponse(e)
+    finally:
+        if man is not None:
+            man.disconnect()
+
+
+async def documentAnnotation(request):
+    """
+    :route: **/document/<document_id>/annotation/<annotation_id>** (GET), see
+    simple_rest.documentAnnotation.
+    """
+    man = None
+    try:
+        man = _createAnnotationManager(request)
+        logger.logUnknownDebug("Get Annotation", " For document Id: {0}", request.match_info["document_id"])
+        doc = await man.getAnnotation(request.match_info["annotation_id"])
+        if (doc is None):
+            raise (StorageRestExceptions(2))
+        _convStorageIdToDocId(doc)
+        return _jsonResponse(doc)
+    except Exception as e:
+        return _errorResponse(e)
+    finally:
+        if man is not None:
+            man.disconnect()
+
+
+async def bulkDocumentAnnotationS(request):
+    """
+    :route: **/annotations/bulk** (POST), see
+    simple_rest.bulkDocumentAnnotationS.
+    """
+    man = None
+    try:
+        try:
+            body = json_codec.loads(await request.read())
+        except ValueError:
+            raise BadRequest()
+        try:
+            documentIds = body['documentIds']
+            jsonSelect = body.get('jsonSelect') or {}
+            storageType = int(body.get('storageType') or 0)
+            skip = int(body.get('skip') or 0)
+            limit = body.get('limit')
+            if limit is not None:
+                limit = int(limit)
+            if not isinstance(documentIds, list) or not isinstance(jsonSelect, dict):
+                raise ValueError()
+        except Exception as e:
+            raise (StorageRestExceptions(5))
+
+        maxDocumentIds = int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations",
+                                                              "BulkMaxDocumentIds", 1000))
+        if len(documentIds) > maxDocumentIds:
+            raise (StorageRestExceptions(6, len(documentIds), maxDocumentIds))
+
+        man = _createAnnotationManager(request)
+        annotations = await man.iterAnnotationS(documentIds, jsonSelect, storageType,
+                                                skip=skip, limit=limit)
+        if _wantsNdjson(request):
+            return await _ndjsonResponse(request, annotations)
+
+        grouped = collections.OrderedDict((str(docId), []) for docId in documentIds)
+        async for anno in annotations:
+            grouped.setdefault(anno.get('doc_id'), []).append(anno)
+        return _jsonResponse({"data": grouped})
+    except Exception as e:
+        return _errorResponse(e)
+    finally:
+        if man is not None:
+            man.disconnect()
+
+
+def createApp():
+    """
+    :return: The aiohttp application. Routes are named after the Flask
+             endpoints (see _getBudgetMS).
+    """
+    app = web.Application(middlewares=[log_request])
+    for path, name, methods in [
+            ('/document/{document_id}', 'document', ['GET']),
+            ('/annotationSchema/{schema_id}', 'annotationSchema', ['GET']),
+            ('/document/{document_id}/annotations', 'documentAnnotationS', ['GET', 'HEAD']),
+            ('/document/{document_id}/annotations/count', 'documentAnnotationSCount', ['GET']),
+            ('/document/{document_id}/annotation/{annotation_id}', 'documentAnnotation', ['GET']),
+            ('/annotations/bulk', 'bulkDocumentAnnotationS', ['POST'])]:
+        resource = app.router.add_resource(path, name=name)
+        for method in methods:
+            resource.add_route(method, globals()[name])
+    return app
+
+
+APP = createApp()
+
+
+if __name__ == "__main__":
+    # -- Script entry point --------------------------------------------------
+    PARSER = optparse.OptionParser()
+    PARSER.add_option('-p', '--port', dest='port', type=int, default=5001)
+    PARSER.add_option('--host', dest='host', default="127.0.0.1")
+    PARSER.add_option('--config',
+                      dest="config_path",
+                      default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           "configs", "dev", "config.ini"),
+                      help='Configuration Directory')
+
+    OPTS, ARGS = PARSER.parse_args()
+    settings.Settings.Instance().LoadConfig(OPTS.config_path)
+    web.run_app(APP, host=OPTS.host, port=OPTS.port)
+else:
+    if os.environ.get('JASS_CONFIG_PATH') != None:
+        settings.Settings.Instance().LoadConfig(os.environ['JASS_CONFIG_PATH'])
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Asynchronous counterpart of storage_manager, used by the asynchronous app
+(async_rest). Operations are coroutines run on motor: a worker serves many
+requests waiting on MongoDB with a single thread.
+
+Only reads are implemented, writes are served by the Flask app.
+"""
+
+import pymongo.errors
+import jass.doc_cache as doc_cache
+import jass.mongo_pool as mongo_pool
+import jass.mongo_utils as mongo_utils
+import jass.settings as settings
+import jass.custom_logger as logger
+from jass.storage_exception import *
+from jass.storage_manager import VERSION_FIELD, clear_nones
+from bson.objectid import ObjectId
+from bson.errors import *
+
+
+class AsyncStorageManager:
+    """
+    Asynchronous storage manager class. Operations have the same arguments,
+    results and exceptions as the ones of StorageManager.
+
+    A manager holds the state of one request and borrows the motor client of
+    the process (see mongo_pool).
+    """
+    m_connected = False
+    # Time budget (ms) of each operation, None if not limited. See time_budget.
+    maxTimeMS = None
+
+    def setCollection(self, collection):
+        """
+        Collection in which documents will be read.
+        """
+        self.mongoCollection = collection
+
+    def connect(self, budgetMS=None):
+        """
+        Borrows the motor client of the process. motor connects when the
+        first operation is awaited.
+
+        :param budgetMS: Time budget of each operation (see time_budget).
+                         Given by the caller: time_budget.getCurrent is per
+                         thread, while a thread interleaves many requests.
+        """
+        self.maxTimeMS = budgetMS
+        try:
+            self.mongoDb = settings.GetConfigValue("ServiceStockageAnnotations",
+                                                   "MongoDb")
+            self.client = mongo_pool.getAsyncClient()
+            self.m_connected = True
+            return True
+
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Create Document",
+                                   "", e)
+            self.m_connected = False
+            return False
+
+    def isConnected(self):
+        return self.m_connected
+
+    async def getMongoDocument(self, strDocId, collection=None, version=None):
+        """
+        See StorageManager.getMongoDocument.
+        """
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            cached = doc_cache.isCached(collection)
+            if cached:
+                doc = doc_cache.getDocument(self.mongoDb, collection, str(strDocId))
+                if doc is not None and (version is None or doc.get(VERSION_FIELD) == version):
+                    mongo_utils.changeDocIdToString(doc)
+                    return doc
+            try:
+                coll = self.client[self.mongoDb][collection]
+                doc = await coll.find_one({"_id": ObjectId(strDocId)}, max_time_ms=self.maxTimeMS)
+                if cached and doc is not None:
+                    doc_cache.putDocument(self.mongoDb, collection, str(strDocId), doc)
+                mongo_utils.changeDocIdToString(doc)
+                return doc
+            except InvalidId:
+                return None
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Get Document",
+                                       "", e)
+                raise MongoDocumentException(0)
+        else:
+            raise StorageException(1)
+
+    async def getMongoDocumentVersion(self, strDocId, collection=None):
+        """
+        See StorageManager.getMongoDocumentVersion.
+        """
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            if not mongo_utils.isObjectId(strDocId):
+                return None
+            try:
+                coll = self.client[self.mongoDb][collection]
+                doc = await coll.find_one({"_id": ObjectId(strDocId)}, {VERSION_FIELD: 1},
+                                          max_time_ms=self.maxTimeMS)
+                return doc.get(VERSION_FIELD) if doc is not None else None
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Get Document",
+                                       "", e)
+                raise MongoDocumentException(0)
+        else:
+            raise StorageException(1)
+
+    def getMongoDocumentS(self, jsonQuery, collection=None, **kwargs):
+        """
+        See StorageManager.getMongoDocumentS.
+
+        :@return: A motor cursor, iterated with async for.
+        """
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            try:
+                coll = self.client[self.mongoDb][collection]
+                # Client might have called with None args. E.g. limit or skip
+                res = coll.find(jsonQuery, **clear_nones(kwargs))
+                if self.maxTimeMS:
+                    res.max_time_ms(self.maxTimeMS)
+                return res
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Get Document",
+                                       "", e)
+                raise MongoDocumentException(0)
+
+        else:
+            raise StorageException(1)
+
+    async def countMongoDocumentS(self, jsonQuery, collection=None, limit=None):
+        """
+        See StorageManager.countMongoDocumentS.
+        """
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            try:
+                coll = self.client[self.mongoDb][collection]
+                kwargs = clear_nones({"limit": limit, "maxTimeMS": self.maxTimeMS})
+                return await coll.count(jsonQuery, **kwargs)
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Count Documents",
+                                       "", e)
+                raise MongoDocumentException(0)
+
+        else:
+            raise StorageException(1)
+
+    def disconnect(self):
+        """
+        Releases the borrowed client, which stays open for the next requests
+        of the process.
+        """
+        self.client = None
+        self.m_connected = False
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Layout of the annotation files of large storage batches in GridFS.
+
+A batch document (in the batch annotation collection) contains the attributes
+common to all its annotations, which are stored in GridFS. Two layouts exist:
+
+    :Single file (legacy): file_fs_id_batch is the id of one GridFS file
+                           containing the JSON array of all the annotations.
+    :Chunked: file_fs_chunks_batch lists the chunks of the batch in order.
+              Each chunk is a GridFS file containing the JSON array of at most
+              BatchChunkSize annotations, and is described by a header:
+              ::
+
+                  {
+                      file_id: Id of the GridFS file,
+                      offset: Position of the first annotation of the chunk
+                              in the batch,
+                      count: Number of annotations in the chunk
+                  }
+
+              count_batch contains the total number of annotations.
+
+              compression_batch is the codec used to compress each chunk
+              (see COMPRESSIONS). It is absent for uncompressed batches.
+
+              encoding_batch is the encoding of each chunk before compression
+              (see ENCODINGS). It is absent for JSON encoded batches.
+
+Readers only need to fetch the chunks overlapping the annotations they want,
+and writers can append chunks to an existing batch.
+"""
+
+import gzip
+import io
+
+import jass.columnar as columnar
+import jass.custom_logger as logger
+import jass.json_codec as json_codec
+import jass.json_stream as json_stream
+from jass.storage_exception import AnnotationException
+import jass.time_budget as time_budget
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LEGACY_FILE_FIELD = "file_fs_id_batch"
+CHUNKS_FIELD = "file_fs_chunks_batch"
+COUNT_FIELD = "count_batch"
+COMPRESSION_FIELD = "compression_batch"
+ENCODING_FIELD = "encoding_batch"
+
+# Fields managed by the storage, which can not be set (or searched) by clients.
+RESERVED_FIELDS = [LEGACY_FILE_FIELD, CHUNKS_FIELD, COUNT_FIELD, COMPRESSION_FIELD,
+                   ENCODING_FIELD]
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Maximum number of files removed by a single delete (see deleteFilesBulk).
+FILE_DELETE_SLICE_SIZE = 1000
+
+NO_COMPRESSION = "none"
+GZIP_COMPRESSION = "gzip"
+# Requires the zstandard package.
+ZSTD_COMPRESSION = "zstd"
+COMPRESSIONS = [NO_COMPRESSION, GZIP_COMPRESSION, ZSTD_COMPRESSION]
+
+# JSON array of annotations.
+JSON_ENCODING = "json"
+# See the columnar module. Faster to encode and decode, and supports
+# decoding only some fields.
+COLUMNAR_ENCODING = "columnar"
+ENCODINGS = [JSON_ENCODING, COLUMNAR_ENCODING]
+
+
+def isCompressionSupported(compression):
+    """
+    :return: True if chunks can be written with this codec.
+    """
+    if compression == ZSTD_COMPRESSION:
+        return zstandard is not None
+    return compression in COMPRESSIONS
+
+
+def compressChunk(data, compression=NO_COMPRESSION):
+    """
+    Compresses the encoded content of a chunk.
+    """
+    if compression == GZIP_COMPRESSION:
+        return gzip.compress(data, 6)
+    elif compression == ZSTD_COMPRESSION:
+        return _getZstandard().ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def openChunk(fileObj, compression=NO_COMPRESSION):
+    """
+    Wraps the file object of a chunk so that reading it returns the
+    decompressed content, without decompressing it all at once.
+    """
+    if compression == GZIP_COMPRESSION:
+        return gzip.GzipFile(fileobj=fileObj, mode="rb")
+    elif compression == ZSTD_COMPRESSION:
+        return _getZstandard().ZstdDecompressor().stream_reader(fileObj)
+    return fileObj
+
+
+def _getZstandard():
+    """
+    :raise AnnotationException: If the zstandard package is not installed,
+                                thus zstd chunks can not be read or written.
+    """
+    if zstandard is None:
+        logger.logInfo(AnnotationException(10, ZSTD_COMPRESSION))
+        raise AnnotationException(10, ZSTD_COMPRESSION)
+    return zstandard
+
+
+def getCompression(batchDoc):
+    return batchDoc.get(COMPRESSION_FIELD, NO_COMPRESSION)
+
+
+def getEncoding(batchDoc):
+    return batchDoc.get(ENCODING_FIELD, JSON_ENCODING)
+
+
+def encodeChunk(chunk, encoding=JSON_ENCODING):
+    """
+    Encodes the annotations of a chunk as bytes.
+    """
+    if encoding == COLUMNAR_ENCODING:
+        return columnar.encode(chunk)
+    return json_codec.dumpb(chunk)
+
+
+def writeChunks(fs, annotations, chunkSize=DEFAULT_CHUNK_SIZE, offset=0,
+                compression=NO_COMPRESSION, encoding=JSON_ENCODING):
+    """
+    Writes annotations as chunks of at most chunkSize annotations.
+
+    :param fs: gridfs.GridFS instance.
+    :param annotations: Iterable of annotations. It is consumed chunk by
+                        chunk, thus can be a generator.
+    :param offset: Position of the first annotation in the batch (when
+                   appending).
+    :param compression: Codec used to compress each chunk. Must be the codec
+                        of the batch.
+    :param encoding: Encoding of each chunk. Must be the encoding of the
+                     batch.
+    :return: List of the headers of the written chunks. If writing fails,
+             chunks already written are deleted.
+    """
+    headers = []
+    chunk = []
+    try:
+        for anno in annotations:
+            chunk.append(anno)
+            if len(chunk) >= chunkSize:
+                headers.append(_writeChunk(fs, chunk, offset, compression, encoding))
+                offset += len(chunk)
+                chunk = []
+        if chunk:
+            headers.append(_writeChunk(fs, chunk, offset, compression, encoding))
+    except Exception:
+        deleteFiles(fs, [header["file_id"] for header in headers])
+        raise
+    return headers
+
+
+def _writeChunk(fs, chunk, offset, compression, encoding):
+    data = compressChunk(encodeChunk(chunk, encoding), compression)
+    fileId = fs.put(data)
+    return {"file_id": fileId, "offset": offset, "count": len(chunk)}
+
+
+def iterChunk(fs, header, compression=NO_COMPRESSION, encoding=JSON_ENCODING, fields=None, budgetMS=None):
+    """
+    Yields the annotations of one chunk.
+
+    :param fields: If not None, annotations only contain these fields.
+    :param budgetMS: If not None, reading the chunk raises ExecutionTimeout
+                     once it takes more than budgetMS milliseconds.
+    """
+    fileObj = fs.get(header["file_id"])
+    if budgetMS:
+        fileObj = time_budget.DeadlineReader(fileObj, budgetMS)
+    return _iterChunkFile(fileObj, header, compression, encoding, fields)
+
+
+def decodeChunk(data, header, compression=NO_COMPRESSION, encoding=JSON_ENCODING, fields=None):
+    """
+    Same as iterChunk, for the content of a chunk already read (by the
+    asynchronous managers).
+    """
+    return _iterChunkFile(io.BytesIO(data), header, compression, encoding, fields)
+
+
+def _iterChunkFile(fileObj, header, compression, encoding, fields):
+    fileObj = openChunk(fileObj, compression)
+    if encoding == COLUMNAR_ENCODING:
+        return iter(columnar.decode(_readAll(fileObj), fields))
+    if header["count"] is None:
+        # Legacy files hold a whole batch, they are decoded incrementally.
+        annotations = json_stream.iterJsonArray(fileObj)
+    else:
+        # Chunks are small enough to be decoded at once, which is much faster.
+        annotations = iter(json_codec.loads(_readAll(fileObj)))
+    if fields is None:
+        return annotations
+    return ({field: anno[field] for field in fields if field in anno} for anno in annotations)
+
+
+def _readAll(fileObj):
+    """
+    Reads a file by pieces, so that a DeadlineReader can interrupt it.
+    """
+    return b"".join(iter(lambda: fileObj.read(json_stream.DEFAULT_READ_SIZE), b""))
+
+
+def iterBatchAnnotations(fs, batchDoc, skip=0, limit=None, fields=None, budgetMS=None):
+    """
+    Yields the annotations of a batch, in order.
+
+    :param fs: gridfs.GridFS instance.
+    :param batchDoc: Batch document, in either layout.
+    :param skip: Number of annotations to skip. Chunks located entirely
+                 before are not read.
+    :param limit: Maximum number of annotations to return. Chunks located
+                  after are not read.
+    :param fields: If not None, annotations only contain these fields.
+    :param budgetMS: Time budget of reading each GridFS file (see iterChunk).
+    """
+    if LEGACY_FILE_FIELD in batchDoc and not fs.exists(batchDoc[LEGACY_FILE_FIELD]):
+        return
+    chunks = getChunkHeaders(batchDoc)
+
+    compression = getCompression(batchDoc)
+    encoding = getEncoding(batchDoc)
+    end = None if limit is None else skip + limit
+    for header in chunks:
+        offset = header["offset"]
+        if end is not None and offset >= end:
+            return
+        if header["count"] is not None and offset + header["count"] <= skip:
+            continue
+        position = offset
+        for anno in iterChunk(fs, header, compression, encoding, fields, budgetMS):
+            if end is not None and position >= end:
+                return
+            if position >= skip:
+                yield anno
+            position += 1
+
+
+def getChunkHeaders(batchDoc):
+    """
+    :return: Headers of the chunks of a batch, in order. A single file batch
+             has one chunk, whose count is None.
+    """
+    if LEGACY_FILE_FIELD in batchDoc:
+        return [{"file_id": batchDoc[LEGACY_FILE_FIELD], "offset": 0, "count": None}]
+    return batchDoc.get(CHUNKS_FIELD, [])
+
+
+def countBatchAnnotations(fs, batchDoc):
+    """
+    Number of annotations in a batch. Only legacy batches need to be read.
+    """
+    if COUNT_FIELD in batchDoc:
+        return batchDoc[COUNT_FIELD]
+    return sum(1 for anno in iterBatchAnnotations(fs, batchDoc))
+
+
+def getBatchFileIds(batchDoc):
+    """
+    :return: Ids of all the GridFS files of a batch.
+    """
+    fileIds = []
+    if LEGACY_FILE_FIELD in batchDoc:
+        fileIds.append(batchDoc[LEGACY_FILE_FIELD])
+    for header in batchDoc.get(CHUNKS_FIELD, []):
+        fileIds.append(header["file_id"])
+    return fileIds
+
+
+def deleteFiles(fs, fileIds):
+    """
+    Deletes GridFS files. Missing files are ignored.
+    """
+    for fileId in fileIds:
+        fs.delete(fileId)
+
+
+def deleteFilesBulk(db, fileIds, sliceSize=FILE_DELETE_SLICE_SIZE, bucket="fs"):
+    """
+    Deletes GridFS files by slices of sliceSize ids, with one delete of the
+    files and one of their chunks per slice instead of two per file. As
+    GridFS does, file documents are deleted before their chunks. Missing
+    files are ignored.
+
+    :param db: pymongo Database containing the GridFS bucket.
+    """
+    for i in range(0, len(fileIds), sliceSize):
+        ids = fileIds[i:i + sliceSize]
+        db[bucket + ".files"].delete_many({"_id": {"$in": ids}})
+        db[bucket + ".chunks"].delete_many({"files_id": {"$in": ids}})
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Insertion of many documents in one collection.
+
+A single ordered insert of a whole batch stops at the first failing document
+and is limited by the maximum size of a MongoDB message. Instead, documents
+are split in sub-batches sent as unordered insert_many, so that a failing
+document does not prevent the others from being inserted, and each failure is
+reported with the position of the document in the batch.
+
+Tuning parameters (section ServiceStockageAnnotations):
+    :HumanInsertBatchSize: Number of documents per insert_many. Default 1000.
+    :HumanInsertWorkers: Number of sub-batches sent in parallel. Default 1.
+    :HumanInsertAtomic: true/false. When true, documents already inserted are
+                        deleted if any document fails. Default false.
+
+MongoDB 3.4 has no multi-document transactions, thus the atomic mode is a
+best effort: other clients may see the documents before they are deleted.
+
+insertStream inserts documents read from an iterable (ex: an upload being
+received) with at most HumanInsertWorkers sub-batches in memory.
+"""
+
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo.errors
+from bson.objectid import ObjectId
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_WORKERS = 1
+
+# Maximum number of ids in a single $in when rolling back.
+_DELETE_SLICE_SIZE = 10000
+
+
+class InsertResult(object):
+    """
+    Outcome of insertMany.
+
+    :nInserted: Number of documents inserted (and not rolled back).
+    :nDocuments: Number of documents sent.
+    :errors: List of {index, code, message} where index is the position of
+             the failed document in the batch, ordered by index.
+    :rolledBack: True if inserted documents were deleted because of errors.
+    """
+
+    def __init__(self):
+        self.nInserted = 0
+        self.nDocuments = 0
+        self.errors = []
+        self.rolledBack = False
+
+
+def insertMany(coll, documents, batchSize=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, atomic=False):
+    """
+    Inserts documents by sub-batches of unordered insert_many.
+
+    An _id is set on each document without one before sending it, thus the
+    caller knows the id of every document.
+
+    :param coll: pymongo Collection.
+    :param documents: List of documents.
+    :param batchSize: Number of documents per insert_many.
+    :param workers: Number of sub-batches sent in parallel.
+    :param atomic: If True, remaining sub-batches are not sent after an error
+                   and inserted documents are deleted.
+    :raise: Errors other than write errors (connection lost, ...) are raised
+            as is, after rolling back in atomic mode.
+    :return: InsertResult.
+    """
+    batchSize = max(1, int(batchSize))
+    workers = max(1, int(workers))
+    for doc in documents:
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+
+    result = InsertResult()
+    result.nDocuments = len(documents)
+    starts = range(0, len(documents), batchSize)
+    sent = []
+    try:
+        if workers == 1 or len(starts) <= 1:
+            for start in starts:
+                sent.append(start)
+                _collect(result, start, _insertSubBatch(coll, documents[start:start + batchSize]))
+                if atomic and result.errors:
+                    break
+        else:
+            # Cancelled sub-batches are rolled back too, which is harmless.
+            sent.extend(starts)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [(start, executor.submit(_insertSubBatch, coll, documents[start:start + batchSize]))
+                           for start in starts]
+                for start, future in futures:
+                    if atomic and result.errors and future.cancel():
+                        continue
+                    _collect(result, start, future.result())
+    except Exception:
+        if atomic:
+            _rollback(coll, documents, sent, batchSize)
+        raise
+
+    result.errors.sort(key=lambda error: error["index"])
+    if atomic and result.errors:
+        # A failed document may have the _id of an existing one.
+        _rollback(coll, documents, sent, batchSize, {error["index"] for error in result.errors})
+        result.nInserted = 0
+        result.rolledBack = True
+    return result
+
+
+def insertStream(coll, documents, batchSize=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, atomic=False):
+    """
+    Same as insertMany, but documents are consumed from an iterable by
+    sub-batches: at most workers sub-batches are held in memory.
+
+    In atomic mode, the ids of the inserted documents are kept to roll them
+    back, and documents after the first error are not read.
+
+    :param documents: Iterable of documents. Errors raised while iterating
+                      are raised as is, after rolling back in atomic mode.
+    :return: InsertResult.
+    """
+    batchSize = max(1, int(batchSize))
+    workers = max(1, int(workers))
+    documents = iter(documents)
+
+    result = InsertResult()
+    pending = collections.deque()
+    sentIds = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while not (atomic and result.errors):
+                subBatch = list(itertools.islice(documents, batchSize))
+                if not subBatch:
+                    break
+                for doc in subBatch:
+                    if '_id' not in doc:
+                        doc['_id'] = ObjectId()
+                if atomic:
+                    sentIds.append((result.nDocuments, [doc['_id'] for doc in subBatch]))
+                pending.append((result.nDocuments, executor.submit(_insertSubBatch, coll, subBatch)))
+                result.nDocuments += len(subBatch)
+                while len(pending) >= workers:
+                    start, future = pending.popleft()
+                    _collect(result, start, future.result())
+            while pending:
+                start, future = pending.popleft()
+                _collect(result, start, future.result())
+    except Exception:
+        if atomic:
+            _rollbackIds(coll, [docId for start, ids in sentIds for docId in ids])
+        raise
+
+    result.errors.sort(key=lambda error: error["index"])
+    if atomic and result.errors:
+        failed = {error["index"] for error in result.errors}
+        _rollbackIds(coll, [docId for start, ids in sentIds
+                            for index, docId in enumerate(ids, start) if index not in failed])
+        result.nInserted = 0
+        result.rolledBack = True
+    return result
+
+
+def _insertSubBatch(coll, subBatch):
+    """
+    :return: (number of inserted documents, write errors)
+    """
+    try:
+        return len(coll.insert_many(subBatch, ordered=False).inserted_ids), []
+    except pymongo.errors.BulkWriteError as e:
+        return e.details.get("nInserted", 0), e.details.get("writeErrors", [])
+
+
+def _collect(result, start, outcome):
+    nInserted, writeErrors = outcome
+    result.nInserted += nInserted
+    for error in writeErrors:
+        result.errors.append({"index": start + error["index"],
+                              "code": error.get("code"),
+                              "message": error.get("errmsg")})
+
+
+def _rollback(coll, documents, starts, batchSize, failed=()):
+    _rollbackIds(coll, [documents[index]['_id'] for start in starts
+                        for index in range(start, min(start + batchSize, len(documents))) if index not in failed])
+
+
+def _rollbackIds(coll, ids):
+    for i in range(0, len(ids), _DELETE_SLICE_SIZE):
+        coll.delete_many({'_id': {'$in': ids[i:i + _DELETE_SLICE_SIZE]}})
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Columnar binary encoding of a list of annotations.
+
+Machine annotations of a batch are nearly homogeneous: the same fields with
+numeric offsets and a few distinct labels. Instead of a JSON list of objects,
+each field is stored as a column:
+
+    :int: 64 bits signed integers.
+    :float: 64 bits floats.
+    :bool: One byte per value.
+    :str: Dictionary encoded strings. The distinct values are stored once and
+          each value is an index in the dictionary.
+    :json: Any other column (mixed types, nested objects, null) is stored as
+           the JSON list of its values.
+
+A column only contains the values of the annotations having the field. If
+some annotations do not have it, a presence mask (one byte per annotation)
+precedes the values.
+
+Layout:
+::
+
+    MAGIC | header length (uint32 little endian) | header | column data
+
+The header is a JSON object:
+::
+
+    {
+        count: Number of annotations,
+        columns: [{name, type, offset, length, masked, dictionary}]
+    }
+
+offset and length locate the data of the column after the header, thus
+decoding only some fields does not touch the other columns.
+"""
+
+import struct
+import sys
+from array import array
+
+import jass.json_codec as json_codec
+
+MAGIC = b"JCOL1"
+
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+
+class ColumnarError(ValueError):
+    """
+    The data is not a valid columnar encoding.
+    """
+    pass
+
+
+def _columnType(values):
+    if all(type(v) is int and _INT_MIN <= v <= _INT_MAX for v in values):
+        return "int"
+    if all(type(v) is float for v in values):
+        return "float"
+    if all(type(v) is bool for v in values):
+        return "bool"
+    if all(type(v) is str for v in values):
+        return "str"
+    return "json"
+
+
+def _toLittleEndian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _fromLittleEndian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def encode(annotations):
+    """
+    :param annotations: List of annotations (JSON objects).
+    :return: Encoded annotations as bytes.
+    """
+    count = len(annotations)
+    values = {}
+    rows = {}
+    for index, anno in enumerate(annotations):
+        for name, value in anno.items():
+            if name not in values:
+                values[name] = []
+                rows[name] = []
+            values[name].append(value)
+            rows[name].append(index)
+
+    columns = []
+    blobs = []
+    offset = 0
+    for name, columnValues in values.items():
+        column = {"name": name, "type": _columnType(columnValues),
+                  "masked": len(columnValues) != count}
+        blob = b""
+        if column["masked"]:
+            mask = bytearray(count)
+            for index in rows[name]:
+                mask[index] = 1
+            blob += bytes(mask)
+
+        if column["type"] == "int":
+            blob += _toLittleEndian(array("q", columnValues))
+        elif column["type"] == "float":
+            blob += _toLittleEndian(array("d", columnValues))
+        elif column["type"] == "bool":
+            blob += bytes(columnValues)
+        elif column["type"] == "str":
+            dictionary = {}
+            indexes = array("I", [dictionary.setdefault(v, len(dictionary)) for v in columnValues])
+            column["dictionary"] = list(dictionary)
+            blob += _toLittleEndian(indexes)
+        else:
+            blob += json_codec.dumpb(columnValues)
+
+        column["offset"] = offset
+        column["length"] = len(blob)
+        offset += len(blob)
+        columns.append(column)
+        blobs.append(blob)
+
+    header = json_codec.dumpb({"count": count, "columns": columns})
+    return b"".join([MAGIC, struct.pack("<I", len(header)), header] + blobs)
+
+
+def decode(data, fields=None):
+    """
+    :param data: Bytes returned by encode.
+    :param fields: If not None, only these fields are decoded.
+    :return: List of annotations.
+    """
+    if not data.startswith(MAGIC):
+        raise ColumnarError("Not a columnar encoded batch")
+    start = len(MAGIC)
+    headerLength, = struct.unpack_from("<I", data, start)
+    start += 4
+    header = json_codec.loads(data[start:start + headerLength])
+    start += headerLength
+
+    count = header["count"]
+    annotations = [{} for i in range(count)]
+    for column in header["columns"]:
+        name = column["name"]
+        if fields is not None and name not in fields:
+            continue
+        blob = memoryview(data)[start + column["offset"]:start + column["offset"] + column["length"]]
+
+        if column["masked"]:
+            rows = [anno for anno, present in zip(annotations, blob[:count]) if present]
+            blob = blob[count:]
+        else:
+            rows = annotations
+
+        if column["type"] == "int":
+            columnValues = _fromLittleEndian("q", blob).tolist()
+        elif column["type"] == "float":
+            columnValues = _fromLittleEndian("d", blob).tolist()
+        elif column["type"] == "bool":
+            columnValues = [bool(v) for v in blob]
+        elif column["type"] == "str":
+            dictionary = column["dictionary"]
+            columnValues = [dictionary[i] for i in _fromLittleEndian("I", blob)]
+        elif column["type"] == "json":
+            columnValues = json_codec.loads(blob)
+        else:
+            raise ColumnarError("Unknown column type {0}".format(column["type"]))
+
+        if len(columnValues) != len(rows):
+            raise ColumnarError("Invalid length for column {0}".format(name))
+        for anno, value in zip(rows, columnValues):
+            anno[name] = value
+
+    return annotations
@@ -3,21 +3,66 @@
 
 """
 Custom logging module.
+
+Messages are only formatted once the logger is known to emit them: nothing is
+done for a disabled level, and messages given as a format string and its
+arguments (or as a callable) are formatted last.
+
+Records are structured: besides the message "code context msg", they carry
+the code and context attributes, usable by formatters (%(code)s,
+%(context)s) and handlers.
+
+Settings (section ServiceStockageAnnotations), read when the first record is
+emitted:
+    :LogMaxMessageLength: Messages are truncated to this number of
+                          characters. 0 means no limit. Default 10000.
+    :LogDebugSampleRate: Fraction (0 to 1) of the debug records emitted.
+                         Default 1.
 """
 
 import logging
+import random
 import traceback
 
+SECTION = "ServiceStockageAnnotations"
+
+_logger = logging.getLogger(__name__)
+
+# Settings, see _getOptions.
+_options = None
+
+
+def isDebugEnabled():
+    """
+    :return: True if debug records are emitted. Callers doing work only to log
+             it (ex: reading a request) should check it first.
+    """
+    return _logger.isEnabledFor(logging.DEBUG)
+
+
+def getMaxMessageLength():
+    """
+    :return: LogMaxMessageLength, 0 if messages are not truncated.
+    """
+    return _getOptions()[0]
+
+
+def resetOptions():
+    """
+    Reads the settings again on the next emitted record. Called when a
+    configuration is loaded (see Settings.LoadConfig).
+    """
+    global _options
+    _options = None
+
+
 def logError(genException):
     """
     This function will take an object of the type GenericException and log it
     as an error.
     """
-    str_error = "{0} {1} {2}".format(genException.code,
-                                     genException.context,
-                                     genException)
-    logger = logging.getLogger(__name__)                                     
-    logger.error(str_error)
+    if _logger.isEnabledFor(logging.ERROR):
+        _log(logging.ERROR, genException.code, genException.context, genException)
 
 
 def logInfo(genException):
@@ -25,10 +70,8 @@ def logInfo(genException):
     This function will take an object of the type GenericException and log it
     as information useful for non critical errors.
     """
-    str_error = "{0} {1} {2}".format(genException.code, genException.context,
-                                     genException)
-    logger = logging.getLogger(__name__)                                     
-    logger.info(str_error)
+    if _logger.isEnabledFor(logging.INFO):
+        _log(logging.INFO, genException.code, genException.context, genException)
 
 
 def logUnknownError(context, msg, e):
@@ -39,49 +82,78 @@ def logUnknownError(context, msg, e):
     :param context: The context to categorize the message
     :param e: Exception object
     """
-
-    # TODO : Look into this standard library function:
-    # https://docs.python.org/2.6/library/logging.html#logging.Logger.exception
-    # which does essentially the same thing.
+    if not _logger.isEnabledFor(logging.ERROR):
+        return
     if msg:
-        msg += "\n"
+        msg = "{0}\n".format(msg)
     msg = '{0}{1}\n{2}'.format(msg, e, traceback.format_exc())
-    str_error = "{0} {1} {2}".format(-1, context, msg)
-    # str = ("%i %s %s" %  (-1, context, e))
-    logger = logging.getLogger(__name__)                                     
-    logger.error(str_error)
+    _log(logging.ERROR, -1, context, msg)
 
 
-def logUnknownWarning(context, msg):
+def logUnknownWarning(context, msg, *args):
     """
     A simple function to display a warning into logs
 
-    :param msg: Custom error message to put
+    :param msg: Custom error message to put, see logUnknownDebug
     :param context: The context to categorize the message
     """
-    str_error = "{0} {1} {2}".format(-2, context, msg)
-    logger = logging.getLogger(__name__)                                     
-    logger.warning(str_error)
+    if _logger.isEnabledFor(logging.WARNING):
+        _log(logging.WARNING, -2, context, msg, args)
 
 
-def logUnknownInfo(context, msg):
+def logUnknownInfo(context, msg, *args):
     """
     A simple function to display a info into logs
 
-    :param msg: Custom error message to put
+    :param msg: Custom error message to put, see logUnknownDebug
     :param context: The context to categorize the message
     """
-    str_error = "{0} {1} {2}".format(-3, context, msg)
-    logger = logging.getLogger(__name__)                                     
-    logger.info(str_error)
-    
-def logUnknownDebug(context, msg):
+    if _logger.isEnabledFor(logging.INFO):
+        _log(logging.INFO, -3, context, msg, args)
+
+
+def logUnknownDebug(context, msg, *args):
     """
     A simple function to display a debug into logs
 
-    :param msg: Custom error message to put
+    :param msg: Custom error message to put. If args are given, it is a
+                format string (str.format) of them. It can also be a function
+                returning the message. Either way, it is only formatted if
+                the record is emitted.
     :param context: The context to categorize the message
     """
-    str_error = "{0} {1} {2}".format(-3, context, msg)
-    logger = logging.getLogger(__name__)
-    logger.debug(str_error)
+    if not _logger.isEnabledFor(logging.DEBUG):
+        return
+    sampleRate = _getOptions()[1]
+    if sampleRate < 1 and random.random() >= sampleRate:
+        return
+    _log(logging.DEBUG, -3, context, msg, args)
+
+
+def _log(level, code, context, msg, args=()):
+    if callable(msg):
+        msg = msg()
+    elif args:
+        msg = msg.format(*args)
+    message = "{0} {1} {2}".format(code, context, msg)
+    maxLength = _getOptions()[0]
+    if maxLength and len(message) > maxLength:
+        message = "{0}... ({1} characters)".format(message[:maxLength], len(message))
+    _logger.log(level, message, extra={"code": code, "context": context})
+
+
+def _getOptions():
+    """
+    :return: (LogMaxMessageLength, LogDebugSampleRate)
+    """
+    global _options
+    if _options is not None:
+        return _options
+    # Imported here since settings logs with this module.
+    import jass.settings as settings
+    options = (int(settings.GetConfigValueOrDefault(SECTION, "LogMaxMessageLength", 10000)),
+               float(settings.GetConfigValueOrDefault(SECTION, "LogDebugSampleRate", 1)))
+    # Defaults are used until a configuration is loaded (see Settings.LoadConfig).
+    if settings.Settings.Instance().IsLoaded():
+        _options = options
+    return options
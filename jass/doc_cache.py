@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+In-process cache of documents and annotation schemas.
+
+Documents and schemas are read far more often than they are written. Reads
+through StorageManager.getMongoDocument of the DocumentCollection and
+SchemaCollection collections are served from a least recently used cache,
+whose entries expire after DocumentCacheTTLSeconds.
+
+Entries are stored BSON encoded: their size is known exactly, and each read
+returns a new copy which the caller may modify.
+
+Writes through a storage manager (update, delete) invalidate the entries of
+the current process. Other processes keep their entries until they expire,
+thus DocumentCacheTTLSeconds bounds how long they may return a previous
+version.
+
+Settings (section ServiceStockageAnnotations):
+    :DocumentCacheMaxBytes: Maximum size of the cached documents. 0 disables
+                            the cache. Default 16777216 (16 MB).
+    :DocumentCacheTTLSeconds: Default 60.
+"""
+
+import collections
+import threading
+import time
+
+import bson
+
+import jass.settings as settings
+
+SECTION = "ServiceStockageAnnotations"
+
+# Settings containing the names of the cached collections.
+CACHED_COLLECTIONS = ["DocumentCollection", "SchemaCollection"]
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with a size limit in bytes and a time to live.
+    Thread safe.
+    """
+
+    def __init__(self, maxBytes, ttlSeconds):
+        self.maxBytes = maxBytes
+        self.ttlSeconds = ttlSeconds
+        self.lock = threading.Lock()
+        # key -> (expiration time, value, size)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: The value, or None if it is not cached or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, size):
+        """
+        Caches a value, evicting the least recently used ones if needed.
+        Values larger than the cache are not cached.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+            if size > self.maxBytes:
+                return
+            self.entries[key] = (time.monotonic() + self.ttlSeconds, value, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes a key, or every key if key is None.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            elif key in self.entries:
+                self.__remove(key)
+
+    def invalidateIf(self, predicate):
+        """
+        Removes the keys for which predicate(key) is true.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.__remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.size, "maxBytes": self.maxBytes}
+
+    # ~ Private
+    def __remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def getCache():
+    """
+    :return: The cache of the process, or None if it is disabled.
+    """
+    global _cache
+    with _lock:
+        if _cache is None:
+            maxBytes = int(settings.GetConfigValueOrDefault(SECTION, "DocumentCacheMaxBytes", 16 * 1024 * 1024))
+            ttlSeconds = float(settings.GetConfigValueOrDefault(SECTION, "DocumentCacheTTLSeconds", 60))
+            _cache = LRUCache(maxBytes, ttlSeconds)
+        return _cache if _cache.maxBytes > 0 else None
+
+
+def resetCache():
+    """
+    Drops the cache. The next getCache call creates a new one from the
+    settings. Used by tests.
+    """
+    global _cache
+    with _lock:
+        _cache = None
+
+
+def isCached(collection):
+    """
+    :return: True if the documents of the collection are cached.
+    """
+    return any(settings.GetConfigValueOrDefault(SECTION, setting, None) == collection
+               for setting in CACHED_COLLECTIONS)
+
+
+def getDocument(db, collection, strDocId):
+    """
+    :return: A copy of the cached document, or None.
+    """
+    cache = getCache()
+    if cache is None:
+        return None
+    data = cache.get((db, collection, strDocId))
+    return bson.BSON(data).decode() if data is not None else None
+
+
+def putDocument(db, collection, strDocId, doc):
+    cache = getCache()
+    if cache is not None:
+        data = bson.BSON.encode(doc)
+        cache.put((db, collection, strDocId), data, len(data))
+
+
+def invalidateDocument(db, collection, strDocId=None):
+    """
+    Invalidates a document, or all the documents of the collection if
+    strDocId is None.
+    """
+    cache = getCache()
+    if cache is None:
+        return
+    if strDocId is not None:
+        cache.invalidate((db, collection, strDocId))
+    else:
+        cache.invalidateIf(lambda key: key[0] == db and key[1] == collection)
+
+
+def stats():
+    """
+    :return: Counters of the cache (hits, misses, evictions, entries, bytes,
+             maxBytes), empty if it is disabled.
+    """
+    cache = getCache()
+    return cache.stats() if cache is not None else {}
@@ -1,16 +1,99 @@
 #!/usr/bin/env python
 # coding:utf-8
 
+import jass.batch_storage as batch_storage
+from jass.annotations_manager import touchAnnotations
+import jass.jobs as jobs
+import jass.mongo_utils as mongo_utils
+import jass.custom_logger as logger
 from jass.storage_exception import *
 from bson.errors import *
 from jass.storage_manager import StorageManager
 # Mongo some interesting performance statistics
 # http://blog.mongolab.com/2014/01/how-big-is-your-mongodb/
 
+# Background job deleting the annotations of a deleted document.
+DELETE_CONTENTS_JOB = "deleteDocumentContents"
+
+# Number of annotations (or batches) deleted at once by the job. Each slice
+# reports progress.
+CONTENTS_SLICE_SIZE = 10000
+BATCHES_SLICE_SIZE = 1000
+
+
+def deleteContentsJob(job):
+    """
+    Runs a DELETE_CONTENTS_JOB: deletes by slices the human annotations, the
+    batches and the GridFS files of the batches of a document. Progress counts
+    what was deleted: {humanAnnotations, batches, files}.
+
+    Only annotations of the document are searched, thus the job can be
+    resumed at any point.
+    """
+    strDocId = job.params["doc_id"]
+    for key in ["humanAnnotations", "batches", "files"]:
+        job.progress.setdefault(key, 0)
+
+    human = job.db[job.params["humanCollection"]]
+    while True:
+        ids = [anno["_id"] for anno in human.find({"doc_id": strDocId}, {"_id": 1}).limit(CONTENTS_SLICE_SIZE)]
+        if not ids:
+            break
+        res = human.delete_many({"_id": {"$in": ids}})
+        touchAnnotations(job.db, [strDocId])
+        job.report(humanAnnotations=job.progress["humanAnnotations"] + res.deleted_count)
+
+    batches = job.db[job.params["batchCollection"]]
+    projection = {batch_storage.LEGACY_FILE_FIELD: 1, batch_storage.CHUNKS_FIELD + ".file_id": 1}
+    while True:
+        batchDocs = list(batches.find({"doc_id": strDocId}, projection).limit(BATCHES_SLICE_SIZE))
+        if not batchDocs:
+            break
+        fileIds = []
+        for batch in batchDocs:
+            fileIds += batch_storage.getBatchFileIds(batch)
+        # Files first, so that an interrupted job still finds the batches
+        # referring to them.
+        batch_storage.deleteFilesBulk(job.db, fileIds)
+        res = batches.delete_many({"_id": {"$in": [batch["_id"] for batch in batchDocs]}})
+        touchAnnotations(job.db, [strDocId])
+        job.report(batches=job.progress["batches"] + res.deleted_count,
+                   files=job.progress["files"] + len(fileIds))
+
+
+jobs.register(DELETE_CONTENTS_JOB, deleteContentsJob)
+
 
 class DocumentManager(StorageManager):
-    def deleteDocumentWithContents(self, documentId):
+    def deleteDocumentWithContents(self, strDocId, humanCollection, batchCollection):
         """
         Delete document and all related annotations
+
+        The document is deleted right away, its annotations (human storage,
+        batches and their GridFS files) by a background job (see jass.jobs),
+        which also cleans up annotations left by a previous deletion. No job
+        is submitted if the document did not exist and has no annotation
+        left, so that deleting a missing document creates nothing.
+
+        :param strDocId: Document ID as string.
+        :param humanCollection: Collection of the human storage annotations.
+        :param batchCollection: Collection of the batches.
+        :return: {"nDeleted": 0 or 1, "jobId": id of the job deleting the
+                 annotations}, jobId is None if there was nothing to delete.
         """
-        pass
+        if not mongo_utils.isObjectId(strDocId):
+            return {"nDeleted": 0, "jobId": None}
+
+        nbDeleted = self.deleteMongoDocument(strDocId)
+        try:
+            db = self.client[self.mongoDb]
+            if not nbDeleted and not any(db[collection].find_one({"doc_id": str(strDocId)}, {"_id": 1})
+                                         for collection in [humanCollection, batchCollection]):
+                return {"nDeleted": 0, "jobId": None}
+            jobId = jobs.submit(db, DELETE_CONTENTS_JOB,
+                                params={"doc_id": str(strDocId), "humanCollection": humanCollection,
+                                        "batchCollection": batchCollection})
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Delete Document Contents", "", e)
+            raise MongoDocumentException(0)
+        return {"nDeleted": nbDeleted, "jobId": jobId}
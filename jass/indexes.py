@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Declarative management of the indexes of the JASS collections.
+
+Indexes are described in the Indexes section of the configuration. Each key
+identifies an index and its value is a JSON object:
+::
+
+    {
+        name: Name of the index. Defaults to the key (lower case).
+        collection: Setting (section ServiceStockageAnnotations) containing
+                    the name of the collection, ex: HumanAnnotationCollection,
+        keys: [[field, direction]] where direction is 1, -1 or "text",
+        Optional index options: unique, sparse, partialFilterExpression,
+                                expireAfterSeconds (TTL), weights (text),
+                                default_language, language_override
+    }
+
+Example:
+::
+
+    [Indexes]
+    human_doc_id = {"collection": "HumanAnnotationCollection", "keys": [["doc_id", 1], ["_id", 1]]}
+    schema_doc_id = {"name": "doc_id_1", "collection": "SchemaCollection", "keys": [["doc_id", 1]]}
+    human_text = {"collection": "HumanAnnotationCollection", "keys": [["$**", "text"]],
+                  "weights": {"text": 10}}
+
+applyIndexes creates the missing indexes and leaves the others untouched, thus
+it can be run on every start. It never drops an index: indexes which differ
+from their specification, or which are not specified, are only reported.
+
+Index builds run in background (IndexBackgroundBuild setting), so that the
+collections stay available while large indexes are built.
+"""
+
+
+import jass.json_codec as json_codec
+import jass.settings as settings
+import jass.custom_logger as logger
+from jass.storage_exception import IndexException
+
+SECTION = "Indexes"
+COLLECTIONS_SECTION = "ServiceStockageAnnotations"
+
+OPTIONS = ["unique", "sparse", "partialFilterExpression", "expireAfterSeconds", "weights",
+           "default_language", "language_override"]
+
+TEXT = "text"
+
+
+def parseIndexSpecs(section, collections):
+    """
+    :param section: Dict of index name to its JSON specification.
+    :param collections: Dict of collection setting to collection name.
+    :raise IndexException: If a specification is invalid.
+    :return: List of specifications {name, collection, keys, options} sorted
+             by name, where keys is a list of (field, direction) tuples.
+    """
+    specs = []
+    for name in sorted(section):
+        try:
+            spec = json_codec.loads(section[name])
+        except ValueError as e:
+            raise IndexException(1, name, e)
+        if not isinstance(spec, dict):
+            raise IndexException(1, name, "not a JSON object")
+        if not isinstance(spec.get("name", name), str):
+            raise IndexException(1, name, "name must be a string")
+        if spec.get("collection") not in collections:
+            raise IndexException(2, name, spec.get("collection"))
+
+        keys = spec.get("keys")
+        if (not isinstance(keys, list) or not keys or
+                any(not isinstance(key, list) or len(key) != 2 or not isinstance(key[0], str) or
+                    key[1] not in (1, -1, TEXT) for key in keys)):
+            raise IndexException(1, name, "keys must be a non empty list of [field, 1, -1 or \"text\"]")
+
+        unknown = set(spec) - set(OPTIONS) - {"name", "collection", "keys"}
+        if unknown:
+            raise IndexException(1, name, "unknown options {0}".format(", ".join(sorted(unknown))))
+
+        specs.append({"name": spec.get("name", name),
+                      "collection": collections[spec["collection"]],
+                      "keys": [tuple(key) for key in keys],
+                      "options": {option: spec[option] for option in OPTIONS if option in spec}})
+    return specs
+
+
+def loadIndexSpecs():
+    """
+    :return: The index specifications of the loaded configuration.
+    """
+    collections = {}
+    for setting in ["DocumentCollection", "SchemaCollection", "HumanAnnotationCollection",
+                    "BatchAnnotationCollection"]:
+        collections[setting] = settings.GetConfigValue(COLLECTIONS_SECTION, setting)
+    for setting, default in [("JobCollection", "jobs"), ("JobItemCollection", "jobs_items")]:
+        collections[setting] = settings.GetConfigValueOrDefault(COLLECTIONS_SECTION, setting, default)
+    return parseIndexSpecs(settings.GetConfigSection(SECTION), collections)
+
+
+def isBackgroundBuild():
+    value = settings.GetConfigValueOrDefault(COLLECTIONS_SECTION, "IndexBackgroundBuild", "true")
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _expectedIndex(spec):
+    """
+    :return: (key, weights) of the index as reported by MongoDB. Text fields
+             are replaced by _fts and _ftsx, and weights is None if it is not
+             a text index.
+    """
+    key = []
+    weights = None
+    for field, direction in spec["keys"]:
+        if direction == TEXT:
+            if weights is None:
+                weights = {}
+                key += [("_fts", TEXT), ("_ftsx", 1)]
+            weights[field] = 1
+        else:
+            key.append((field, direction))
+    if weights is not None:
+        weights.update(spec["options"].get("weights", {}))
+    return key, weights
+
+
+def _differences(spec, info):
+    """
+    :param info: Description of an existing index (index_information).
+    :return: List of the differences between an index and its specification.
+    """
+    key, weights = _expectedIndex(spec)
+    differences = []
+    if [(field, direction) for field, direction in info["key"]] != key:
+        differences.append("keys")
+    if weights is not None and info.get("weights") != weights:
+        differences.append("weights")
+    for option in OPTIONS:
+        if option == "weights":
+            continue
+        if option in spec["options"]:
+            if info.get(option) != spec["options"][option]:
+                differences.append(option)
+        elif option in ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds") and info.get(option):
+            differences.append(option)
+    return differences
+
+
+def driftReport(db, specs):
+    """
+    Compares the indexes of the collections referred by specs to their
+    specification.
+
+    :param db: pymongo Database.
+    :return: Dict with the lists:
+             :missing: Specified indexes which do not exist
+                       ({collection, name}).
+             :different: Indexes which exist with another definition
+                         ({collection, name, differences}). An index with the
+                         specified keys but another name is reported with the
+                         difference "name".
+             :extra: Indexes which are not specified ({collection, name}).
+                     The _id index is never reported.
+    """
+    report = {"missing": [], "different": [], "extra": []}
+    collections = []
+    for spec in specs:
+        if spec["collection"] not in collections:
+            collections.append(spec["collection"])
+
+    for collection in collections:
+        existing = db[collection].index_information()
+        matched = {"_id_"}
+        for spec in [spec for spec in specs if spec["collection"] == collection]:
+            if spec["name"] in existing:
+                matched.add(spec["name"])
+                differences = _differences(spec, existing[spec["name"]])
+                if differences:
+                    report["different"].append({"collection": collection, "name": spec["name"],
+                                                "differences": differences})
+                continue
+            # MongoDB refuses to create an index with the keys of an existing
+            # one, whatever its name.
+            key = _expectedIndex(spec)[0]
+            sameKeys = [name for name, info in existing.items()
+                        if name not in matched and [tuple(k) for k in info["key"]] == key]
+            if sameKeys:
+                matched.add(sameKeys[0])
+                report["different"].append({"collection": collection, "name": sameKeys[0],
+                                            "differences": ["name"] + _differences(spec, existing[sameKeys[0]])})
+            else:
+                report["missing"].append({"collection": collection, "name": spec["name"]})
+
+        for name in sorted(existing):
+            if name not in matched:
+                report["extra"].append({"collection": collection, "name": name})
+    return report
+
+
+def applyIndexes(db, specs, background=None):
+    """
+    Creates the missing indexes. Idempotent.
+
+    :param db: pymongo Database.
+    :param background: Build indexes in background. Defaults to the
+                       IndexBackgroundBuild setting.
+    :return: The drift report (see driftReport) before creating indexes, with
+             the list created of the created indexes ({collection, name}).
+    """
+    if background is None:
+        background = isBackgroundBuild()
+    report = driftReport(db, specs)
+    report["created"] = []
+    for missing in report["missing"]:
+        spec = [spec for spec in specs
+                if spec["collection"] == missing["collection"] and spec["name"] == missing["name"]][0]
+        db[spec["collection"]].create_index(spec["keys"], name=spec["name"], background=background,
+                                            **spec["options"])
+        report["created"].append(missing)
+
+    for kind in ["different", "extra"]:
+        for index in report[kind]:
+            logger.logUnknownWarning("Index drift", "{0} index {1}.{2} {3}",
+                                     kind, index["collection"], index["name"], ", ".join(index.get("differences", [])))
+    return report
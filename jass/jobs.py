@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Background jobs.
+
+A job is a long operation (ex: deleting the GridFS files of thousands of
+batches) run by a thread of the process once the HTTP request has returned.
+Jobs are kept in the JobCollection collection, so that clients can follow
+their progress and jobs interrupted by a restart are resumed:
+::
+
+    {
+        _id: Id of the job,
+        type: Name of the handler running the job (see register),
+        params: Arguments of the handler,
+        state: pending, running, done or failed,
+        progress: Set by the handler, ex: {done: n, total: n},
+        error: Message if the job failed,
+        created, updated: Dates (UTC),
+        heartbeat: Last time the process running the job reported progress,
+        expires: Date after which a finished job is removed
+    }
+
+Long lists of ids are stored apart, in the JobItemCollection collection, by
+slices of ITEM_SLICE_SIZE ids ({job_id, ids}) which are removed once
+processed.
+
+Once a job is done or failed, it and its remaining slices get an expires
+date, JobRetentionSeconds later. The TTL indexes of the Indexes section
+(jobs_expires, job_items_expires) remove them after this date.
+
+A job is claimed atomically before it runs. A running job whose heartbeat is
+older than JobLeaseSeconds is considered abandoned and may be claimed again,
+thus handlers must be idempotent.
+
+Settings (section ServiceStockageAnnotations):
+    :JobCollection: Default jobs.
+    :JobItemCollection: Default jobs_items.
+    :JobWorkers: Number of threads running jobs in each process. Default 1.
+    :JobLeaseSeconds: Default 300.
+    :JobRetentionSeconds: Delay during which finished jobs can be read.
+                          Default 604800 (7 days).
+"""
+
+import concurrent.futures
+import datetime
+import os
+import threading
+
+import pymongo
+from bson.objectid import ObjectId
+
+import jass.mongo_pool as mongo_pool
+import jass.mongo_utils as mongo_utils
+import jass.settings as settings
+import jass.custom_logger as logger
+
+SECTION = "ServiceStockageAnnotations"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+ITEM_SLICE_SIZE = 10000
+
+_lock = threading.Lock()
+_executor = None
+_executorPid = None
+_handlers = {}
+
+
+def register(jobType, handler):
+    """
+    :param handler: Function handler(job) running a job of this type, where
+                    job is a Job. Must be idempotent.
+    """
+    _handlers[jobType] = handler
+
+
+class Job(object):
+    """
+    Job being run, given to its handler.
+    """
+
+    def __init__(self, db, doc):
+        self.db = db
+        self.id = doc["_id"]
+        self.type = doc["type"]
+        self.params = doc.get("params") or {}
+        self.progress = doc.get("progress") or {}
+
+    def iterItems(self):
+        """
+        Yields the slices of ids ({_id, ids}) which were not processed yet.
+        """
+        for item in _itemCollection(self.db).find({"job_id": self.id}, sort=[("_id", 1)]):
+            yield item
+
+    def itemDone(self, item):
+        _itemCollection(self.db).delete_one({"_id": item["_id"]})
+
+    def report(self, **progress):
+        """
+        Updates the progress of the job, and its heartbeat.
+        """
+        self.progress.update(progress)
+        now = datetime.datetime.utcnow()
+        _jobCollection(self.db).update_one({"_id": self.id},
+                                           {"$set": {"progress": self.progress, "updated": now,
+                                                     "heartbeat": now}})
+
+
+def submit(db, jobType, params=None, items=None, progress=None):
+    """
+    Creates a job and schedules it in the current process.
+
+    :param db: pymongo Database.
+    :param items: List of ids processed by the job (see Job.iterItems).
+    :param progress: Initial progress.
+    :return: Id of the job as a string.
+    """
+    jobId = ObjectId()
+    items = items or []
+    # Items are written first: a job is never claimed without them.
+    if items:
+        _itemCollection(db).insert_many([{"job_id": jobId, "ids": items[i:i + ITEM_SLICE_SIZE]}
+                                         for i in range(0, len(items), ITEM_SLICE_SIZE)])
+    now = datetime.datetime.utcnow()
+    _jobCollection(db).insert_one({"_id": jobId, "type": jobType, "params": params or {},
+                                   "state": PENDING, "progress": progress or {},
+                                   "created": now, "updated": now})
+    _schedule(jobId)
+    return str(jobId)
+
+
+def getJob(db, strJobId):
+    """
+    :return: The job ({id, type, state, progress, error, created, updated}),
+             or None if it does not exist.
+    """
+    if not mongo_utils.isObjectId(strJobId):
+        return None
+    doc = _jobCollection(db).find_one({"_id": ObjectId(strJobId)})
+    if doc is None:
+        return None
+    job = {"id": str(doc["_id"]), "type": doc["type"], "state": doc["state"],
+           "progress": doc.get("progress") or {}, "error": doc.get("error")}
+    for field in ["created", "updated"]:
+        job[field] = doc[field].isoformat() + "Z"
+    return job
+
+
+def resumeJobs(db):
+    """
+    Schedules the pending and abandoned jobs in the current process.
+
+    :return: Number of jobs scheduled.
+    """
+    nbJobs = 0
+    for doc in _jobCollection(db).find(_claimableQuery(), {"_id": 1}):
+        _schedule(doc["_id"])
+        nbJobs += 1
+    return nbJobs
+
+
+def _jobCollection(db):
+    return db[settings.GetConfigValueOrDefault(SECTION, "JobCollection", "jobs")]
+
+
+def _itemCollection(db):
+    return db[settings.GetConfigValueOrDefault(SECTION, "JobItemCollection", "jobs_items")]
+
+
+def _claimableQuery():
+    lease = datetime.timedelta(seconds=float(settings.GetConfigValueOrDefault(SECTION, "JobLeaseSeconds", 300)))
+    return {"$or": [{"state": PENDING},
+                    {"state": RUNNING, "heartbeat": {"$lt": datetime.datetime.utcnow() - lease}}]}
+
+
+def _getExpiration(now):
+    retention = float(settings.GetConfigValueOrDefault(SECTION, "JobRetentionSeconds", 604800))
+    return now + datetime.timedelta(seconds=retention)
+
+
+def _schedule(jobId):
+    global _executor, _executorPid
+    with _lock:
+        # Threads are not inherited by forked workers.
+        if _executor is None or _executorPid != os.getpid():
+            workers = int(settings.GetConfigValueOrDefault(SECTION, "JobWorkers", 1))
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1))
+            _executorPid = os.getpid()
+        _executor.submit(_run, jobId)
+
+
+def _run(jobId):
+    pooled = mongo_pool.isPoolingEnabled()
+    client = mongo_pool.getClient() if pooled else mongo_pool.createClient()
+    try:
+        db = client[settings.GetConfigValue(SECTION, "MongoDb")]
+        query = _claimableQuery()
+        query["_id"] = jobId
+        now = datetime.datetime.utcnow()
+        doc = _jobCollection(db).find_one_and_update(query,
+                                                     {"$set": {"state": RUNNING, "updated": now,
+                                                               "heartbeat": now}},
+                                                     return_document=pymongo.ReturnDocument.AFTER)
+        if doc is None:
+            # Claimed by another process, or already run.
+            return
+
+        update = {"state": DONE}
+        try:
+            handler = _handlers.get(doc["type"])
+            if handler is None:
+                raise ValueError("Unknown job type {0}".format(doc["type"]))
+            handler(Job(db, doc))
+        except Exception as e:
+            logger.logUnknownError("Annotation Storage Job", "Job {0} failed".format(jobId), e)
+            update = {"state": FAILED, "error": str(e)}
+        now = datetime.datetime.utcnow()
+        update["updated"] = now
+        update["expires"] = _getExpiration(now)
+        # Slices left by a failed job expire with it.
+        _itemCollection(db).update_many({"job_id": jobId}, {"$set": {"expires": update["expires"]}})
+        _jobCollection(db).update_one({"_id": jobId}, {"$set": update})
+    except Exception as e:
+        logger.logUnknownError("Annotation Storage Job", "Job {0} could not run".format(jobId), e)
+    finally:
+        if not pooled:
+            client.close()
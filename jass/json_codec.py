@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+JSON encoding and decoding.
+
+Request bodies, responses and batch files all go through this module, which
+uses orjson when it is installed and the json module of the standard library
+otherwise. orjson is several times faster on large annotation batches.
+
+Both backends produce compact UTF-8 JSON. Values orjson does not support
+(integers larger than 64 bits, non string keys, NaN and infinite floats) are
+handled by the standard library instead, thus the backend does not change
+what is accepted, nor how NaN and infinite floats are written (NaN, Infinity).
+The standard library escapes non ASCII characters (\\uXXXX), as the responses
+of Flask always did, while orjson writes them as UTF-8: the bytes differ, not
+the decoded values.
+
+Settings (section ServiceStockageAnnotations):
+    :JsonCodec: auto (orjson if installed), orjson or stdlib. Default auto.
+"""
+
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import jass.settings as settings
+
+SECTION = "ServiceStockageAnnotations"
+
+AUTO = "auto"
+ORJSON = "orjson"
+STDLIB = "stdlib"
+CODECS = [AUTO, ORJSON, STDLIB]
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+_decoder = json.JSONDecoder()
+
+# Resolved backend, see getCodec.
+_codec = None
+
+
+def getCodec():
+    """
+    :return: Backend in use: ORJSON or STDLIB.
+    """
+    global _codec
+    if _codec is None:
+        name = str(settings.GetConfigValueOrDefault(SECTION, "JsonCodec", AUTO)).strip().lower()
+        if name not in CODECS:
+            raise ValueError("Unknown JsonCodec {0}, expected one of {1}".format(name, CODECS))
+        _codec = ORJSON if orjson is not None and name != STDLIB else STDLIB
+    return _codec
+
+
+def resetCodec():
+    """
+    Forgets the resolved backend. Called when a configuration is loaded
+    (see Settings.LoadConfig).
+    """
+    global _codec
+    _codec = None
+
+
+def dumpb(obj, default=None, sortKeys=False):
+    """
+    Encodes a value as UTF-8 JSON bytes.
+
+    :param default: Function returning a serializable version of values
+                    which are not (datetimes included), or raising TypeError.
+    :param sortKeys: Sort the keys of objects.
+    """
+    if getCodec() == ORJSON:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sortKeys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=default, option=option)
+            # orjson writes NaN and infinite floats as null.
+            if b"null" not in data or not _hasNonFiniteFloat(obj):
+                return data
+        except TypeError:
+            # Not supported by orjson, ex: integers larger than 64 bits.
+            pass
+    return _stdlibDumps(obj, default, sortKeys).encode("UTF-8")
+
+
+def dumps(obj, default=None, sortKeys=False):
+    """
+    Same as dumpb, but returns a str.
+    """
+    if getCodec() == ORJSON:
+        return dumpb(obj, default, sortKeys).decode("UTF-8")
+    return _stdlibDumps(obj, default, sortKeys)
+
+
+def loads(data):
+    """
+    Decodes JSON.
+
+    :param data: str, or UTF-8 bytes.
+    :raise json.JSONDecodeError: If data is not valid JSON.
+    """
+    if getCodec() == ORJSON:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # May still be accepted by the standard library (NaN, very large
+            # integers), which also gives the usual error otherwise.
+            pass
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode("UTF-8")
+    return _decoder.decode(data)
+
+
+def _stdlibDumps(obj, default, sortKeys):
+    if default is None and not sortKeys:
+        return _encoder.encode(obj)
+    return json.dumps(obj, default=default, sort_keys=sortKeys, separators=(",", ":"))
+
+
+def _hasNonFiniteFloat(obj):
+    """
+    :return: True if a float of obj (lists, tuples and dicts included) is NaN
+             or infinite.
+    """
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_hasNonFiniteFloat(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_hasNonFiniteFloat(value) for value in obj)
+    return False
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Incremental decoding of JSON arrays and of newline delimited JSON.
+
+Batch files can be several hundred MB. Instead of reading a whole file and
+decoding it with json.loads, the array is read chunk by chunk and its elements
+are decoded and yielded one at a time, thus memory usage only depends on the
+chunk size and the size of one element.
+
+Uploads of newline delimited JSON (NDJSON, one object per line) are decoded
+the same way, line by line (see iterNdjson).
+"""
+
+import codecs
+import json
+import re
+
+import jass.json_codec as json_codec
+
+# GridFS default chunk size. Reading by multiples of it avoids partial chunks.
+DEFAULT_READ_SIZE = 255 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonStreamError(ValueError):
+    """
+    The stream does not contain a valid JSON array.
+    """
+    pass
+
+
+def iterJsonArray(fileObj, readSize=DEFAULT_READ_SIZE, decoder=None):
+    """
+    Yields the elements of a JSON array read from a binary file object.
+
+    :param fileObj: Object with a read(size) method returning UTF-8 bytes,
+                    like a GridOut.
+    :param readSize: Number of bytes read at a time.
+    :param decoder: json.JSONDecoder used to decode elements.
+    :raise JsonStreamError: If the content is not a JSON array.
+    """
+    if decoder is None:
+        decoder = json.JSONDecoder()
+    textDecoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill(buf, pos):
+        """
+        Reads one more chunk, dropping what was already consumed.
+        """
+        data = fileObj.read(readSize)
+        if not data:
+            return buf[pos:] + textDecoder.decode(b"", final=True), 0, True
+        return buf[pos:] + textDecoder.decode(data), 0, False
+
+    def skipWhitespace(buf, pos, eof):
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skipWhitespace(buf, pos, eof)
+    if pos >= len(buf) or buf[pos] != "[":
+        raise JsonStreamError("Expected a JSON array")
+    pos += 1
+
+    buf, pos, eof = skipWhitespace(buf, pos, eof)
+    if pos < len(buf) and buf[pos] == "]":
+        return
+
+    while True:
+        # Decode next element, reading more data until it is complete. A
+        # value ending exactly at the end of the buffer may be a truncated
+        # number, so it is only accepted at the end of the stream.
+        while True:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    break
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise JsonStreamError("Invalid JSON array element: {0}".format(e))
+            buf, pos, eof = fill(buf, pos)
+        pos = end
+        yield element
+
+        buf, pos, eof = skipWhitespace(buf, pos, eof)
+        if pos >= len(buf):
+            raise JsonStreamError("Unterminated JSON array")
+        if buf[pos] == "]":
+            return
+        if buf[pos] != ",":
+            raise JsonStreamError("Expected ',' or ']' at position {0}".format(pos))
+        pos += 1
+        buf, pos, eof = skipWhitespace(buf, pos, eof)
+
+
+def iterNdjson(fileObj):
+    """
+    Yields the objects of newline delimited JSON read from a binary file
+    object, one per line. Empty lines are skipped.
+
+    :param fileObj: Iterable of UTF-8 lines, like a file or a request stream.
+    :raise JsonStreamError: If a line is not a JSON object.
+    """
+    for lineNumber, line in enumerate(fileObj, 1):
+        if not line.strip():
+            continue
+        try:
+            element = json_codec.loads(line)
+        except ValueError as e:
+            raise JsonStreamError("Invalid JSON on line {0}: {1}".format(lineNumber, e))
+        if not isinstance(element, dict):
+            raise JsonStreamError("Expected a JSON object on line {0}".format(lineNumber))
+        yield element
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Process-wide MongoDB client pool.
+
+A MongoClient already maintains its own pool of sockets and is meant to be
+shared, thus each process keeps a single client which storage managers borrow
+instead of creating (and tearing down) one per request. The asynchronous app
+(async_rest) borrows a motor client configured the same way.
+
+MongoClient is not fork-safe. Since gunicorn may load the application before
+forking its workers (-preload), the client remembers the pid of the process
+which created it and is recreated in a forked child.
+
+Tuning parameters (section ServiceStockageAnnotations):
+    :MongoConnectionPooling: true/false. When false, each manager creates its
+                             own client (previous behaviour).
+    :MongoMaxPoolSize: Maximum number of sockets per process. Default 100.
+    :MongoMinPoolSize: Number of sockets kept open. Default 0.
+    :MongoMaxIdleTimeMS: Idle sockets are closed after this delay. Default
+                         none (never closed).
+    :MongoHealthCheckInterval: Seconds between two health checks (ismaster)
+                               of the shared client. 0 checks on every borrow.
+                               Default 30.
+"""
+
+import os
+import threading
+import time
+
+import pymongo.errors
+from pymongo import MongoClient
+
+import jass.settings as settings
+import jass.custom_logger as logger
+
+SECTION = "ServiceStockageAnnotations"
+
+_lock = threading.Lock()
+_client = None
+_clientPid = None
+_lastHealthCheck = 0.0
+_asyncClient = None
+_asyncClientPid = None
+
+
+def isPoolingEnabled():
+    """
+    :return: True if managers should borrow the shared client.
+    """
+    value = settings.GetConfigValueOrDefault(SECTION, "MongoConnectionPooling", "true")
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def getClientOptions():
+    """
+    :return: (host, port, options) of the clients, from the configuration.
+    """
+    host = settings.GetConfigValue(SECTION, "MONGO_HOST")
+    port = int(settings.GetConfigValue(SECTION, "MongoPort"))
+    options = {"maxPoolSize": int(settings.GetConfigValueOrDefault(SECTION, "MongoMaxPoolSize", 100)),
+               "minPoolSize": int(settings.GetConfigValueOrDefault(SECTION, "MongoMinPoolSize", 0))}
+    maxIdleTimeMS = settings.GetConfigValueOrDefault(SECTION, "MongoMaxIdleTimeMS", None)
+    if maxIdleTimeMS:
+        options["maxIdleTimeMS"] = int(maxIdleTimeMS)
+    return host, port, options
+
+
+def createClient(**kwargs):
+    """
+    Creates a new client from the configuration. The client does not connect
+    until it is used.
+
+    :param kwargs: Additional MongoClient options overriding configured ones.
+    """
+    host, port, options = getClientOptions()
+    options.update(kwargs)
+    return MongoClient(host, port, connect=False, **options)
+
+
+def getClient():
+    """
+    Borrow the client of the current process. Creates it on first use (or
+    after a fork) and verifies it is still reachable every
+    MongoHealthCheckInterval seconds. If the health check fails, the client is
+    recreated once before giving up.
+
+    :raise pymongo.errors.ConnectionFailure: If MongoDB can not be reached.
+    :return: A connected MongoClient. Must not be closed by the caller.
+    """
+    global _client, _clientPid, _lastHealthCheck
+
+    interval = float(settings.GetConfigValueOrDefault(SECTION, "MongoHealthCheckInterval", 30))
+    with _lock:
+        if _client is None or _clientPid != os.getpid():
+            # Never close a client inherited from the parent, its sockets are
+            # shared with it.
+            _client = createClient()
+            _clientPid = os.getpid()
+            _lastHealthCheck = 0.0
+
+        client = _client
+        now = time.monotonic()
+        if now - _lastHealthCheck < interval:
+            return client
+        # A single thread checks, the others keep using the client meanwhile
+        # instead of waiting for the check.
+        _lastHealthCheck = now
+
+    try:
+        client.admin.command("ismaster")
+        return client
+    except pymongo.errors.ConnectionFailure as e:
+        logger.logUnknownWarning("Annotation Storage Connection Pool",
+                                 "Health check failed, recreating client: {0}", e)
+    with _lock:
+        if _client is client:
+            client.close()
+            _client = createClient()
+        client = _client
+    try:
+        client.admin.command("ismaster")
+    except pymongo.errors.ConnectionFailure:
+        # Check again on next borrow.
+        with _lock:
+            _lastHealthCheck = 0.0
+        raise
+    return client
+
+
+def getAsyncClient():
+    """
+    Borrow the motor client of the current process, used by the asynchronous
+    managers (see async_storage_manager). Created on first use, it is bound
+    to the event loop running then, which serves all the requests of the
+    process. motor reconnects by itself, thus there is no health check.
+
+    :return: An AsyncIOMotorClient. Must not be closed by the caller.
+    """
+    global _asyncClient, _asyncClientPid
+
+    with _lock:
+        if _asyncClient is None or _asyncClientPid != os.getpid():
+            # Imported here: only the asynchronous app requires motor.
+            import motor.motor_asyncio
+            host, port, options = getClientOptions()
+            _asyncClient = motor.motor_asyncio.AsyncIOMotorClient(host, port, **options)
+            _asyncClientPid = os.getpid()
+        return _asyncClient
+
+
+def resetClient():
+    """
+    Closes the clients of the current process. The next getClient (or
+    getAsyncClient) call will create a new one.
+    """
+    global _client, _clientPid, _asyncClient, _asyncClientPid
+
+    with _lock:
+        if _client is not None and _clientPid == os.getpid():
+            _client.close()
+        _client = None
+        _clientPid = None
+        if _asyncClient is not None and _asyncClientPid == os.getpid():
+            _asyncClient.close()
+        _asyncClient = None
+        _asyncClientPid = None
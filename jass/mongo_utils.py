@@ -5,8 +5,13 @@
 Various utilities for mongoDB usage.
 """
 
+import base64
+import binascii
+
 from bson.objectid import ObjectId
 
+import jass.json_codec as json_codec
+
 
 def changeDocIdToString(mongoDoc):
     """
@@ -28,3 +33,26 @@ def changeDocIdToMongoId(jsonDoc):
 
 def isObjectId(strId):
     return ObjectId.is_valid(strId)
+
+
+def encodeContinuationToken(position):
+    """
+    Encodes a position in a result set (a JSON object) as an opaque string
+    which can be passed in an URL.
+    """
+    return base64.urlsafe_b64encode(json_codec.dumpb(position)).decode("ascii")
+
+
+def decodeContinuationToken(token):
+    """
+    Decodes a token created by encodeContinuationToken.
+
+    :return: The position, or None if the token is invalid.
+    """
+    try:
+        position = json_codec.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error, UnicodeError):
+        return None
+    if not isinstance(position, dict):
+        return None
+    return position
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Guard against expensive client queries.
+
+jsonSelect is an arbitrary MongoDB query supplied by the client. A query
+which can not use an index scans the whole collection and stalls the worker
+running it. Before running such a query, its shape is checked:
+
+    - $where (JavaScript evaluated for every document),
+    - $regex which is not anchored (^ or \\A) or is case insensitive, thus
+      can not use an index,
+    - a winning plan (explain with queryPlanner verbosity, which does not run
+      the query) containing a collection scan (COLLSCAN).
+
+Plans are cached by query shape (the query without its values) for
+QueryGuardPlanCacheSeconds.
+
+Settings (section ServiceStockageAnnotations):
+    :QueryGuardPolicy: What to do with expensive queries:
+                       :off: Nothing (default).
+                       :throttle: Run at most QueryGuardThrottleRate
+                                  expensive queries per second per process.
+                                  A query waits at most QueryGuardThrottleWait
+                                  seconds for its turn, then fails.
+                       :reject: Fail.
+    :QueryGuardThrottleRate: Default 1.
+    :QueryGuardThrottleWait: Default 5.
+    :QueryGuardPlanCacheSeconds: Default 60.
+"""
+
+import collections
+import threading
+import time
+
+from bson import json_util
+from bson.son import SON
+
+import jass.json_codec as json_codec
+import jass.settings as settings
+import jass.custom_logger as logger
+from jass.storage_exception import AnnotationException, StorageException
+
+SECTION = "ServiceStockageAnnotations"
+
+POLICY_OFF = "off"
+POLICY_THROTTLE = "throttle"
+POLICY_REJECT = "reject"
+POLICIES = [POLICY_OFF, POLICY_THROTTLE, POLICY_REJECT]
+
+COLLECTION_SCAN = "COLLSCAN"
+
+_PLAN_CACHE_SIZE = 1000
+
+_lock = threading.Lock()
+# (collection, shape) -> (expiration time, collection scan)
+_planCache = collections.OrderedDict()
+_tokens = None
+_lastRefill = 0.0
+
+
+def getPolicy():
+    policy = str(settings.GetConfigValueOrDefault(SECTION, "QueryGuardPolicy", POLICY_OFF)).strip().lower()
+    if policy not in POLICIES:
+        logger.logUnknownWarning("Query guard", "Unknown policy {0}, the guard is disabled", policy)
+        return POLICY_OFF
+    return policy
+
+
+def findExpensiveOperator(query):
+    """
+    :return: Description of the first operator of the query which can not
+             use an index, or None.
+    """
+    if isinstance(query, list):
+        for value in query:
+            reason = findExpensiveOperator(value)
+            if reason:
+                return reason
+    elif isinstance(query, dict):
+        if "$where" in query:
+            return "$where"
+        if "$regex" in query:
+            pattern = query["$regex"]
+            options = query.get("$options", "")
+            if not isinstance(pattern, str) or not pattern.startswith(("^", "\\A")):
+                return "unanchored $regex {0}".format(pattern)
+            if "i" in options:
+                return "case insensitive $regex {0}".format(pattern)
+        for value in query.values():
+            reason = findExpensiveOperator(value)
+            if reason:
+                return reason
+    return None
+
+
+def isCollectionScan(plan):
+    """
+    :param plan: Plan returned by explain (winningPlan).
+    :return: True if a stage of the plan scans the whole collection.
+    """
+    if plan.get("stage") == COLLECTION_SCAN:
+        return True
+    stages = list(plan.get("inputStages", []))
+    for key in ["inputStage", "outerStage", "innerStage"]:
+        if key in plan:
+            stages.append(plan[key])
+    return any(isCollectionScan(stage) for stage in stages)
+
+
+def explainQuery(db, collection, query, maxTimeMS=None):
+    """
+    Explains a find. The query is only run (executionStats verbosity) if it
+    passes the guard, whatever the policy: an expensive query is not run
+    only to be explained.
+
+    :param db: pymongo Database.
+    :param maxTimeMS: Time budget of each explain, None if not limited.
+    :return: {winningPlan, collectionScan, guard (reason why the query is
+             expensive, or None)} and if the query was run: nReturned,
+             totalDocsExamined, totalKeysExamined, executionTimeMillis.
+    """
+    plan = _explain(db, collection, query, "queryPlanner", maxTimeMS)["queryPlanner"]["winningPlan"]
+    collectionScan = isCollectionScan(plan)
+    reason = findExpensiveOperator(query)
+    if reason is None and collectionScan:
+        reason = "collection scan"
+    report = {"winningPlan": _toJson(plan), "collectionScan": collectionScan, "guard": reason}
+    if reason is not None:
+        return report
+
+    stats = _explain(db, collection, query, "executionStats", maxTimeMS)["executionStats"]
+    for key in ["nReturned", "totalDocsExamined", "totalKeysExamined", "executionTimeMillis"]:
+        report[key] = stats.get(key)
+    return report
+
+
+def checkQuery(db, collection, query):
+    """
+    Applies the policy to a query before running it.
+
+    :raise AnnotationException: (14) If the query is expensive and the
+                                policy is reject.
+    :raise StorageException: (3) If the query is expensive and the policy is
+                             throttle, but it could not run in time.
+    """
+    policy = getPolicy()
+    if policy == POLICY_OFF:
+        return
+    reason = findExpensiveOperator(query)
+    if reason is None and _isCollectionScan(db, collection, query):
+        reason = "collection scan of {0}".format(collection)
+    if reason is None:
+        return
+
+    if policy == POLICY_REJECT:
+        logger.logInfo(AnnotationException(14, reason))
+        raise AnnotationException(14, reason)
+    rate = float(settings.GetConfigValueOrDefault(SECTION, "QueryGuardThrottleRate", 1))
+    maxWait = float(settings.GetConfigValueOrDefault(SECTION, "QueryGuardThrottleWait", 5))
+    if not _acquire(rate, maxWait):
+        logger.logInfo(StorageException(3, reason))
+        raise StorageException(3, reason)
+
+
+def resetState():
+    """
+    Forgets cached plans and throttling state. Used by tests.
+    """
+    global _tokens
+    with _lock:
+        _planCache.clear()
+        _tokens = None
+
+
+def _explain(db, collection, query, verbosity, maxTimeMS=None):
+    find = SON([("find", collection), ("filter", query)])
+    if maxTimeMS:
+        # Applies to the explained find, which runs the query for
+        # executionStats.
+        find["maxTimeMS"] = maxTimeMS
+    return db.command(SON([("explain", find), ("verbosity", verbosity)]))
+
+
+def _shape(value):
+    """
+    The query without its values, to identify queries having the same plan.
+    """
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if any(isinstance(item, (dict, list)) for item in value):
+            return [_shape(item) for item in value]
+        return "array"
+    return None
+
+
+def _isCollectionScan(db, collection, query):
+    key = (collection, json_codec.dumps(_shape(query), sortKeys=True))
+    now = time.monotonic()
+    with _lock:
+        cached = _planCache.get(key)
+        if cached is not None and cached[0] > now:
+            _planCache.move_to_end(key)
+            return cached[1]
+
+    plan = _explain(db, collection, query, "queryPlanner")["queryPlanner"]["winningPlan"]
+    collectionScan = isCollectionScan(plan)
+    expiration = now + float(settings.GetConfigValueOrDefault(SECTION, "QueryGuardPlanCacheSeconds", 60))
+    with _lock:
+        _planCache[key] = (expiration, collectionScan)
+        _planCache.move_to_end(key)
+        while len(_planCache) > _PLAN_CACHE_SIZE:
+            _planCache.popitem(last=False)
+    return collectionScan
+
+
+def _acquire(rate, maxWait):
+    """
+    Token bucket shared by the threads of the process.
+
+    :return: False if no token was available within maxWait seconds.
+    """
+    global _tokens, _lastRefill
+    if rate <= 0:
+        return False
+    capacity = max(rate, 1.0)
+    deadline = time.monotonic() + maxWait
+    while True:
+        with _lock:
+            now = time.monotonic()
+            if _tokens is None:
+                _tokens = capacity
+            else:
+                _tokens = min(capacity, _tokens + (now - _lastRefill) * rate)
+            _lastRefill = now
+            if _tokens >= 1:
+                _tokens -= 1
+                return True
+            wait = (1 - _tokens) / rate
+        if now + wait > deadline:
+            return False
+        time.sleep(wait)
+
+
+def _toJson(value):
+    # Plans may contain BSON types (regular expressions, ids...).
+    return json_codec.loads(json_util.dumps(value))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+HTTP errors returned for the exceptions raised while handling a request.
+Shared by the Flask app (simple_rest) and the asynchronous app (async_rest),
+so that both answer with the same status and code.
+"""
+
+import http
+
+from werkzeug.exceptions import BadRequest
+
+import jass.custom_logger as logger
+import jass.time_budget as time_budget
+from jass.storage_exception import *
+
+
+def getError(e):
+    """
+    :return: (HTTP status, message, code, details) describing the exception.
+             Codes are absolute, see the ERROR CODES of simple_rest.
+    """
+    if (time_budget.isTimeout(e) or (isinstance(e, StorageException) and e.code == 4)):
+        return (http.HTTPStatus.GATEWAY_TIMEOUT,
+                "Gateway Timeout", 53004,
+                "The storage did not answer within the time budget of the request")
+    if (isinstance(e, StorageException)):
+        if (e.code == 3):
+            return (http.HTTPStatus.SERVICE_UNAVAILABLE,
+                    "Service Unavailable", 53000 + e.code,
+                    str(e))
+        return (http.HTTPStatus.SERVICE_UNAVAILABLE,
+                "Service Unavailable", 53000 + e.code,
+                "Error connecting to the backend storage")
+    elif (isinstance(e, MongoDocumentException)):
+        if (e.code == 0):
+            return (http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                    "Internal Server Error", 52000,
+                    "Server can not currently process requests")
+        elif (e.code == 6):
+            return (http.HTTPStatus.PRECONDITION_FAILED,
+                    "Precondition Failed", 52000 + e.code, str(e))
+        else:
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    "Cannot process Entity",
+                    52000 + e.code, str(e))
+    elif (isinstance(e, AnnotationException)):
+        if (e.code == 0):
+            return (http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                    "Internal Server Error", 51000,
+                    "Server can not currently process requests")
+        else:
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    "Cannot process Entity", 51000 + e.code,
+                    str(e))
+    elif (isinstance(e, StorageRestExceptions)):
+        if (e.code == 2 or e.code == 3 or e.code == 7):
+            return (http.HTTPStatus.NOT_FOUND, "Not Found",
+                    50100 + e.code, str(e))
+        else:
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    "Cannot process entity", 50100 + e.code,
+                    str(e))
+    elif (isinstance(e, BadRequest)):
+        # Flask error
+        return (http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
+    else:
+        logger.logUnknownError("Annotation Storage REST Service Unknown Error",
+                               str(e), 50000)
+        return (http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                "Internal Server Error", "",
+                "Server can not currently process requests")
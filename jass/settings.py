@@ -48,6 +48,17 @@ class Settings(Singleton):
         """
         self.__config_path = config_path
         self.__load_settings(config_path)
+        # Settings resolved once by these modules are read again.
+        # Imported here since json_codec reads its settings with this module.
+        import jass.json_codec as json_codec
+        json_codec.resetCodec()
+        logger.resetOptions()
+
+    def IsLoaded(self):
+        """
+        :return: True if a configuration was loaded.
+        """
+        return self.__config is not None
 
     def GetConfigValue(self, namespace, key):
         """
@@ -59,20 +70,35 @@ class Settings(Singleton):
         """
         return self.__config.get(namespace, key)
 
+    def GetConfigSection(self, namespace):
+        """
+        Raw values of all the keys of a section. Keys are lower case.
+
+        :param namespace: Section of the INI
+        :return: Dict of the values, empty if the section does not exist.
+        """
+        if not self.__config.has_section(namespace):
+            return {}
+        return dict(self.__config.items(namespace, raw=True))
+
     def __load_settings(self, config_path):
         """
         load setting specified by config path
-        """
 
-        self.__config = None
+        The configuration is read completely before replacing the current
+        one, thus threads reading settings meanwhile never see a partial
+        configuration.
+        """
 
         if not os.path.exists(config_path):
+            self.__config = None
             exc = SettingsExceptions(1, config_path)
             logger.logError(exc)
             raise exc
 
-        self.__config = configparser.ConfigParser()
-        self.__config.read(config_path)
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        self.__config = config
 
 
 def GetConfigValue(namespace, key):
@@ -86,3 +112,31 @@ def GetConfigValue(namespace, key):
         return os.environ[key]
     else:
         return Settings.Instance().GetConfigValue(namespace, key)
+
+
+def GetConfigValueOrDefault(namespace, key, default):
+    """
+    Same as GetConfigValue, but returns default if the value is not
+    configured. Used for optional tuning parameters.
+
+    :param namespace: Section of the INI
+    :param key: Actual key for which we want a value.
+    :param default: Value returned if the key (or section) is missing, or if
+                    no configuration was loaded yet.
+    """
+    if key not in os.environ and not Settings.Instance().IsLoaded():
+        return default
+    try:
+        return GetConfigValue(namespace, key)
+    except configparser.Error:
+        return default
+
+
+def GetConfigSection(namespace):
+    """
+    Generic accessor for all the values of a section. Environment variables
+    are not used.
+
+    :param namespace: Section of the INI
+    """
+    return Settings.Instance().GetConfigSection(namespace)
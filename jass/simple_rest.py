@@ -73,20 +73,25 @@ Here is the prefix by type:
 import optparse
 import logging
 import collections
-import json
 import os
 import http.client
+import zlib
 
 # -- 3rd party ---------------------------------------------------------------
 from flask import Flask
 from flask import request
 from flask import render_template
 from flask import jsonify
+from flask import Response
 
 # Utility
 from jass.utility_rest import request_wants_json
+from jass.utility_rest import request_wants_ndjson
+from jass.utility_rest import NDJSON_MIMETYPE
 from jass.utility_rest import get_canarie_api_response
 from jass.utility_rest import error_response  # OK
+from jass.utility_rest import CodecJSONEncoder
+from jass.utility_rest import CodecJSONDecoder
 
 # -- Project specific --------------------------------------------------------
 import jass.settings
@@ -95,10 +100,15 @@ import jass.error
 # -- Program Classes --------------------------------------------------------
 from jass.storage_exception import *
 from jass.document_manager import DocumentManager
-from jass.storage_manager import StorageManager
+from jass.storage_manager import StorageManager, VERSION_FIELD
 from jass.annotations_manager import AnnotationManager
 import jass.custom_logger as logger
-from werkzeug.exceptions import BadRequest
+import jass.time_budget as time_budget
+import jass.jobs as jobs
+import jass.doc_cache as doc_cache
+import jass.json_codec as json_codec
+import jass.json_stream as json_stream
+import jass.rest_errors as rest_errors
 from jass.reverse_proxied import ReverseProxied
 import jass.settings as settings
 
@@ -110,6 +120,8 @@ TEMPLATE_PATH = os.path.join(FILE_ROOT, "..", "templates")
 APP = Flask(__name__,
             static_folder=os.path.join(FILE_ROOT, "..", "static"),
             template_folder=TEMPLATE_PATH)
+APP.json_encoder = CodecJSONEncoder
+APP.json_decoder = CodecJSONDecoder
 
 
 # -- Accessibility ---------------------------------------------------------    --
@@ -123,47 +135,9 @@ APP = Flask(__name__,
 def _processCommonException(e):
     """
     This function is used to generate exception codes. It will create absolute
-    codes for reference
-    """
-    if (isinstance(e, StorageException)):
-        return error_response(http.HTTPStatus.SERVICE_UNAVAILABLE,
-                              "Service Unavailable", 53000 + e.code,
-                              "Error connecting to the backend storage")
-    elif (isinstance(e, MongoDocumentException)):
-        if (e.code == 0):
-            return error_response(http.HTTPStatus.INTERNAL_SERVER_ERROR,
-                                  "Internal Server Error", 52000,
-                                  "Server can not currently process requests")
-        else:
-            return error_response(http.HTTPStatus.UNPROCESSABLE_ENTITY,
-                                  "Cannot process Entity",
-                                  52000 + e.code, str(e))
-    elif (isinstance(e, AnnotationException)):
-        if (e.code == 0):
-            return error_response(http.HTTPStatus.INTERNAL_SERVER_ERROR,
-                                  "Internal Server Error", 51000,
-                                  "Server can not currently process requests")
-        else:
-            return error_response(http.HTTPStatus.UNPROCESSABLE_ENTITY,
-                                  "Cannot process Entity", 51000 + e.code,
-                                  str(e))
-    elif (isinstance(e, StorageRestExceptions)):
-        if (e.code == 2 or e.code == 3):
-            return error_response(http.HTTPStatus.NOT_FOUND, "Not Found",
-                                  50100 + e.code, str(e))
-        else:
-            return error_response(http.HTTPStatus.UNPROCESSABLE_ENTITY,
-                                  "Cannot process entity", 50100 + e.code,
-                                  str(e))
-    elif (isinstance(e, BadRequest)):
-        # Flask error
-        return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
-    else:
-        logger.logUnknownError("Annotation Storage REST Service Unknown Error",
-                               str(e), 50000)
-        return error_response(http.HTTPStatus.INTERNAL_SERVER_ERROR,
-                              "Internal Server Error", "",
-                              "Server can not currently process requests")
+    codes for reference (see rest_errors).
+    """
+    return error_response(*rest_errors.getError(e))
 
 
 def _convStorageIdToDocId(doc):
@@ -188,6 +162,130 @@ def _convDocIdToStorageId(doc):
         del doc["id"]
 
 
+def _ndjsonResponse(man, annotations):
+    """
+    Streams annotations as newline delimited JSON, one annotation per line.
+    The manager is disconnected once the response is sent or the client goes
+    away.
+    """
+
+    def generate():
+        try:
+            for anno in annotations:
+                yield json_codec.dumpb(anno) + b"\n"
+        except GeneratorExit:
+            logger.logUnknownDebug("Annotation Storage Stream Annotations",
+                                   "Client went away, reading is abandoned")
+            raise
+        except Exception as e:
+            # Status is already sent, the client will get a truncated stream.
+            logger.logUnknownError("Annotation Storage Stream Annotations", "", e)
+        finally:
+            # Stops reading (and closes cursors) if the client went away.
+            if hasattr(annotations, "close"):
+                annotations.close()
+            man.disconnect()
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+
+def _createAnnotationStream(man, document_id, storageType):
+    """
+    Inserts the annotations of an NDJSON upload as they are received (POST
+    /document/<document_id>/annotations).
+    """
+    try:
+        storageType = int(storageType) if storageType else 1
+        common = request.args.get('common')
+        if common:
+            common = json_codec.loads(common)
+            if not isinstance(common, dict):
+                raise ValueError()
+        atomic = request.args.get('atomic')
+        if atomic is not None:
+            atomic = atomic.strip().lower() in ("1", "true", "yes", "on")
+    except Exception as e:
+        raise (StorageRestExceptions(5))
+
+    logger.logUnknownDebug("Create Annotations",
+                           " For document Id: {0} StorageType :{1}, NDJSON upload", document_id, storageType)
+    try:
+        nbAnnotationsCreated = man.createAnnotationStream(json_stream.iterNdjson(request.stream),
+                                                          document_id,
+                                                          storageType,
+                                                          common or None,
+                                                          request.args.get('compression'),
+                                                          request.args.get('encoding'),
+                                                          atomic)
+    except AnnotationException as e:
+        if not hasattr(e, "errors"):
+            raise
+        return jsonify({"nCreated": e.nInserted, "errors": e.errors}), http.HTTPStatus.UNPROCESSABLE_ENTITY
+    return jsonify({"nCreated": nbAnnotationsCreated})
+
+
+def _getExpectedVersion():
+    """
+    Returns the version a document must have to be updated: the tags of the
+    If-Match header. None if any version can be replaced.
+
+    The _version field of the body is not a precondition: it is echoed by
+    clients which read the document, possibly from the cache of another
+    process (see doc_cache), and would fail their update with 412.
+    """
+    if request.if_match and not request.if_match.star_tag:
+        # If-Match uses the strong comparison, weak tags never match.
+        return list(request.if_match.as_set())
+    return None
+
+
+def _versionedResponse(res, doc):
+    """
+    Adds the version of the document to a response as its ETag.
+    """
+    response = jsonify(res)
+    if doc.get(VERSION_FIELD) is not None:
+        response.set_etag(doc[VERSION_FIELD])
+    return response
+
+
+def _notModified(etag):
+    """
+    Returns a 304 response if the client already has the representation
+    tagged etag (If-None-Match header), None otherwise.
+    """
+    if etag is None or not request.if_none_match:
+        return None
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=http.HTTPStatus.NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def _annotationsETag(man, document_id):
+    """
+    ETag of the annotations of a document returned for the current request:
+    the change counter of the annotations, and a digest of the request
+    parameters since each set of parameters returns other annotations.
+    """
+    params = "{0}|{1}".format(request.full_path, "ndjson" if request_wants_ndjson() else "json")
+    return "{0}-{1:08x}".format(man.getAnnotationsVersion(document_id),
+                                zlib.crc32(params.encode("UTF-8")))
+
+
+def _parseFields(fields):
+    """
+    Returns the list of fields requested by the client: a comma separated
+    string (query parameter) or a list (JSON body). None if not given.
+    """
+    if fields is None or isinstance(fields, list):
+        return fields
+    if not isinstance(fields, str):
+        raise (StorageRestExceptions(5))
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
 def _getStorageTypeFromId(strId):
     """
     Returns the storage type from object id.
@@ -246,18 +344,51 @@ canarie_api_valid_requests = ['doc',
 
 @APP.before_request
 def log_request():
-    logger.logUnknownDebug("Annotation Storage Request url:", request.url)
-    logger.logUnknownDebug("Annotation Storage Request type:", request.method)
+    # Streamed uploads (NDJSON, or without length) are never read here: they
+    # would be consumed. Other bodies are only read if the record is emitted,
+    # and if they fit in LogMaxMessageLength.
+    if not logger.isDebugEnabled():
+        return
+    logger.logUnknownDebug("Annotation Storage Request", "{0} {1} type: {2} length: {3} arguments: {4}",
+                           request.method, request.url, request.mimetype, request.content_length, request.args)
+    length = request.content_length
+    if not length or request.mimetype == NDJSON_MIMETYPE:
+        return
+    maxLength = logger.getMaxMessageLength()
+    if maxLength and length > maxLength:
+        logger.logUnknownDebug("Annotation Storage Request Data", "Not logged, {0} bytes", length)
+    else:
+        logger.logUnknownDebug("Annotation Storage Request Data", lambda: request.get_data(as_text=True))
+
+
+@APP.before_request
+def set_time_budget():
+    """
+    Managers connected while handling the request limit their MongoDB
+    operations to the budget of the route (see time_budget).
+    """
+    time_budget.setCurrent(time_budget.getBudgetMS(request.endpoint))
+
+
+@APP.teardown_request
+def reset_time_budget(exception):
+    time_budget.setCurrent(None)
+
+
+@APP.before_first_request
+def resume_jobs():
+    """
+    Each worker resumes the background jobs interrupted by a restart. Jobs
+    are claimed atomically, thus run by a single worker (see jobs).
+    """
+    man = StorageManager()
     try:
-        cl = request.content_length
-        if cl is not None:
-            if cl < 10000:
-                logger.logUnknownDebug("Annotation Storage Request Data:", request.data)
-            else:
-                logger.logUnknownDebug("Annotation Storage Request Data:", " Too much data for output")
+        man.connect()
+        jobs.resumeJobs(man.client[man.mongoDb])
     except Exception as e:
-        logger.logUnknownDebug("Annotation Storage Request Data:", "Failed to ouput data.")
-    logger.logUnknownDebug("Annotation Storage Request Arguments:", request.args)
+        logger.logUnknownError("Annotation Storage Resume Jobs", "", e)
+    finally:
+        man.disconnect()
 
 
 @APP.route("/info")
@@ -296,9 +427,14 @@ def info():
 def stats():
     """
     Required by CANARIE.
+
+    Also reports the counters of the document cache of the process (see
+    doc_cache): documentCacheHits, documentCacheMisses, ...
     """
 
     service_stats = {}
+    for key, value in doc_cache.stats().items():
+        service_stats["documentCache" + key[0].upper() + key[1:]] = value
     if request_wants_json():
         return jsonify(service_stats)
     return render_template('default.html', Title="Stats", Tags=service_stats)
@@ -378,7 +514,7 @@ def createDocument():
         man.connect()
         if request.method == 'POST':
             docId = man.createMongoDocument(request.json)
-            logger.logUnknownDebug("Create Document", "Id: {0}".format(docId))
+            logger.logUnknownDebug("Create Document", "Id: {0}", docId)
             return jsonify({"id": docId}), 201
         else:
             return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
@@ -427,8 +563,13 @@ def document(document_id):
 
             Other custom fields which were created would be returned too.
 
+            The ETag of the response is the version of the document
+            (_version). If the If-None-Match header contains it, 304 is
+            returned without fetching the document.
+
             :http status code:
                 |    OK: 200
+                |    Not modified: 304
                 |    Error: See Error Codes
 
     :PUT updates a document by replacing whole document contents:
@@ -446,16 +587,35 @@ def document(document_id):
             Other custom fields which were created would be saved too.
             Erases "_id" field.
 
+            Each update gives the document a new version (_version field,
+            also returned as ETag). To avoid overwriting the changes of
+            someone else, send the version which was read in the If-Match
+            header: the document is only replaced if it was not modified
+            since. The _version field of the body is ignored.
+
         :Response:
             :http status code:
                 |    OK: 200
+                |    Modified since the version read: 412
                 |    Error: See Error Codes
 
-    :DELETE deletes the document. If the document not found do nothing.:
-        :Response JSON: {}
+    :DELETE deletes the document and its annotations. If the document not found do nothing.:
+        :Response JSON:
+
+            The document is deleted before the response. Its annotations
+            (both storages) are deleted by a background job, whose progress
+            is returned by /job/<job_id>:
+            ::
+
+                {"jobId": jobId}
+
+            Until release 1.1.11 the annotations were left in place and the
+            response was 204 {}. It still is when the document does not
+            exist and has no annotation: no job is created.
 
             :http status code:
-                |    OK: 200
+                |    Accepted: 202
+                |    Nothing to delete: 204
                 |    Error: See Error Codes
     """
     man = DocumentManager()
@@ -464,28 +624,39 @@ def document(document_id):
                                                   "documentCollection"))
         man.connect()
         if request.method == 'GET':
-            logger.logUnknownDebug("Get Document", "Id: {0}".format(document_id))
-            doc = man.getMongoDocument(document_id)
+            logger.logUnknownDebug("Get Document", "Id: {0}", document_id)
+            version = None
+            if request.if_none_match:
+                version = man.getMongoDocumentVersion(document_id)
+                notModified = _notModified(version)
+                if notModified is not None:
+                    return notModified
+            # Not older than the version just compared.
+            doc = man.getMongoDocument(document_id, version=version)
             _convStorageIdToDocId(doc)
             if (doc is None):
                 raise (StorageRestExceptions(2))
             else:
-                return jsonify(doc)
+                return _versionedResponse(doc, doc)
         elif request.method == 'PUT':
-            logger.logUnknownDebug("Update Document", "Document {0}".format(document_id))
+            logger.logUnknownDebug("Update Document", "Document {0}", document_id)
             doc = request.json
             _convDocIdToStorageId(doc)
             if '_id' in doc and doc["_id"] != document_id:
                 raise (StorageRestExceptions(1))
             else:
-                docId = man.updateMongoDocument(doc)
-                return jsonify({"id": docId})
+                docId = man.updateMongoDocument(doc, expectedVersion=_getExpectedVersion())
+                return _versionedResponse({"id": docId}, doc)
         elif request.method == 'DELETE':
-            logger.logUnknownDebug("Delete Document", "Id: {0}".format(document_id))
-            man.deleteMongoDocument(document_id)
-            # Whenever it is true or false we don't care, if there is no
-            # exception
-            return jsonify({}), 204
+            logger.logUnknownDebug("Delete Document", "Id: {0}", document_id)
+            res = man.deleteDocumentWithContents(document_id,
+                                                 settings.GetConfigValue("ServiceStockageAnnotations",
+                                                                         "HumanAnnotationCollection"),
+                                                 settings.GetConfigValue("ServiceStockageAnnotations",
+                                                                         "BatchAnnotationCollection"))
+            if res["jobId"] is None:
+                return jsonify({}), 204
+            return jsonify({"jobId": res["jobId"]}), 202
         else:
             return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
 
@@ -510,7 +681,7 @@ def createAnnotationSchema():
         man.connect()
         if request.method == 'POST':
             docId = man.createMongoDocument(request.json)
-            logger.logUnknownDebug("Create Schema", "Id: {0}".format(docId))
+            logger.logUnknownDebug("Create Schema", "Id: {0}", docId)
             return jsonify({"id": docId}), 201
         else:
             return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
@@ -536,26 +707,33 @@ def annotationSchema(schema_id):
                                                   "SchemaCollection"))
         man.connect()
         if request.method == 'GET':
-            logger.logUnknownDebug("Get Schema", "Id: {0}".format(schema_id))
-            doc = man.getMongoDocument(schema_id)
+            logger.logUnknownDebug("Get Schema", "Id: {0}", schema_id)
+            version = None
+            if request.if_none_match:
+                version = man.getMongoDocumentVersion(schema_id)
+                notModified = _notModified(version)
+                if notModified is not None:
+                    return notModified
+            # Not older than the version just compared.
+            doc = man.getMongoDocument(schema_id, version=version)
             _convStorageIdToDocId(doc)
             if (doc is None):
                 raise (StorageRestExceptions(2))
             else:
-                return jsonify(doc)
+                return _versionedResponse(doc, doc)
         elif request.method == 'PUT':
             doc = request.json
             _convDocIdToStorageId(doc)
             if '_id' in doc and doc["_id"] != schema_id:
                 raise (StorageRestExceptions(1))
             else:
-                logger.logUnknownDebug("Update Schema", "Id: {0}".format(schema_id))
-                docId = man.updateMongoDocument(request.json)
+                logger.logUnknownDebug("Update Schema", "Id: {0}", schema_id)
+                docId = man.updateMongoDocument(doc, expectedVersion=_getExpectedVersion())
                 if (docId is None):
                     raise (StorageRestExceptions(3))
-                return jsonify({"id": docId})
+                return _versionedResponse({"id": docId}, doc)
         elif request.method == 'DELETE':
-            logger.logUnknownDebug("Delete Schema", "Id: {0}".format(schema_id))
+            logger.logUnknownDebug("Delete Schema", "Id: {0}", schema_id)
             man.deleteMongoDocument(schema_id)
             # Whenever it is true or false we don't care, if there is no
             # exception
@@ -570,7 +748,7 @@ def annotationSchema(schema_id):
 
 
 @APP.route('/document/<document_id>/annotations',
-           methods=['GET', 'PUT', 'POST', 'DELETE'])
+           methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
 def documentAnnotationS(document_id):
     """
     :route: **/document/<document_id>/annotations**
@@ -591,22 +769,42 @@ def documentAnnotationS(document_id):
             :preconditions:
 
                All must be valid annotations.
-               If one annotation fails, it will return an error message and
-               fail all create.
+               In human storage, annotations which can not be inserted are
+               reported, and the others are kept unless atomic is true.
             :params supported:
 
                 |   batchFormat = 0,1
                 |   storageType = 1,2
+                |   compression = none,gzip,zstd (storageType = 2 only)
+                |   encoding = json,columnar (storageType = 2 only)
+                |   atomic = true,false (storageType = 1 only)
             :params default:
 
                 |   batchFormat = 1
                 |   storageType = 1
+                |   compression = BatchCompression setting
+                |   encoding = BatchEncoding setting
+                |   atomic = HumanInsertAtomic setting
+
+            With the Content-Type application/x-ndjson, the body contains
+            one annotation per line instead of a batch, and is inserted as
+            it is received: memory use does not depend on the size of the
+            upload. Attributes common to all the annotations can be given as
+            a JSON object in the common parameter. batchFormat is ignored.
+            An invalid line returns 422 (code 51016).
         :Response json:
 
-            |    returns {"nInserted":nbAnnotationsInserted}
+            |    returns {"nCreated":nbAnnotationsInserted}
+
+            If some annotations could not be inserted, returns the position
+            of each of them in the batch:
+
+            |    {"nCreated":nbAnnotationsInserted,
+            |     "errors":[{"index":position, "code":mongoCode, "message":message}]}
 
             :http status code:
                 |    OK: 200
+                |    Some annotations not inserted: 422
                 |    Error: See Error Codes
 
     :PUT Updates annotations related for the document.:
@@ -637,14 +835,22 @@ def documentAnnotationS(document_id):
 
                 |    jsonSelect
                 |    storageType = 1,2
+                |    async = true,false
             :params default:
 
                 |    storageType = 1
                 |    jsonSelect = {}
+                |    async = false
         :Response json:
             |    Returns number of annotations deleted
             |    {"nDeleted":nbAnnotationsDeleted}
 
+            With async=true, annotations are deleted before the response, but
+            the GridFS files of large storage batches are deleted by a
+            background job (see /job/<job_id>), null if there is no file:
+
+            |    {"nDeleted":nbAnnotationsDeleted, "jobId":jobId}
+
             :http status code:
                 |    OK: 200
                 |    Error: See Error Codes
@@ -657,6 +863,11 @@ def documentAnnotationS(document_id):
                 |    jsonSelect
                 |    storageType = 0,1,2
                 |    batchFormat = 0
+                |    format = ndjson
+                |    pageSize
+                |    continuationToken
+                |    explain = true
+                |    fields = comma separated list of fields (ex: fields=label,start)
 
             :params default:
                 |    batchFormat = 0
@@ -667,13 +878,72 @@ def documentAnnotationS(document_id):
             An array of annotations check batch format for how they will be
             formatted.
 
+            If fields is given, annotations only contain these fields and id.
+            Nested fields of human storage annotations may be given with a
+            dot (ex: data.text). Nested fields of batch annotations are
+            returned whole.
+
+        :Response json (paged):
+
+            If pageSize or continuationToken is given, returns at most
+            pageSize annotations (capped by MaxPageSize) and the token to
+            pass as continuationToken to get the next page:
+            ::
+
+                {"data": [annotation, ...], "next": token or null if last page}
+
+        :Response json (explain):
+
+            If explain=true, returns for each storage searched the winning
+            plan of the query and, unless the query guard considers it too
+            expensive (whatever QueryGuardPolicy), the number of documents
+            and keys examined. The query is then run within the time budget
+            of the route:
+            ::
+
+                {"humanStorage": {"winningPlan": plan, "collectionScan": bool,
+                                  "guard": reason or null, "nReturned": n,
+                                  "totalDocsExamined": n, "totalKeysExamined": n,
+                                  "executionTimeMillis": n},
+                 "batchStorage": {...}}
+
+        :Response ndjson:
+
+            If format=ndjson or the Accept header prefers application/x-ndjson,
+            annotations are streamed one per line as they are read from the
+            storage.
+
             :http status code:
                 |    OK: 200
                 |    Error: See Error Codes
 
+        :Conditional requests:
+
+            Responses (except explain) have an ETag, which changes whenever
+            annotations of the document are written. If the If-None-Match
+            header contains it, 304 is returned without reading any
+            annotation.
+
+    :HEAD Checks whether the document has annotations.:
+        :Request:
+
+            Same params as GET (jsonSelect, storageType). Annotations are
+            not read: at most one indexed lookup per storage is done.
+
+        :Response:
+
+            No body.
+
+            :http status code:
+                |    Annotations found: 200
+                |    No annotation found: 404
+                |    Error: See Error Codes
+
 
     """
     man = AnnotationManager()
+    # The connection is released by the response when streaming.
+    streaming = False
 
     try:
         hac = settings.GetConfigValue("ServiceStockageAnnotations",
@@ -689,12 +959,12 @@ def documentAnnotationS(document_id):
         batchFormat = request.args.get('batchFormat')
 
         # Note for batch operations all ids are replaced in man
-        if request.method == 'GET':
+        if request.method in ('GET', 'HEAD'):
             try:
                 if not jsonSelect:
                     jsonSelect = {}
                 else:
-                    jsonSelect = json.loads(jsonSelect)
+                    jsonSelect = json_codec.loads(jsonSelect)
                 if not storageType:
                     storageType = 0
                 else:
@@ -703,16 +973,47 @@ def documentAnnotationS(document_id):
                     batchFormat = 0
                 else:
                     batchFormat = int(batchFormat)
+                pageSize = request.args.get('pageSize')
+                if pageSize:
+                    pageSize = int(pageSize)
+                continuationToken = request.args.get('continuationToken')
+                fields = _parseFields(request.args.get('fields'))
+                explain = request.args.get('explain', '').strip().lower() in ("1", "true", "yes", "on")
             except Exception as e:
                 raise (StorageRestExceptions(5))
-            batch = man.getAnnotationS([document_id], jsonSelect, batchFormat,
-                                       storageType)
-            return jsonify(batch)
+            if request.method == 'HEAD':
+                found = man.hasAnnotationS([document_id], jsonSelect, storageType)
+                return "", http.HTTPStatus.OK if found else http.HTTPStatus.NOT_FOUND
+            if explain:
+                return jsonify(man.explainAnnotationS([document_id], jsonSelect, storageType))
+            # The counter is read before the annotations, see touchAnnotations.
+            etag = _annotationsETag(man, document_id)
+            notModified = _notModified(etag)
+            if notModified is not None:
+                return notModified
+            if pageSize or continuationToken:
+                page = man.getAnnotationPage([document_id], jsonSelect, storageType,
+                                             pageSize, continuationToken, fields)
+                response = jsonify(page)
+            elif request_wants_ndjson():
+                annotations = man.iterAnnotationS([document_id], jsonSelect,
+                                                  storageType, fields)
+                streaming = True
+                response = _ndjsonResponse(man, annotations)
+            else:
+                batch = man.getAnnotationS([document_id], jsonSelect, batchFormat,
+                                           storageType, fields)
+                response = jsonify(batch)
+            response.set_etag(etag)
+            return response
 
         elif request.method == 'PUT':
-            logger.logUnknownDebug("Update Annotations", " For document Id: {0}".format(document_id))
+            logger.logUnknownDebug("Update Annotations", " For document Id: {0}", document_id)
             return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
 
+        elif request.method == 'POST' and request.mimetype == NDJSON_MIMETYPE:
+            return _createAnnotationStream(man, document_id, storageType)
+
         elif request.method == 'POST':
             jsonBatch = request.json
             try:
@@ -724,44 +1025,155 @@ def documentAnnotationS(document_id):
                     batchFormat = 1
                 else:
                     batchFormat = int(batchFormat)
+                atomic = request.args.get('atomic')
+                if atomic is not None:
+                    atomic = atomic.strip().lower() in ("1", "true", "yes", "on")
                 logger.logUnknownDebug("Create Annotations",
-                                       " For document Id: {0} StorageType :{1},BatchFormat:{2}, jsonBatch: {3}".format(
-                                           document_id, str(storageType), str(batchFormat), str(jsonBatch)))
+                                       " For document Id: {0} StorageType :{1},BatchFormat:{2}",
+                                       document_id, storageType, batchFormat)
             except Exception as e:
                 raise (StorageRestExceptions(5))
 
-            nbAnnotationsCreated = man.createAnnotationS(jsonBatch,
-                                                         document_id,
-                                                         batchFormat,
-                                                         storageType)
+            try:
+                nbAnnotationsCreated = man.createAnnotationS(jsonBatch,
+                                                             document_id,
+                                                             batchFormat,
+                                                             storageType,
+                                                             request.args.get('compression'),
+                                                             request.args.get('encoding'),
+                                                             atomic)
+            except AnnotationException as e:
+                if not hasattr(e, "errors"):
+                    raise
+                return jsonify({"nCreated": e.nInserted, "errors": e.errors}), http.HTTPStatus.UNPROCESSABLE_ENTITY
             return jsonify({"nCreated": nbAnnotationsCreated})
 
         elif request.method == 'DELETE':
             # Whenever it is true or false we don't care, if there is no
             # exception
             try:
-                logger.logUnknownDebug("Delete Annotations", " For document Id: {0}".format(document_id))
+                logger.logUnknownDebug("Delete Annotations", " For document Id: {0}", document_id)
                 if not jsonSelect:
                     jsonSelect = {}
                 else:
-                    jsonSelect = json.loads(jsonSelect)
+                    jsonSelect = json_codec.loads(jsonSelect)
                 if not storageType:
                     storageType = 0
                 else:
                     storageType = int(storageType)
+                inBackground = request.args.get('async', '').strip().lower() in ("1", "true", "yes", "on")
             except Exception as e:
                 raise (StorageRestExceptions(5))
 
+            if inBackground:
+                res = man.deleteAnnotationSInBackground([document_id], jsonSelect, storageType)
+                logger.logUnknownDebug("Delete Annotations",
+                                       " Number of deleted annotations {0} For document Id: {1}, files job {2}",
+                                       res["nDeleted"], document_id, res["jobId"])
+                return jsonify(res), 200
             nbAnnotationsDeleted = man.deleteAnnotationS([document_id],
                                                          jsonSelect,
                                                          storageType)
             logger.logUnknownDebug("Delete Annotations",
-                                   " Number of deleted annotations {0} For document Id: {1}".format(
-                                       str(nbAnnotationsDeleted), document_id))
+                                   " Number of deleted annotations {0} For document Id: {1}",
+                                   nbAnnotationsDeleted, document_id)
             return jsonify({"nDeleted": nbAnnotationsDeleted}), 200
         else:
             return error_response(http.HTTPStatus.BAD_REQUEST, "Bad Request", "", "")
 
+    except Exception as e:
+        return _processCommonException(e)
+    finally:
+        if not streaming:
+            man.disconnect()
+
+
+@APP.route('/document/<document_id>/annotations/count', methods=['GET'])
+def documentAnnotationSCount(document_id):
+    """
+    :route: **/document/<document_id>/annotations/count**
+
+    Counts the annotations of a document without reading them.
+
+    :GET Returns the number of annotations for the current document.:
+        :Request:
+
+            :params supported:
+
+                |    jsonSelect
+                |    storageType = 0,1,2
+
+            :params default:
+                |    storageType = 0
+                |    jsonSelect = {}
+        :Response json:
+
+            The total, and the count of each storage searched:
+            ::
+
+                {"count": n, "humanStorage": n, "batchStorage": n}
+
+            :http status code:
+                |    OK: 200
+                |    Error: See Error Codes
+    """
+    man = AnnotationManager()
+
+    try:
+        hac = settings.GetConfigValue("ServiceStockageAnnotations",
+                                      "HumanAnnotationCollection")
+        man.addStorageCollection(AnnotationManager.HUMAN_STORAGE, hac)
+        bac = settings.GetConfigValue("ServiceStockageAnnotations",
+                                      "BatchAnnotationCollection")
+        man.addStorageCollection(AnnotationManager.BATCH_STORAGE, bac)
+        man.connect()
+
+        try:
+            jsonSelect = json_codec.loads(request.args.get('jsonSelect') or '{}')
+            storageType = int(request.args.get('storageType') or 0)
+            if not isinstance(jsonSelect, dict):
+                raise ValueError()
+        except Exception as e:
+            raise (StorageRestExceptions(5))
+
+        return jsonify(man.countAnnotationS([document_id], jsonSelect, storageType))
+    except Exception as e:
+        return _processCommonException(e)
+    finally:
+        man.disconnect()
+
+
+@APP.route('/job/<job_id>', methods=['GET'])
+def job(job_id):
+    """
+    :route: **/job/<job_id>**
+
+    Returns the state of a background job.
+
+    :GET returns a job:
+        :Response JSON:
+            ::
+
+                {
+                    id: Id of the job,
+                    type: Kind of job,
+                    state: pending, running, done or failed,
+                    progress: Depends on the type, ex: {done: n, total: n},
+                    error: Message if the job failed,
+                    created, updated: Dates (ISO 8601, UTC)
+                }
+
+            :http status code:
+                |    OK: 200
+                |    Error: See Error Codes
+    """
+    man = StorageManager()
+    try:
+        man.connect()
+        res = jobs.getJob(man.client[man.mongoDb], job_id)
+        if res is None:
+            raise (StorageRestExceptions(7))
+        return jsonify(res)
     except Exception as e:
         return _processCommonException(e)
     finally:
@@ -774,7 +1186,13 @@ def search_annotations():
     Search manual annotations (storageType 1)
     The body of the request is a JSON query passed to https://docs.mongodb.com/manual/reference/method/db.collection.find/
 
+    Instead of skip and limit, pageSize and continuationToken can be used to walk through many results. The cost of
+    a page then does not depend on its depth.
+
+    fields (list or comma separated string) restricts the annotations returned to these fields and id.
+
     :return: JSON Array of results containing the annotation and score matching the query, sorted descending by score.
+             If pageSize or continuationToken is given: {"data": results, "next": token of the next page or null}
     """
     man = AnnotationManager()
 
@@ -785,11 +1203,17 @@ def search_annotations():
 
         query = request.json.get('query')
         if query is None:
-            return json.dumps({"error": "body with query is mandatory"}), 400
+            return json_codec.dumps({"error": "body with query is mandatory"}), 400
         skip = request.json.get('skip')
         limit = request.json.get('limit')
+        page_size = request.json.get('pageSize')
+        continuation_token = request.json.get('continuationToken')
+        fields = _parseFields(request.json.get('fields'))
 
-        results = man.search_annotations(query, skip=skip, limit=limit)
+        if page_size or continuation_token:
+            results = man.search_annotations_page(query, page_size, continuation_token, fields)
+        else:
+            results = man.search_annotations(query, skip=skip, limit=limit, fields=fields)
 
         return jsonify(results)
     except Exception as e:
@@ -807,6 +1231,8 @@ def search_annotations_grouped():
 
     Limit is mandatory when skip is specified.
 
+    fields (list or comma separated string) restricts the annotations returned to these fields and id.
+
     :return: The text index fields and an array of annotation matches grouped by timeline (annotationSetId).
      Each match contains the annotation and score matching the query, sorted descending by score.
      Groups are also sorted descending by score.
@@ -820,13 +1246,15 @@ def search_annotations_grouped():
 
         query = request.get_json(force=True).get('query')
         if query is None:
-            return json.dumps({"error": "body with query is mandatory."}), 400
+            return json_codec.dumps({"error": "body with query is mandatory."}), 400
         skip = request.json.get('skip')
         limit = request.json.get('limit')
         if limit is None and skip is not None:
-            return json.dumps({"error": "Limit is mandatory when skip is specified."}), 400
+            return json_codec.dumps({"error": "Limit is mandatory when skip is specified."}), 400
+
+        fields = _parseFields(request.json.get('fields'))
 
-        results = man.grouped_search_annotations(query, skip=skip, limit=limit)
+        results = man.grouped_search_annotations(query, skip=skip, limit=limit, fields=fields)
         indexed_fields = man.get_text_index_fields()
 
         return jsonify({"results": results, "indexedFields": indexed_fields})
@@ -836,6 +1264,96 @@ def search_annotations_grouped():
         man.disconnect()
 
 
+@APP.route('/annotations/bulk', methods=['POST'])
+def bulkDocumentAnnotationS():
+    """
+    :route: **/annotations/bulk**
+
+    Returns annotations of many documents at once, using one query per
+    storage.
+
+    :POST Returns annotations for the requested documents.:
+        :Request json:
+
+            ::
+
+                {
+                    documentIds: [document_id, ...] (mandatory, at most
+                                 BulkMaxDocumentIds ids),
+                    jsonSelect: {} (see documentAnnotationS),
+                    storageType: 0,1,2 (default 0),
+                    skip: Number of annotations to skip (default 0),
+                    limit: Maximum number of annotations returned
+                }
+
+            skip and limit apply to the annotations of all the documents.
+
+        :Response json:
+
+            Annotations grouped by document id:
+            ::
+
+                {"data": {document_id: [annotation, ...], ...}}
+
+        :Response ndjson:
+
+            If format=ndjson or the Accept header prefers application/x-ndjson,
+            annotations are streamed one per line. Use the doc_id field of
+            each annotation to group them.
+
+            :http status code:
+                |    OK: 200
+                |    Error: See Error Codes
+    """
+    man = AnnotationManager()
+    # The connection is released by the response when streaming.
+    streaming = False
+
+    try:
+        hac = settings.GetConfigValue("ServiceStockageAnnotations",
+                                      "HumanAnnotationCollection")
+        man.addStorageCollection(AnnotationManager.HUMAN_STORAGE, hac)
+        bac = settings.GetConfigValue("ServiceStockageAnnotations",
+                                      "BatchAnnotationCollection")
+        man.addStorageCollection(AnnotationManager.BATCH_STORAGE, bac)
+
+        body = request.get_json(force=True)
+        try:
+            documentIds = body['documentIds']
+            jsonSelect = body.get('jsonSelect') or {}
+            storageType = int(body.get('storageType') or 0)
+            skip = int(body.get('skip') or 0)
+            limit = body.get('limit')
+            if limit is not None:
+                limit = int(limit)
+            if not isinstance(documentIds, list) or not isinstance(jsonSelect, dict):
+                raise ValueError()
+        except Exception as e:
+            raise (StorageRestExceptions(5))
+
+        maxDocumentIds = int(settings.GetConfigValueOrDefault("ServiceStockageAnnotations",
+                                                              "BulkMaxDocumentIds", 1000))
+        if len(documentIds) > maxDocumentIds:
+            raise (StorageRestExceptions(6, len(documentIds), maxDocumentIds))
+
+        man.connect()
+        annotations = man.iterAnnotationS(documentIds, jsonSelect, storageType,
+                                          skip=skip, limit=limit)
+        if request_wants_ndjson():
+            streaming = True
+            return _ndjsonResponse(man, annotations)
+
+        grouped = collections.OrderedDict((str(docId), []) for docId in documentIds)
+        for anno in annotations:
+            grouped.setdefault(anno.get('doc_id'), []).append(anno)
+        return jsonify({"data": grouped})
+    except Exception as e:
+        return _processCommonException(e)
+    finally:
+        if not streaming:
+            man.disconnect()
+
+
 # TODO Update
 @APP.route('/document/<document_id>/annotation', methods=['POST'])
 def createDocumentAnnotation(document_id):
@@ -881,7 +1399,7 @@ def createDocumentAnnotation(document_id):
     try:
         man.connect()
         if request.method == 'POST':
-            logger.logUnknownDebug("Create Annotation", " For document Id: {0}".format(document_id))
+            logger.logUnknownDebug("Create Annotation", " For document Id: {0}", document_id)
             docId = man.createAnnotation(request.json, document_id)
             return jsonify({"id": docId}), 201
         else:
@@ -957,7 +1475,7 @@ def documentAnnotation(document_id, annotation_id):
             raise (StorageRestExceptions(4))
 
         if request.method == 'GET':
-            logger.logUnknownDebug("Get Annotation", " For document Id: {0}".format(document_id))
+            logger.logUnknownDebug("Get Annotation", " For document Id: {0}", document_id)
             doc = man.getAnnotation(annotation_id)
             _convStorageIdToDocId(doc)
             if (doc is None):
@@ -970,11 +1488,11 @@ def documentAnnotation(document_id, annotation_id):
             if '_id' in doc and doc["_id"] != annotation_id:
                 raise (StorageRestExceptions(1))
             else:
-                logger.logUnknownDebug("Update Annotation", " For document Id: {0}".format(document_id))
-                man.updateAnnotation(doc, annotation_id)
+                logger.logUnknownDebug("Update Annotation", " For document Id: {0}", document_id)
+                man.updateAnnotation(doc, document_id)
                 return jsonify({})
         elif request.method == 'DELETE':
-            logger.logUnknownDebug("Delete Annotation", " For document Id: {0}".format(document_id))
+            logger.logUnknownDebug("Delete Annotation", " For document Id: {0}", document_id)
             man.deleteAnnotation(annotation_id)
             # Whenever it is true or false we don't care, if there is no
             # exception
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 # coding:utf-8
 
+import threading
+
+
 class Singleton:
     """
-    A non-thread-safe helper class to ease implementing singletons.
+    A thread-safe helper class to ease implementing singletons.
     This should be used as a decorator -- not a metaclass -- to the
     class that should be a singleton.
 
@@ -22,6 +25,7 @@ class Singleton:
 
     def __init__(self, decorated):
         self._decorated = decorated
+        self._lock = threading.Lock()
 
     def Instance(self):
         """
@@ -29,11 +33,15 @@ class Singleton:
         new instance of the decorated class and calls its `__init__` method.
         On all subsequent calls, the already created instance is returned.
 
+        Threads calling it concurrently for the first time get the same
+        instance, which is only created once.
         """
         try:
             return self._instance
         except AttributeError:
-            self._instance = self._decorated()
+            with self._lock:
+                if not hasattr(self, "_instance"):
+                    self._instance = self._decorated()
             return self._instance
 
     def __call__(self):
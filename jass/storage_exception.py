@@ -10,7 +10,9 @@ class MongoDocumentException(GenericException):
                      3: "Storage document is missing the required @context "
                         "field",
                      4: "Storage document contains a reserved field : {0}",
-                     5: "Storage Document with id : {0} not found for update"}
+                     5: "Storage Document with id : {0} not found for update",
+                     6: "Storage Document with id : {0} was modified, it is not"
+                        " at version {1} anymore"}
     context = "Annotation Storage Document"
 
 
@@ -31,7 +33,15 @@ class AnnotationException(GenericException):
                      7: "StorageType: {0} is not supported ",
                      8: "Number of inserted annotations is not equal to the "
                         "number of annotations in batch: {0} vs {1}",
-                     9: "Some of the document IDs have invalid format."
+                     9: "Some of the document IDs have invalid format.",
+                     10: "Compression {0} is not supported",
+                     11: "Encoding {0} is not supported",
+                     12: "Invalid continuation token {0}",
+                     13: "{0} of {1} annotations could not be inserted. "
+                         "The batch was rolled back.",
+                     14: "Query rejected since it can not use an index: {0}",
+                     15: "Invalid fields {0}, expected a list of field names",
+                     16: "Invalid NDJSON annotations: {0}"
                      }
     context = "Annotation Storage Annotation"
 
@@ -42,7 +52,18 @@ class StorageException(GenericException):
     """
     context = "Annotation Storage Storage"
     codeToMessage = {1: "Failed to connect to MongoDB",
-                     2: "Unexpected delete fail to MongoDB"}
+                     2: "Unexpected delete fail to MongoDB",
+                     3: "Too many expensive queries, try again later: {0}",
+                     4: "Operation exceeded its time budget of {0} ms"}
+
+
+class IndexException(GenericException):
+    """
+    Exceptions related to the index specification
+    """
+    context = "Annotation Storage Index"
+    codeToMessage = {1: "Invalid specification of index {0}: {1}",
+                     2: "Index {0} refers to an unknown collection setting {1}"}
 
 
 class StorageRestExceptions(GenericException):
@@ -58,4 +79,7 @@ class StorageRestExceptions(GenericException):
                         " not exist.",
                      4: "The id supplied is not located in Human Storage."
                         " This request only works with Human Storage.",
-                     5: "One of the supplied request parameters is invalid."}
+                     5: "One of the supplied request parameters is invalid.",
+                     6: "Too many document ids requested: {0}. The maximum"
+                        " is {1}.",
+                     7: "Did not found the job requested"}
@@ -1,6 +1,8 @@
 import pymongo
 import pymongo.errors
-from pymongo import MongoClient
+import jass.doc_cache as doc_cache
+import jass.mongo_pool as mongo_pool
+import jass.time_budget as time_budget
 import jass.mongo_utils as mongo_utils
 import jass.settings as settings
 import jass.custom_logger as logger
@@ -13,6 +15,22 @@ from bson.errors import *
 # http://blog.mongolab.com/2014/01/how-big-is-your-mongodb/
 
 
+# Maximum number of ids in a single $in when deleting by id.
+DELETE_SLICE_SIZE = 10000
+
+
+# Version of a document, changed on every update (see updateMongoDocument).
+VERSION_FIELD = "_version"
+
+
+def newVersion():
+    """
+    :return: A new document version. Versions are unique, thus a version
+             identifies the contents of a document.
+    """
+    return str(ObjectId())
+
+
 def clear_nones(a_dict: dict) -> dict:
     cleaned = {key: value for key, value in a_dict.items() if a_dict[key] is not None}
     return cleaned
@@ -21,8 +39,18 @@ def clear_nones(a_dict: dict) -> dict:
 class StorageManager:
     """
     Storage manager class.
+
+    A manager holds the connection state of one request (collection, borrowed
+    client, time budget) and must not be shared between threads: create one
+    per request. Managers of concurrent requests share the client of the
+    process (see mongo_pool), which is thread-safe.
     """
     m_connected = False
+    m_pooled = False
+    # Time budget (ms) of each operation, None if not limited. See time_budget.
+    maxTimeMS = None
+    # Documents get a version (VERSION_FIELD) on creation and update.
+    versioned = True
 
     def setCollection(self, collection):
         """
@@ -33,18 +61,28 @@ class StorageManager:
     def connect(self):
         """
         Connects to MongoDB and verifies connection.
+
+        Unless MongoConnectionPooling is disabled, the process-wide client is
+        borrowed (see mongo_pool) instead of creating a new one.
+
+        Operations are limited by the time budget of the current request.
         """
+        self.maxTimeMS = time_budget.getCurrent()
         try:
-            host = settings.GetConfigValue("ServiceStockageAnnotations", "MONGO_HOST")
-            port = int(settings.GetConfigValue("ServiceStockageAnnotations", "MongoPort"))
-            self.client = MongoClient(host, port, connect=False)
             db = settings.GetConfigValue("ServiceStockageAnnotations",
                                          "MongoDb")
             self.mongoDb = db
 
-            # Force connection test
-            # https://api.mongodb.com/python/current/migrate-to-pymongo3.html#mongoclient-connects-asynchronously
-            self.client.admin.command("ismaster")
+            if mongo_pool.isPoolingEnabled():
+                self.client = mongo_pool.getClient()
+                self.m_pooled = True
+            else:
+                self.client = mongo_pool.createClient()
+                self.m_pooled = False
+
+                # Force connection test
+                # https://api.mongodb.com/python/current/migrate-to-pymongo3.html#mongoclient-connects-asynchronously
+                self.client.admin.command("ismaster")
 
             self.m_connected = True
             return True
@@ -99,6 +137,8 @@ class StorageManager:
             # We don't want the client to specify an id.
             if '_id' in jsonDoc:
                 del jsonDoc["_id"]
+            if self.versioned:
+                jsonDoc[VERSION_FIELD] = newVersion()
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
@@ -111,7 +151,7 @@ class StorageManager:
         else:
             raise StorageException(1)
 
-    def getMongoDocument(self, strDocId, collection=None):
+    def getMongoDocument(self, strDocId, collection=None, version=None):
         """
         Returns a document
         This function only validates the presence of the required fields.
@@ -120,6 +160,10 @@ class StorageManager:
             * isConnected must be true,
 
         :param strDocId: Document ID
+
+        :param version: If not None, the version the document is known to
+                        have (see getMongoDocumentVersion). A cached copy
+                        with another version is not returned.
         
         :return : If the document is found returns a json object of the
                   document, otherwise returns None
@@ -136,14 +180,61 @@ class StorageManager:
             collection = self.mongoCollection
 
         if self.isConnected():
+            cached = doc_cache.isCached(collection)
+            if cached:
+                doc = doc_cache.getDocument(self.mongoDb, collection, str(strDocId))
+                if doc is not None and (version is None or doc.get(VERSION_FIELD) == version):
+                    mongo_utils.changeDocIdToString(doc)
+                    return doc
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
-                doc = coll.find_one({"_id": ObjectId(strDocId)})
+                cursor = coll.find({"_id": ObjectId(strDocId)}).limit(-1)
+                if self.maxTimeMS:
+                    cursor.max_time_ms(self.maxTimeMS)
+                doc = next(cursor, None)
+                if cached and doc is not None:
+                    doc_cache.putDocument(self.mongoDb, collection, str(strDocId), doc)
                 mongo_utils.changeDocIdToString(doc)
                 return doc
             except InvalidId:
                 return None
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Get Document",
+                                       "", e)
+                raise MongoDocumentException(0)
+        else:
+            raise StorageException(1)
+
+    def getMongoDocumentVersion(self, strDocId, collection=None):
+        """
+        Returns the version of a document, without fetching its contents.
+
+        The version is always read from MongoDB, not from doc_cache: it is
+        used as a validator (ETag), and the cache of a process does not see
+        the updates made by the others.
+
+        :return: The version (VERSION_FIELD), or None if the document is not
+                 found or has no version.
+        """
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            if not mongo_utils.isObjectId(strDocId):
+                return None
+            try:
+                db = self.client[self.mongoDb]
+                coll = db[collection]
+                cursor = coll.find({"_id": ObjectId(strDocId)}, {VERSION_FIELD: 1}).limit(-1)
+                if self.maxTimeMS:
+                    cursor.max_time_ms(self.maxTimeMS)
+                doc = next(cursor, None)
+                return doc.get(VERSION_FIELD) if doc is not None else None
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
             except Exception as e:
                 logger.logUnknownError("Annotation Storage Get Document",
                                        "", e)
@@ -151,19 +242,28 @@ class StorageManager:
         else:
             raise StorageException(1)
 
-    def updateMongoDocument(self, jsonDoc, collection=None):
+    def updateMongoDocument(self, jsonDoc, collection=None, expectedVersion=None):
         # Note for now: We just create a new document. Reason: Simpler
         """
         Updates an existing document, by replacing it with new contents.
         This function only validates the presence of the required fields.
 
+        The document is replaced in a single round trip, and gets a new
+        version (VERSION_FIELD) if the manager is versioned. If expectedVersion is given, the document is
+        only replaced if it still has this version, so that concurrent
+        updates are detected instead of overwriting each other. The cached
+        document (see doc_cache) is invalidated.
+
         :Preconditions (Otherwise exception is thrown):
             * isConnected must be true,
             * required fields must be present
 
         :param jsonDoc: Document as a JSON document. The document needs to contain a valid id.
 
+        :param expectedVersion: Version (or list of versions) the document must have. None to replace any version.
+
         :return : If the document to be updated is found, returns the id of the document. If it can not be found, raises an exception.
+                  If it does not have the expected version, raises MongoDocumentException 6.
 
                   Document content returned (mandatory). Other user fields may be present:
                   ::
@@ -181,28 +281,47 @@ class StorageManager:
             if jsonDoc is None:
                 raise MongoDocumentException(2)
 
-            if '_id' in jsonDoc:
-                doWithId = self.getMongoDocument(jsonDoc['_id'])
-                if doWithId is None:
-                    # ID cannot be found
-                    logger.logInfo(MongoDocumentException(5, jsonDoc['_id']))
-                    raise MongoDocumentException(5, jsonDoc['_id'])
-
-            else:
+            if '_id' not in jsonDoc:
                 logger.logInfo(MongoDocumentException(5, ""))
                 raise MongoDocumentException(5, "")
+            strDocId = str(jsonDoc['_id'])
+            if not mongo_utils.isObjectId(jsonDoc['_id']):
+                # ID cannot be found
+                logger.logInfo(MongoDocumentException(5, strDocId))
+                raise MongoDocumentException(5, strDocId)
 
             mongo_utils.changeDocIdToMongoId(jsonDoc)
+            query = {"_id": jsonDoc["_id"]}
+            if isinstance(expectedVersion, list):
+                query[VERSION_FIELD] = {"$in": expectedVersion}
+            elif expectedVersion is not None:
+                query[VERSION_FIELD] = expectedVersion
+            if self.versioned:
+                jsonDoc[VERSION_FIELD] = newVersion()
 
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
-                doc_id = coll.save(jsonDoc)
-                return str(doc_id)
+                res = coll.replace_one(query, jsonDoc)
+                # Only a failed update needs a second look at the document.
+                found = res.matched_count or (expectedVersion is not None and
+                                              coll.find_one({"_id": jsonDoc["_id"]}, {"_id": 1}) is not None)
             except Exception as e:
                 logger.logUnknownError("Annotation Storage Update Document",
                                        "", e)
                 raise MongoDocumentException(0)
+            finally:
+                if doc_cache.isCached(collection):
+                    doc_cache.invalidateDocument(self.mongoDb, collection, strDocId)
+
+            if not found:
+                # ID cannot be found
+                logger.logInfo(MongoDocumentException(5, strDocId))
+                raise MongoDocumentException(5, strDocId)
+            if not res.matched_count:
+                logger.logInfo(MongoDocumentException(6, strDocId, expectedVersion))
+                raise MongoDocumentException(6, strDocId, expectedVersion)
+            return strDocId
 
         else:
             raise StorageException(1)
@@ -242,12 +361,11 @@ class StorageManager:
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
-                if kwargs is None:
-                    res = coll.find(jsonQuery)
-                else:
-                    # Client might have called with None args. E.g. limit or skip
-                    cleaned_kwargs = clear_nones(kwargs)
-                    res = coll.find(jsonQuery, **cleaned_kwargs)
+                # Client might have called with None args. E.g. limit or skip
+                cleaned_kwargs = clear_nones(kwargs)
+                res = coll.find(jsonQuery, **cleaned_kwargs)
+                if self.maxTimeMS:
+                    res.max_time_ms(self.maxTimeMS)
                 return res
             except StorageException as e:
                 raise e
@@ -259,6 +377,37 @@ class StorageManager:
         else:
             raise StorageException(1)
 
+    def countMongoDocumentS(self, jsonQuery, collection=None, limit=None):
+        """
+        Counts the documents matching a query, without fetching them.
+
+        :@param jsonQuery: See getMongoDocumentS.
+
+        :@param limit: Stop counting after this number of documents. limit=1
+                       checks whether a document exists.
+
+        :@return The number of matching documents
+        """
+
+        if not collection:
+            collection = self.mongoCollection
+
+        if self.isConnected():
+            try:
+                db = self.client[self.mongoDb]
+                coll = db[collection]
+                kwargs = clear_nones({"limit": limit, "maxTimeMS": self.maxTimeMS})
+                return coll.count(jsonQuery, **kwargs)
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
+            except Exception as e:
+                logger.logUnknownError("Annotation Storage Count Documents",
+                                       "", e)
+                raise MongoDocumentException(0)
+
+        else:
+            raise StorageException(1)
+
     @staticmethod
     def grouped_annotation_filter(limit, skip):
         project = {"$project": {"score": 1}}
@@ -297,10 +446,14 @@ class StorageManager:
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
+                if self.maxTimeMS and "maxTimeMS" not in kwargs:
+                    kwargs["maxTimeMS"] = self.maxTimeMS
                 res = coll.aggregate(pipeline, **kwargs)
                 return res
             except StorageException as e:
                 raise e
+            except pymongo.errors.ExecutionTimeout:
+                raise StorageException(4, self.maxTimeMS)
             except Exception as e:
                 logger.logUnknownError("Annotation Storage Aggregate",
                                        "", e)
@@ -319,6 +472,11 @@ class StorageManager:
             options
 
         :@return The number of deleted documents
+
+        Deletes are not limited by the time budget: MongoDB 3.4 deletes do
+        not take maxTimeMS, and a partial delete could not be undone anyway.
+
+        The cached documents of the collection (see doc_cache) are invalidated.
         """
 
         if not collection:
@@ -328,25 +486,37 @@ class StorageManager:
             try:
                 db = self.client[self.mongoDb]
                 coll = db[collection]
-                res = coll.remove(jsonQuery)
-                if (res['ok'] != 1):
-                    raise StorageException(2)
-                else:
-                    return res['n']
+                return self.__remove(coll, jsonQuery)
             except StorageException as e:
                 raise e
             except Exception as e:
                 logger.logUnknownError("Annotation Storage Delete Document",
                                        "", e)
                 raise MongoDocumentException(0)
+            finally:
+                if doc_cache.isCached(collection):
+                    doc_cache.invalidateDocument(self.mongoDb, collection)
 
         else:
             raise StorageException(1)
 
+    # ~ Private
+    def __remove(self, coll, jsonQuery):
+        res = coll.remove(jsonQuery)
+        if (res['ok'] != 1):
+            raise StorageException(2)
+        return res['n']
+
     def disconnect(self):
+        """
+        Releases the connection. A borrowed client is only released, it stays
+        open for the next requests of the process.
+        """
         if self.isConnected():
             try:
-                self.client.close()
+                if not self.m_pooled:
+                    self.client.close()
+                self.client = None
                 self.m_connected = False
             except:
                 self.m_connected = False
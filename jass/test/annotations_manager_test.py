@@ -1,11 +1,22 @@
 import unittest
+import io
 import json
 import logging
+import math
 import random
+import time
 import os
+import gridfs
+from bson.objectid import ObjectId
 from pymongo import MongoClient
 
 from jass.annotations_manager import AnnotationManager
+from jass.annotations_manager import normalizeAnnotations, normalizeAnnotationList
+from jass.document_manager import DocumentManager
+from jass import batch_storage
+from jass import jobs
+from jass import json_stream
+from jass import query_guard
 from jass import settings
 from jass.storage_exception import *
 
@@ -103,6 +114,398 @@ class TestAnnotationsManager(unittest.TestCase):
         res = self.d.getAnnotationS([id, id2], {"k": 2}, 0, 2)
         self.assertEqual(6, len(res["data"]))
 
+    def test_batchChunks(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        jsonBatch = self.l('{"common":{"@context":"test","k":1},"data":[{"a":1,"b":1},{"a":2,"b":1},{"a":3,"b":1}]}')
+        self.assertEqual(3, self.d.createAnnotationS(jsonBatch, id, 1, 2))
+        # The test configuration uses chunks of 2 annotations.
+        batch = self.d.getMongoDocumentS({"doc_id": id}, self.d.storageCollections[2])[0]
+        self.assertEqual([(0, 2), (2, 1)], [(c["offset"], c["count"]) for c in batch["file_fs_chunks_batch"]])
+        self.assertEqual(3, batch["count_batch"])
+        fs = gridfs.GridFS(self.d.client[self.d.mongoDb])
+        self.assertEqual([2, 3], [anno["a"] for anno in batch_storage.iterBatchAnnotations(fs, batch, 1, 2)])
+        self.assertEqual([3], [anno["a"] for anno in batch_storage.iterBatchAnnotations(fs, batch, 2)])
+
+        appendBatch = self.l('{"common":{"@context":"test","k":1},"data":[{"a":4,"b":1},{"a":5,"b":2}]}')
+        self.assertEqual(2, self.d.appendAnnotationsInLargeStorage(appendBatch, id))
+        res = self.d.getAnnotationS([id], {"k": 1}, 0, 2)
+        self.assertEqual([1, 2, 3, 4, 5], [anno["a"] for anno in res["data"]])
+        # b is no longer common to all annotations of the batch.
+        self.assertEqual(0, len(self.d.getAnnotationS([id], {"b": 1}, 0, 2)["data"]))
+        self.assertEqual(1, self.d.deleteAnnotationS([id], {"k": 1}, 2))
+        self.assertEqual(0, fs.find().count(), "All chunks should have been deleted")
+
+    def test_batchCompression(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        jsonBatch = '{"common":{"@context":"test","k":"%s"},"data":[{"a":1},{"a":2},{"a":3}]}'
+        self.assertRaises(AnnotationException,
+                          lambda: self.d.createAnnotationS(self.l(jsonBatch % "x"), id, 1, 2, "yolo"))
+        compressions = ["none", "gzip"]
+        if batch_storage.zstandard is not None:
+            compressions.append("zstd")
+        else:
+            self.assertRaises(AnnotationException, lambda: batch_storage.compressChunk(b"[]", "zstd"))
+            self.assertRaises(AnnotationException, lambda: batch_storage.openChunk(io.BytesIO(b""), "zstd"))
+        for compression in compressions:
+            self.assertEqual(3, self.d.createAnnotationS(self.l(jsonBatch % compression), id, 1, 2, compression))
+            res = self.d.getAnnotationS([id], {"k": compression}, 0, 2)
+            self.assertEqual([1, 2, 3], [anno["a"] for anno in res["data"]],
+                             "Failed to read batch compressed with {0}".format(compression))
+            appendBatch = self.l('{"common":{"k":"%s"},"data":[{"a":4}]}' % compression)
+            self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(appendBatch, id))
+            res = self.d.getAnnotationS([id], {"k": compression}, 0, 2)
+            self.assertEqual([1, 2, 3, 4], [anno["a"] for anno in res["data"]])
+        self.assertEqual(len(compressions), self.d.deleteAnnotationS([id], {}, 2))
+
+    def test_batchEncoding(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        jsonBatch = self.l('{"common":{"@context":"test","k":1},"data":[{"a":1,"b":"x"},{"a":2,"c":1.5},{"a":3}]}')
+        self.assertRaises(AnnotationException, lambda: self.d.createAnnotationS(jsonBatch, id, 1, 2, None, "yolo"))
+        self.assertEqual(3, self.d.createAnnotationS(jsonBatch, id, 1, 2, "gzip", "columnar"))
+        res = self.d.getAnnotationS([id], {}, 0, 2)
+        self.assertEqual([{"a": 1, "b": "x"}, {"a": 2, "c": 1.5}, {"a": 3}],
+                         [{k: v for k, v in anno.items() if k in ["a", "b", "c"]} for anno in res["data"]])
+        res = self.d.getAnnotationS([id], {}, 0, 2, ["a", "b"])
+        self.assertEqual([{"a": 1, "b": "x"}, {"a": 2}, {"a": 3}],
+                         [{k: v for k, v in anno.items() if k != "id"} for anno in res["data"]])
+        self.assertTrue(all("id" in anno for anno in res["data"]))
+        self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(self.l('{"common":{"k":1},"data":[{"a":4}]}'), id))
+        res = self.d.getAnnotationS([id], {}, 0, 2, ["a"])
+        self.assertEqual([1, 2, 3, 4], [anno["a"] for anno in res["data"]])
+        self.assertEqual([["a", "id"]] * 4, [sorted(anno) for anno in res["data"]])
+
+    def test_batchNonFiniteFloats(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        for encoding in batch_storage.ENCODINGS:
+            jsonBatch = {"common": {"@context": "test", "e": encoding},
+                         "data": [{"a": float("nan")}, {"a": float("inf")}, {"a": -float("inf")}]}
+            self.assertEqual(3, self.d.createAnnotationS(jsonBatch, id, 1, 2, None, encoding))
+            res = self.d.getAnnotationS([id], {"e": encoding}, 0, 2)
+            values = [anno["a"] for anno in res["data"]]
+            # Not null.
+            self.assertTrue(math.isnan(values[0]), encoding)
+            self.assertEqual([float("inf"), -float("inf")], values[1:], encoding)
+
+    def test_legacyBatch(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        db = self.d.client[self.d.mongoDb]
+        fs = gridfs.GridFS(db)
+        fileId = fs.put(json.dumps([{"a": 1, "doc_id": id}, {"a": 2, "doc_id": id}]).encode("UTF-8"))
+        db[self.d.storageCollections[2]].insert_one({"doc_id": id, "k": 1, "file_fs_id_batch": fileId})
+        self.assertEqual([1, 2], [anno["a"] for anno in self.d.getAnnotationS([id], {}, 0, 2)["data"]])
+        appendBatch = self.l('{"common":{"k":1},"data":[{"a":3}]}')
+        self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(appendBatch, id))
+        self.assertEqual([1, 2, 3], [anno["a"] for anno in self.d.getAnnotationS([id], {}, 0, 2)["data"]])
+        self.assertEqual(1, self.d.deleteAnnotationS([id], {}, 2))
+        self.assertEqual(0, fs.find().count())
+
+    def test_appendToChangedBatch(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        db = self.d.client[self.d.mongoDb]
+        coll = db[self.d.storageCollections[2]]
+        fs = gridfs.GridFS(db)
+        self.assertEqual(1, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":1}]}'), id, 1, 2))
+        # The count of a batch without one is restored from its chunks.
+        coll.update_one({"doc_id": id}, {"$unset": {batch_storage.COUNT_FIELD: ""}})
+        self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(self.l('{"common":{"k":1},"data":[{"a":2}]}'), id))
+        self.assertEqual(2, coll.find_one({"doc_id": id})[batch_storage.COUNT_FIELD])
+        self.assertEqual([1, 2], [anno["a"] for anno in self.d.getAnnotationS([id], {}, 0, 2)["data"]])
+
+        writeChunks = batch_storage.writeChunks
+
+        # Another append is added while the chunks are written: the chunks
+        # are positioned after its annotations.
+        def appendThenWrite(*args, **kwargs):
+            batch_storage.writeChunks = writeChunks
+            self.d.appendAnnotationsInLargeStorage(self.l('{"common":{"k":1},"data":[{"a":3},{"a":4}]}'), id)
+            return writeChunks(*args, **kwargs)
+
+        batch_storage.writeChunks = appendThenWrite
+        try:
+            self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(
+                self.l('{"common":{"k":1},"data":[{"a":5}]}'), id))
+        finally:
+            batch_storage.writeChunks = writeChunks
+        self.assertEqual(5, coll.find_one({"doc_id": id})[batch_storage.COUNT_FIELD])
+        self.assertEqual([1, 2, 3, 4, 5], [anno["a"] for anno in self.d.getAnnotationS([id], {}, 0, 2)["data"]])
+        self.assertEqual([3, 4], [anno["a"] for anno in self.d.iterAnnotationS([id], {}, 2, skip=2, limit=2)])
+
+        # The batch is deleted while the appended chunks are written: the
+        # annotations make a new batch.
+        def deleteThenWrite(*args, **kwargs):
+            self.d.deleteAnnotationS([id], {}, 2)
+            return writeChunks(*args, **kwargs)
+
+        batch_storage.writeChunks = deleteThenWrite
+        try:
+            self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(
+                self.l('{"common":{"k":1},"data":[{"a":6}]}'), id))
+        finally:
+            batch_storage.writeChunks = writeChunks
+        self.assertEqual(1, coll.count())
+        self.assertEqual([6], [anno["a"] for anno in self.d.getAnnotationS([id], {}, 0, 2)["data"]])
+        self.assertEqual(1, fs.find().count())
+
+    def test_deleteAnnotationSInBackground(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        db = self.d.client[self.d.mongoDb]
+        fs = gridfs.GridFS(db)
+        for k in range(3):
+            jsonBatch = self.l('{"common":{"k":%d},"data":[{"a":1},{"a":2},{"a":3}]}' % k)
+            self.assertEqual(3, self.d.createAnnotationS(jsonBatch, id, 1, 2))
+        self.assertEqual(6, fs.find().count())
+        self.assertEqual({"nDeleted": 0, "jobId": None}, self.d.deleteAnnotationSInBackground([id], {"k": 5}, 2))
+
+        res = self.d.deleteAnnotationSInBackground([id], {}, 2)
+        self.assertEqual(3, res["nDeleted"])
+        self.assertEqual([], self.d.getAnnotationS([id], {}, 0, 2)["data"])
+        job = self.waitForJob(res["jobId"])
+        self.assertEqual(jobs.DONE, job["state"])
+        self.assertEqual({"done": 6, "total": 6}, job["progress"])
+        self.assertEqual(0, fs.find().count(), "All chunks should have been deleted")
+        self.assertIsNone(jobs.getJob(db, "yolo"))
+
+    def waitForJob(self, jobId):
+        db = self.d.client[self.d.mongoDb]
+        for i in range(100):
+            job = jobs.getJob(db, jobId)
+            if job["state"] in [jobs.DONE, jobs.FAILED]:
+                break
+            time.sleep(0.1)
+        return job
+
+    def test_deleteDocumentWithContents(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        other = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        for docId in [id, other]:
+            self.assertEqual(3, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2},{"a":3}]}'), docId, 1, 1))
+            self.assertEqual(3, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":4},{"a":5},{"a":6}]}'),
+                                                         docId, 1, 2))
+        fs = gridfs.GridFS(self.d.client[self.d.mongoDb])
+        self.assertEqual(4, fs.find().count())
+
+        man = DocumentManager()
+        man.setCollection(self.d.mongoCollection)
+        man.connect()
+        try:
+            self.assertEqual({"nDeleted": 0, "jobId": None}, man.deleteDocumentWithContents("yolo", "a", "b"))
+            res = man.deleteDocumentWithContents(id, self.d.storageCollections[1], self.d.storageCollections[2])
+            job = self.waitForJob(res["jobId"])
+            # Nothing is left to delete, no job is created.
+            self.assertEqual({"nDeleted": 0, "jobId": None},
+                             man.deleteDocumentWithContents(id, self.d.storageCollections[1],
+                                                            self.d.storageCollections[2]))
+        finally:
+            man.disconnect()
+        self.assertEqual(1, res["nDeleted"])
+        self.assertEqual(None, self.d.getMongoDocument(id))
+
+        self.assertEqual(jobs.DONE, job["state"])
+        self.assertEqual({"humanAnnotations": 3, "batches": 1, "files": 2}, job["progress"])
+        # Finished jobs expire.
+        self.assertIn("expires", self.d.client[self.d.mongoDb]["jobs"].find_one({}))
+        self.assertEqual({"count": 0, "humanStorage": 0, "batchStorage": 0}, self.d.countAnnotationS([id]))
+        self.assertEqual({"count": 6, "humanStorage": 3, "batchStorage": 3}, self.d.countAnnotationS([other]))
+        self.assertEqual(2, fs.find().count())
+
+    def test_createAnnotationsSPartialFailure(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        coll = self.d.client[self.d.mongoDb][self.d.storageCollections[1]]
+        coll.create_index("u", unique=True)
+        # Sub-batches of 2 annotations (test config), the duplicate is in the second one.
+        jsonBatch = self.l('{"data":[{"u":1},{"u":2},{"u":3},{"u":1},{"u":4}]}')
+        with self.assertRaises(AnnotationException) as cm:
+            self.d.createAnnotationS(jsonBatch, id, 0, 1)
+        self.assertEqual(8, cm.exception.code)
+        self.assertEqual(4, cm.exception.nInserted)
+        self.assertEqual([3], [error["index"] for error in cm.exception.errors])
+        self.assertEqual(4, coll.count({"doc_id": id}))
+
+        jsonBatch = self.l('{"data":[{"u":5},{"u":6},{"u":2}]}')
+        with self.assertRaises(AnnotationException) as cm:
+            self.d.createAnnotationS(jsonBatch, id, 0, 1, atomic=True)
+        self.assertEqual(13, cm.exception.code)
+        self.assertEqual(0, cm.exception.nInserted)
+        self.assertEqual([2], [error["index"] for error in cm.exception.errors])
+        self.assertEqual(4, coll.count({"doc_id": id}))
+
+    def test_createAnnotationStream(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        lines = io.BytesIO(b'{"a":1}\n{"a":2}\n\n{"a":3,"_id":"x"}\n')
+        self.assertEqual(3, self.d.createAnnotationStream(json_stream.iterNdjson(lines), id, 1, {"@context": "test"}))
+        res = self.d.getAnnotationS([id], {}, 0, 1)["data"]
+        self.assertEqual([1, 2, 3], sorted(anno["a"] for anno in res))
+        self.assertTrue(all(anno["@context"] == "test" for anno in res))
+
+        lines = io.BytesIO(b'{"b":1}\n{"b":2}\n{"b":3}\n')
+        self.assertEqual(3, self.d.createAnnotationStream(json_stream.iterNdjson(lines), id, 2, {"k": 1}))
+        batch = self.d.getMongoDocumentS({"doc_id": id}, self.d.storageCollections[2])[0]
+        # The test configuration uses chunks of 2 annotations.
+        self.assertEqual([2, 1], [c["count"] for c in batch["file_fs_chunks_batch"]])
+        self.assertEqual(1, batch["k"])
+        self.assertEqual([1, 2, 3], [anno["b"] for anno in self.d.getAnnotationS([id], {"k": 1}, 0, 2)["data"]])
+
+        # Invalid line after a first sub-batch.
+        lines = io.BytesIO(b'{"c":1}\n{"c":2}\n{"c":3}\nyolo\n')
+        with self.assertRaises(AnnotationException) as cm:
+            self.d.createAnnotationStream(json_stream.iterNdjson(lines), id, 1, atomic=True)
+        self.assertEqual(16, cm.exception.code)
+        self.assertEqual(0, self.d.countAnnotationS([id], {"c": {"$exists": True}}, 1)["count"])
+        lines = io.BytesIO(b'{"c":1}\n{"c":2}\n{"c":3}\nyolo\n')
+        with self.assertRaises(AnnotationException) as cm:
+            self.d.createAnnotationStream(json_stream.iterNdjson(lines), id, 2)
+        self.assertEqual(16, cm.exception.code)
+        self.assertEqual(1, self.d.countMongoDocumentS({"doc_id": id}, self.d.storageCollections[2]))
+        fs = gridfs.GridFS(self.d.client[self.d.mongoDb])
+        self.assertEqual(2, fs.find().count(), "Chunks of the failed upload should have been deleted")
+
+    def test_explainAnnotationS(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertEqual(2, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2}]}'), id, 1, 1))
+        res = self.d.explainAnnotationS([id], {"a": 1}, 1)
+        self.assertEqual(["humanStorage"], list(res))
+        self.assertTrue(res["humanStorage"]["collectionScan"])
+        self.assertEqual(1, res["humanStorage"]["nReturned"])
+        self.assertEqual(2, res["humanStorage"]["totalDocsExamined"])
+
+        os.environ["QueryGuardPolicy"] = "reject"
+        try:
+            query_guard.resetState()
+            res = self.d.explainAnnotationS([id], {"a": 1}, 1)
+            self.assertEqual("collection scan", res["humanStorage"]["guard"])
+            self.assertNotIn("nReturned", res["humanStorage"])
+            self.assertRaises(AnnotationException, lambda: self.d.getAnnotationS([id], {"a": 1}, 0, 1))
+            self.assertRaises(AnnotationException, lambda: self.d.deleteAnnotationS([id], {"a": 1}, 1))
+            self.d.client[self.d.mongoDb][self.d.storageCollections[1]].create_index("doc_id")
+            query_guard.resetState()
+            self.assertEqual(1, len(self.d.getAnnotationS([id], {"a": 1}, 0, 1)["data"]))
+            self.assertRaises(AnnotationException,
+                              lambda: self.d.getAnnotationS([id], {"a": {"$regex": "1"}}, 0, 1))
+        finally:
+            del os.environ["QueryGuardPolicy"]
+            query_guard.resetState()
+
+    def test_iterAnnotationsS(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        jsonBatch = self.l('{"common":{"@context":"test"},"data":[{"a":1},{"a":2}]}')
+        largeJsonBatch = self.l('{"common":{"@context":"test","k":1},"data":[{"a":3},{"a":4},{"a":5}]}')
+        self.assertEqual(2, self.d.createAnnotationS(jsonBatch, id, 1, 1))
+        self.assertEqual(3, self.d.createAnnotationS(largeJsonBatch, id, 1, 2))
+        self.assertEqual([], list(self.d.iterAnnotationS([], {}, 0)))
+        self.assertRaises(AnnotationException, lambda: self.d.iterAnnotationS(["yolo"], {}, 0))
+        annotations = list(self.d.iterAnnotationS([id], {}, 0))
+        self.assertEqual([1, 2, 3, 4, 5], sorted(anno["a"] for anno in annotations))
+        self.assertEqual(annotations, self.d.getAnnotationS([id], {}, 0, 0)["data"])
+
+    def test_getAnnotationPage(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertEqual(3, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2},{"a":3}]}'), id, 1, 1))
+        self.assertEqual(3, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":4},{"a":5},{"a":6}]}'),
+                                                     id, 1, 2))
+        self.assertEqual(1, self.d.createAnnotationS(self.l('{"common":{"k":2},"data":[{"a":7}]}'), id, 1, 2))
+        values = []
+        token = None
+        nbPages = 0
+        while True:
+            page = self.d.getAnnotationPage([id], {}, 0, 2, token)
+            values += [anno["a"] for anno in page["data"]]
+            nbPages += 1
+            token = page["next"]
+            if token is None:
+                break
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7], values)
+        self.assertEqual(4, nbPages)
+        page = self.d.getAnnotationPage([id], {"k": 1}, 2, 2)
+        self.assertEqual([4, 5], [anno["a"] for anno in page["data"]])
+        page = self.d.getAnnotationPage([id], {"k": 1}, 2, 2, page["next"])
+        self.assertEqual([6], [anno["a"] for anno in page["data"]])
+        self.assertEqual(None, page["next"])
+        self.assertRaises(AnnotationException, lambda: self.d.getAnnotationPage([id], {}, 0, 2, "yolo"))
+
+    def test_getAnnotationsSFields(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertEqual(1, self.d.createAnnotationS(self.l('{"data":[{"a":1,"b":2,"c":{"x":3,"y":4}}]}'), id, 1, 1))
+        self.assertEqual(1, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":5,"b":6}]}'), id, 1, 2))
+        human = self.d.getAnnotationS([id], {}, 0, 1, ["a", "c.x"])["data"]
+        self.assertEqual([["a", "c", "id"]], [sorted(anno) for anno in human])
+        self.assertEqual({"x": 3}, human[0]["c"])
+        batch = self.d.getAnnotationS([id], {}, 0, 2, ["b"])["data"]
+        self.assertEqual([["b", "id"]], [sorted(anno) for anno in batch])
+        self.assertEqual(6, batch[0]["b"])
+        page = self.d.getAnnotationPage([id], {}, 0, 10, None, ["a"])
+        self.assertEqual([1, 5], [anno["a"] for anno in page["data"]])
+        self.assertTrue(all("b" not in anno for anno in page["data"]))
+        self.assertRaises(AnnotationException, lambda: self.d.getAnnotationS([id], {}, 0, 1, ["$where"]))
+        self.assertRaises(AnnotationException, lambda: list(self.d.iterAnnotationS([id], {}, 0, "a")))
+
+    def test_countAnnotationS(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertEqual({"count": 0, "humanStorage": 0, "batchStorage": 0}, self.d.countAnnotationS([id]))
+        self.assertFalse(self.d.hasAnnotationS([id]))
+        self.assertEqual(2, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2}]}'), id, 1, 1))
+        self.assertEqual(3, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":3},{"a":4},{"a":5}]}'),
+                                                     id, 1, 2))
+        self.assertEqual({"count": 5, "humanStorage": 2, "batchStorage": 3}, self.d.countAnnotationS([id]))
+        self.assertEqual({"count": 1, "humanStorage": 1}, self.d.countAnnotationS([id], {"a": 2}, 1))
+        self.assertEqual({"count": 3, "batchStorage": 3}, self.d.countAnnotationS([id], {"k": 1}, 2))
+        self.assertTrue(self.d.hasAnnotationS([id], {}, 1))
+        self.assertTrue(self.d.hasAnnotationS([id], {"k": 1}, 2))
+        self.assertFalse(self.d.hasAnnotationS([id], {"k": 2}, 2))
+
+    def test_getAnnotationsVersion(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        versions = [self.d.getAnnotationsVersion(id)]
+        self.assertEqual([0], versions)
+
+        def changed():
+            versions.append(self.d.getAnnotationsVersion(id))
+            return versions[-1] > versions[-2]
+
+        self.assertEqual(2, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2}]}'), id, 1, 1))
+        self.assertTrue(changed())
+        self.d.getAnnotationS([id], {}, 0, 0)
+        self.assertFalse(changed())
+        self.assertEqual(1, self.d.appendAnnotationsInLargeStorage(self.l('{"common":{"k":1},"data":[{"a":3}]}'), id))
+        self.assertTrue(changed())
+        annoId = self.d.createAnnotation(self.l('{"@context":"test","a":4}'), id)
+        self.assertTrue(changed())
+        # Moving an annotation changes the annotations of both documents.
+        id2 = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        version2 = self.d.getAnnotationsVersion(id2)
+        self.d.updateAnnotation(self.l('{"_id":"%s","@context":"test","a":5}' % annoId), id2)
+        self.assertTrue(changed())
+        self.assertLess(version2, self.d.getAnnotationsVersion(id2))
+        self.d.updateAnnotation(self.l('{"_id":"%s","@context":"test","a":6}' % annoId), id)
+        self.assertTrue(changed())
+        self.assertEqual(1, self.d.deleteAnnotation(annoId))
+        self.assertTrue(changed())
+        self.assertEqual(0, self.d.deleteAnnotation(annoId))
+        self.assertFalse(changed())
+        self.assertEqual(3, self.d.deleteAnnotationS([id], {}, 0))
+        self.assertTrue(changed())
+
+    def test_iterAnnotationsSPaging(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        id2 = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertEqual(2, self.d.createAnnotationS(self.l('{"data":[{"a":1},{"a":2}]}'), id, 1, 1))
+        self.assertEqual(3, self.d.createAnnotationS(self.l('{"common":{"k":1},"data":[{"a":3},{"a":4},{"a":5}]}'),
+                                                     id, 1, 2))
+        self.assertEqual(2, self.d.createAnnotationS(self.l('{"common":{"k":2},"data":[{"a":6},{"a":7}]}'),
+                                                     id2, 1, 2))
+
+        def page(skip, limit):
+            return [anno["a"] for anno in self.d.iterAnnotationS([id, id2], {}, 0, skip=skip, limit=limit)]
+
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7], page(0, None))
+        self.assertEqual([1, 2, 3], page(0, 3))
+        self.assertEqual([2, 3, 4], page(1, 3))
+        self.assertEqual([4, 5, 6], page(3, 3))
+        self.assertEqual([7], page(6, 3))
+        self.assertEqual([], page(7, 3))
+        self.assertEqual([], page(0, 0))
+        docIds = set(anno["doc_id"] for anno in self.d.iterAnnotationS([id, id2], {}, 0))
+        self.assertEqual({id, id2}, docIds)
+
     def test_deleteAnnotationsS(self):
         id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
         jsonBatch = self.l('{"common":{"@context":"test"},"data":[{"a":1},{"b":2}]}')
@@ -123,5 +526,36 @@ class TestAnnotationsManager(unittest.TestCase):
         self.assertEqual(1, res, "Should delete 1 (only the first batch of 2 batches) we got {0}".format(res))
 
 
+
+class TestNormalizeAnnotations(unittest.TestCase):
+
+    def test_normalizeAnnotations(self):
+        batchData = [{"a": 1, "_id": "x"}, {"a": 1, "b": 2}, {"b": 2}]
+        res = list(normalizeAnnotations(batchData, "doc", {"@context": "test"}))
+        self.assertIs(batchData[0], res[0])
+        self.assertEqual([{"a": 1, "@context": "test", "doc_id": "doc"},
+                          {"a": 1, "b": 2, "@context": "test", "doc_id": "doc"},
+                          {"b": 2, "@context": "test", "doc_id": "doc"}], res)
+
+    def test_normalizeAnnotationList(self):
+        batchData = [{"a": 1, "_id": "x"}, {"a": 2, "@context": "other"}]
+        self.assertIs(batchData, normalizeAnnotationList(batchData, "doc", {"@context": "test"}))
+        self.assertEqual([{"a": 1, "@context": "test", "doc_id": "doc"},
+                          {"a": 2, "@context": "test", "doc_id": "doc"}], batchData)
+
+    def test_normalizeAnnotationsBatchDoc(self):
+        batchDoc = {}
+        batchData = [{"a": 1, "c": 1}, {"a": 1, "b": 2, "c": 2}, {"a": 1, "c": 3}]
+        res = list(normalizeAnnotations(batchData, "doc", None, batchDoc))
+        self.assertEqual({"a": 1, "doc_id": "doc"}, batchDoc)
+        self.assertEqual(3, len({anno["id"] for anno in res}))
+        self.assertTrue(all(ObjectId.is_valid(anno["id"]) for anno in res))
+
+        # Attributes missing from some annotations are kept.
+        batchDoc = {}
+        list(normalizeAnnotations([{"a": 1}, {"b": 2}], "doc", None, batchDoc))
+        self.assertEqual({"a": 1, "doc_id": "doc"}, batchDoc)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+import json
+import os
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from pymongo import MongoClient
+
+from jass import mongo_pool
+from jass import settings
+from jass.annotations_manager import AnnotationManager
+from jass.storage_manager import StorageManager
+from jass.async_rest import createApp
+from jass.simple_rest import APP
+
+
+class TestAsyncRest(AioHTTPTestCase):
+    """
+    The read routes of the asynchronous app must answer as the ones of the
+    Flask app (simple_rest).
+    """
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+
+        c = MongoClient(settings.GetConfigValue("ServiceStockageAnnotations", "MONGO_HOST"),
+                        int(settings.GetConfigValue("ServiceStockageAnnotations", "MongoPort")),
+                        connect=False)
+        c.drop_database(settings.GetConfigValue("ServiceStockageAnnotations", "MongoDb"))
+        c.close()
+        self.flask = APP.test_client()
+
+        man = StorageManager()
+        man.setCollection(settings.GetConfigValue("ServiceStockageAnnotations", "documentCollection"))
+        man.connect()
+        self.docId = man.createMongoDocument({"@context": "testing_context"})
+        self.otherId = man.createMongoDocument({"@context": "testing_context"})
+        man.disconnect()
+        man = AnnotationManager()
+        man.addStorageCollection(1, settings.GetConfigValue("ServiceStockageAnnotations",
+                                                            "HumanAnnotationCollection"))
+        man.addStorageCollection(2, settings.GetConfigValue("ServiceStockageAnnotations",
+                                                            "BatchAnnotationCollection"))
+        man.connect()
+        man.createAnnotationS({"common": {"@context": "test"}, "data": [{"a": 1}, {"a": 2}]}, self.docId, 1, 1)
+        man.createAnnotationS({"common": {"@context": "test"}, "data": [{"a": 3}, {"a": 4}, {"a": 5}]},
+                              self.docId, 1, 2)
+        man.createAnnotationS({"common": {"@context": "test"}, "data": [{"a": 6}]}, self.otherId, 1, 1)
+        man.disconnect()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        # The motor client is bound to the event loop of the test.
+        mongo_pool.resetClient()
+
+    async def get_application(self):
+        return createApp()
+
+    async def request(self, method, url, body=None, headers=None):
+        res = await self.client.request(method, url, data=None if body is None else json.dumps(body),
+                                        headers=headers)
+        return res.status, json.loads(await res.text() or "null"), res
+
+    def flaskRequest(self, method, url, body=None, headers=None):
+        headers = dict(headers or {}, Accept="application/json")
+        res = self.flask.open(url, method=method, data=None if body is None else json.dumps(body),
+                              content_type="application/json", headers=headers)
+        return res.status_code, json.loads(res.get_data(as_text=True) or "null"), res
+
+    @unittest_run_loop
+    async def test_getDocument(self):
+        url = "/document/{0}".format(self.docId)
+        status, doc, r = await self.request("GET", url)
+        self.assertEqual(200, status)
+        self.assertEqual(self.docId, doc["id"])
+        self.assertEqual(self.flaskRequest("GET", url)[1], doc)
+        etag = r.headers["ETag"]
+        self.assertEqual(self.flaskRequest("GET", url)[2].headers["ETag"], etag)
+        status, res, r = await self.request("GET", url, headers={"If-None-Match": etag})
+        self.assertEqual(304, status)
+        status, res, r = await self.request("GET", "/document/yolo")
+        self.assertEqual(404, status)
+        self.assertEqual(self.flaskRequest("GET", "/document/yolo")[1], res)
+
+    @unittest_run_loop
+    async def test_getAnnotations(self):
+        url = "/document/{0}/annotations".format(self.docId)
+        for query in ["", "?storageType=1", "?storageType=2", "?fields=a",
+                      '?jsonSelect={"a": {"$gt": 1}}', "?pageSize=2"]:
+            status, res, r = await self.request("GET", url + query)
+            self.assertEqual(200, status)
+            flaskStatus, flaskRes, flaskR = self.flaskRequest("GET", url + query)
+            self.assertEqual(flaskRes, res)
+            # Both apps tag the same representation alike.
+            self.assertEqual(flaskR.headers["ETag"], r.headers["ETag"])
+        status, res, r = await self.request("GET", url)
+        self.assertEqual([1, 2, 3, 4, 5], [anno["a"] for anno in res["data"]])
+        status, res, r = await self.request("GET", url, headers={"If-None-Match": r.headers["ETag"]})
+        self.assertEqual(304, status)
+
+        status, res, r = await self.request("GET", url + "/count")
+        self.assertEqual({"count": 5, "humanStorage": 2, "batchStorage": 3}, res)
+        self.assertEqual(200, (await self.request("HEAD", url))[0])
+        self.assertEqual(404, (await self.request("HEAD", url + '?jsonSelect={"a": 7}'))[0])
+
+    @unittest_run_loop
+    async def test_getAnnotationPages(self):
+        url = "/document/{0}/annotations?pageSize=2".format(self.docId)
+        annotations = []
+        token = None
+        while True:
+            status, res, r = await self.request("GET", url + ("&continuationToken=" + token if token else ""))
+            self.assertEqual(200, status)
+            annotations += [anno["a"] for anno in res["data"]]
+            token = res["next"]
+            if token is None:
+                break
+        self.assertEqual([1, 2, 3, 4, 5], annotations)
+
+    @unittest_run_loop
+    async def test_streamAnnotations(self):
+        res = await self.client.get("/document/{0}/annotations?format=ndjson".format(self.docId))
+        self.assertEqual(200, res.status)
+        self.assertEqual("application/x-ndjson", res.content_type)
+        lines = (await res.text()).splitlines()
+        self.assertEqual([1, 2, 3, 4, 5], [json.loads(line)["a"] for line in lines])
+
+    @unittest_run_loop
+    async def test_getAnnotation(self):
+        status, res, r = await self.request("GET", "/document/{0}/annotations?storageType=1".format(self.docId))
+        annoId = res["data"][0]["id"]
+        url = "/document/{0}/annotation/{1}".format(self.docId, annoId)
+        status, res, r = await self.request("GET", url)
+        self.assertEqual(200, status)
+        self.assertEqual(self.flaskRequest("GET", url)[1], res)
+
+    @unittest_run_loop
+    async def test_bulkAnnotations(self):
+        body = {"documentIds": [self.docId, self.otherId], "skip": 1, "limit": 5}
+        status, res, r = await self.request("POST", "/annotations/bulk", body)
+        self.assertEqual(200, status)
+        self.assertEqual(self.flaskRequest("POST", "/annotations/bulk", body)[1], res)
+        self.assertEqual([2, 3, 4, 5], [anno["a"] for anno in res["data"][self.docId]])
+        self.assertEqual([6], [anno["a"] for anno in res["data"][self.otherId]])
+
+    @unittest_run_loop
+    async def test_errors(self):
+        for method, url, body in [("GET", "/document/{0}/annotations?storageType=x".format(self.docId), None),
+                                  ("GET", "/document/{0}/annotations?storageType=3".format(self.docId), None),
+                                  ("GET", "/document/{0}/annotations/count?jsonSelect=[]".format(self.docId), None),
+                                  ("GET", "/document/{0}/annotations?continuationToken=yolo".format(self.docId),
+                                   None),
+                                  ("POST", "/annotations/bulk", {"documentIds": "yolo"})]:
+            status, res, r = await self.request(method, url, body)
+            flaskStatus, flaskRes, flaskR = self.flaskRequest(method, url, body)
+            self.assertEqual(flaskStatus, status, url)
+            self.assertEqual(flaskRes, res)
+
+
+if __name__ == '__main__':
+    unittest.main()
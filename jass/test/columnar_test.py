@@ -0,0 +1,40 @@
+import unittest
+
+from jass import columnar
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_roundTrip(self):
+        annotations = [{"begin": i, "end": i + 0.5, "label": "speaker_{0}".format(i % 3), "ok": i % 2 == 0,
+                        "doc_id": "59f0a7c3e1382307a3b8a1f1"} for i in range(100)]
+        # Missing fields, mixed types, nested values, unicode and large integers.
+        annotations[3]["extra"] = {"a": [1, None]}
+        annotations[5]["extra"] = "été"
+        annotations[7]["big"] = 2 ** 70
+        annotations[8]["begin"] = -2 ** 63
+        del annotations[9]["label"]
+        annotations.append({})
+        self.assertEqual(annotations, columnar.decode(columnar.encode(annotations)))
+        self.assertEqual([], columnar.decode(columnar.encode([])))
+
+    def test_types(self):
+        annotations = [{"i": 1, "f": 1.0, "b": True, "n": None}, {"i": 2, "f": 2.5, "b": False, "n": None}]
+        decoded = columnar.decode(columnar.encode(annotations))
+        self.assertEqual(annotations, decoded)
+        self.assertIs(type(decoded[0]["i"]), int)
+        self.assertIs(type(decoded[0]["f"]), float)
+        self.assertIs(type(decoded[0]["b"]), bool)
+
+    def test_projection(self):
+        annotations = [{"a": 1, "b": "x", "c": 1.5}, {"a": 2, "c": 2.5}]
+        data = columnar.encode(annotations)
+        self.assertEqual([{"a": 1, "b": "x"}, {"a": 2}], columnar.decode(data, ["a", "b"]))
+        self.assertEqual([{"b": "x"}, {}], columnar.decode(data, ["b", "missing"]))
+
+    def test_invalid(self):
+        self.assertRaises(columnar.ColumnarError, lambda: columnar.decode(b'[{"a":1}]'))
+
+
+if __name__ == '__main__':
+    unittest.main()
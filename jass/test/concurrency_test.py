@@ -0,0 +1,108 @@
+import os
+import random
+import threading
+import time
+import unittest
+
+from jass import doc_cache
+from jass import settings
+from jass import time_budget
+from jass.singleton import Singleton
+
+NB_THREADS = 16
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini")
+
+
+def runThreads(target, nbThreads=NB_THREADS):
+    """
+    Runs target(i) in nbThreads threads started at the same time.
+
+    :return: Exceptions raised by the threads.
+    """
+    barrier = threading.Barrier(nbThreads)
+    errors = []
+
+    def run(i):
+        barrier.wait()
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(nbThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(CONFIG_PATH)
+        doc_cache.resetCache()
+
+    def tearDown(self):
+        doc_cache.resetCache()
+
+    def test_singleton(self):
+        created = []
+
+        @Singleton
+        class Slow:
+            def __init__(self):
+                time.sleep(0.01)
+                created.append(self)
+
+        instances = []
+        self.assertEqual([], runThreads(lambda i: instances.append(Slow.Instance())))
+        self.assertEqual(1, len(created))
+        self.assertTrue(all(instance is created[0] for instance in instances))
+
+    def test_settingsReload(self):
+        def run(i):
+            for j in range(200):
+                if i == 0:
+                    settings.Settings.Instance().LoadConfig(CONFIG_PATH)
+                else:
+                    self.assertEqual("docs", settings.GetConfigValue("ServiceStockageAnnotations",
+                                                                     "DocumentCollection"))
+
+        self.assertEqual([], runThreads(run))
+
+    def test_docCache(self):
+        cache = doc_cache.LRUCache(1000, 60)
+        gets = [0] * NB_THREADS
+
+        def run(i):
+            rand = random.Random(i)
+            for j in range(2000):
+                key = rand.randrange(100)
+                action = rand.random()
+                if action < 0.5:
+                    cache.put(key, key, rand.randrange(1, 50))
+                elif action < 0.95:
+                    cache.get(key)
+                    gets[i] += 1
+                else:
+                    cache.invalidate(key)
+
+        self.assertEqual([], runThreads(run))
+        stats = cache.stats()
+        self.assertEqual(sum(entry[2] for entry in cache.entries.values()), stats["bytes"])
+        self.assertLessEqual(stats["bytes"], 1000)
+        self.assertEqual(sum(gets), stats["hits"] + stats["misses"])
+
+    def test_timeBudget(self):
+        def run(i):
+            time_budget.setCurrent(i)
+            time.sleep(0.01)
+            self.assertEqual(i, time_budget.getCurrent())
+
+        self.assertEqual([], runThreads(run))
+
+
+if __name__ == '__main__':
+    unittest.main()
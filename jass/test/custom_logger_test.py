@@ -0,0 +1,82 @@
+import logging
+import os
+import unittest
+
+from jass import custom_logger as logger
+from jass import settings
+from jass.storage_exception import StorageException
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestCustomLogger(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+        self.logger = logging.getLogger(logger.__name__)
+        self.level = self.logger.level
+        self.handler = RecordHandler()
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+        for key in ["LogMaxMessageLength", "LogDebugSampleRate"]:
+            os.environ.pop(key, None)
+        logger.resetOptions()
+
+    def test_disabledLevel(self):
+        self.logger.setLevel(logging.INFO)
+        self.assertFalse(logger.isDebugEnabled())
+
+        def fail():
+            raise AssertionError("Formatted while debug is disabled")
+
+        class Unformattable(object):
+            def __format__(self, spec):
+                fail()
+
+        logger.logUnknownDebug("Test", fail)
+        logger.logUnknownDebug("Test", "{0}", Unformattable())
+        self.assertEqual([], self.handler.records)
+
+        logger.logUnknownInfo("Test", "Id: {0}", 12)
+        self.assertEqual(["-3 Test Id: 12"], [record.getMessage() for record in self.handler.records])
+
+    def test_structured(self):
+        logger.logUnknownDebug("Test", lambda: "lazy")
+        logger.logUnknownWarning("Test", "{0} {1}", "a", {"b": 1})
+        logger.logInfo(StorageException(1))
+        self.assertEqual(["-3 Test lazy", "-2 Test a {'b': 1}"],
+                         [record.getMessage() for record in self.handler.records[:2]])
+        self.assertEqual([(-3, "Test", logging.DEBUG), (-2, "Test", logging.WARNING),
+                          (1, "Annotation Storage Storage", logging.INFO)],
+                         [(record.code, record.context, record.levelno) for record in self.handler.records])
+
+    def test_truncate(self):
+        os.environ["LogMaxMessageLength"] = "20"
+        logger.resetOptions()
+        logger.logUnknownDebug("Test", "x" * 100)
+        self.assertEqual("-3 Test " + "x" * 12 + "... (108 characters)", self.handler.records[0].getMessage())
+
+    def test_sampling(self):
+        os.environ["LogDebugSampleRate"] = "0"
+        logger.resetOptions()
+        for i in range(10):
+            logger.logUnknownDebug("Test", "Id: {0}", i)
+        logger.logUnknownWarning("Test", "Not sampled")
+        self.assertEqual(["-2 Test Not sampled"], [record.getMessage() for record in self.handler.records])
+
+
+if __name__ == '__main__':
+    unittest.main()
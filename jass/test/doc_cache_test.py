@@ -0,0 +1,72 @@
+import os
+import time
+import unittest
+
+from bson.objectid import ObjectId
+
+from jass import settings
+from jass import doc_cache
+
+
+class TestDocCache(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+        doc_cache.resetCache()
+
+    def tearDown(self):
+        doc_cache.resetCache()
+
+    def test_lru(self):
+        cache = doc_cache.LRUCache(10, 60)
+        cache.put("a", b"aaaa", 4)
+        cache.put("b", b"bbbb", 4)
+        self.assertEqual(b"aaaa", cache.get("a"))
+        # b is the least recently used
+        cache.put("c", b"cccc", 4)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(b"cccc", cache.get("c"))
+        # Larger than the cache
+        cache.put("d", b"d" * 11, 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual({"hits": 2, "misses": 2, "evictions": 1, "entries": 2, "bytes": 8, "maxBytes": 10},
+                         cache.stats())
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        cache.invalidate()
+        self.assertEqual(0, cache.stats()["bytes"])
+
+    def test_ttl(self):
+        cache = doc_cache.LRUCache(10, 0.05)
+        cache.put("a", b"a", 1)
+        self.assertEqual(b"a", cache.get("a"))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.stats()["entries"])
+
+    def test_documents(self):
+        self.assertTrue(doc_cache.isCached("docs"))
+        self.assertTrue(doc_cache.isCached("annoSchema"))
+        self.assertFalse(doc_cache.isCached("humanAnno"))
+
+        docId = ObjectId()
+        doc_cache.putDocument("db", "docs", str(docId), {"_id": docId, "a": [1]})
+        doc = doc_cache.getDocument("db", "docs", str(docId))
+        self.assertEqual({"_id": docId, "a": [1]}, doc)
+        # Copies are returned
+        doc["a"].append(2)
+        self.assertEqual([1], doc_cache.getDocument("db", "docs", str(docId))["a"])
+        self.assertIsNone(doc_cache.getDocument("db", "annoSchema", str(docId)))
+
+        doc_cache.putDocument("db", "annoSchema", str(docId), {"_id": docId})
+        doc_cache.invalidateDocument("db", "docs")
+        self.assertIsNone(doc_cache.getDocument("db", "docs", str(docId)))
+        self.assertIsNotNone(doc_cache.getDocument("db", "annoSchema", str(docId)))
+        doc_cache.invalidateDocument("db", "annoSchema", str(docId))
+        self.assertIsNone(doc_cache.getDocument("db", "annoSchema", str(docId)))
+        self.assertEqual(3, doc_cache.stats()["hits"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from jass import indexes
+from jass.storage_exception import IndexException
+
+
+class FakeCollection(object):
+    # Only what indexes needs, with index_information in the format of MongoDB.
+
+    def __init__(self, info):
+        self.info = info
+        self.created = []
+
+    def index_information(self):
+        return self.info
+
+    def create_index(self, keys, name, **options):
+        self.created.append((keys, name, options))
+
+
+class TestIndexes(unittest.TestCase):
+    collections = {"HumanAnnotationCollection": "humanAnno", "SchemaCollection": "annoSchema"}
+
+    def specs(self, section):
+        return indexes.parseIndexSpecs(section, self.collections)
+
+    def test_parseIndexSpecs(self):
+        specs = self.specs({
+            "human_text": '{"collection": "HumanAnnotationCollection", "keys": [["$**", "text"]],'
+                          ' "weights": {"label": 10}}',
+            "schema": '{"name": "doc_id_1", "collection": "SchemaCollection", "keys": [["doc_id", 1]],'
+                      ' "partialFilterExpression": {"doc_id": {"$exists": true}}}'})
+        self.assertEqual([{"name": "human_text", "collection": "humanAnno", "keys": [("$**", "text")],
+                           "options": {"weights": {"label": 10}}},
+                          {"name": "doc_id_1", "collection": "annoSchema", "keys": [("doc_id", 1)],
+                           "options": {"partialFilterExpression": {"doc_id": {"$exists": True}}}}], specs)
+
+        for spec in ['{"collection": "HumanAnnotationCollection", "keys": [["a", 1]]',
+                     '{"collection": "Unknown", "keys": [["a", 1]]}',
+                     '{"collection": "HumanAnnotationCollection", "keys": []}',
+                     '{"collection": "HumanAnnotationCollection", "keys": [["a", 2]]}',
+                     '{"collection": "HumanAnnotationCollection", "keys": [["a", 1]], "expire": 1}']:
+            self.assertRaises(IndexException, lambda: self.specs({"bad": spec}))
+
+    def test_driftReport(self):
+        specs = self.specs({
+            "human_doc_id": '{"collection": "HumanAnnotationCollection", "keys": [["doc_id", 1], ["_id", 1]]}',
+            "human_text": '{"collection": "HumanAnnotationCollection", "keys": [["$**", "text"]],'
+                          ' "weights": {"label": 10}}',
+            "schema_ttl": '{"collection": "SchemaCollection", "keys": [["createdAt", 1]],'
+                          ' "expireAfterSeconds": 60}',
+            "schema_doc_id": '{"collection": "SchemaCollection", "keys": [["doc_id", 1]]}'})
+        db = {"humanAnno": FakeCollection({
+                  "_id_": {"key": [("_id", 1)]},
+                  "doc_id_1": {"key": [("doc_id", 1)]},
+                  "human_text": {"key": [("_fts", "text"), ("_ftsx", 1)],
+                                 "weights": {"$**": 1, "label": 10}}}),
+              "annoSchema": FakeCollection({
+                  "_id_": {"key": [("_id", 1)]},
+                  "doc_id_1": {"key": [("doc_id", 1.0)]},
+                  "schema_ttl": {"key": [("createdAt", 1)], "expireAfterSeconds": 3600}})}
+
+        report = indexes.applyIndexes(db, specs, background=True)
+        self.assertEqual([{"collection": "humanAnno", "name": "human_doc_id"}], report["missing"])
+        self.assertEqual(report["missing"], report["created"])
+        self.assertEqual([{"collection": "annoSchema", "name": "doc_id_1", "differences": ["name"]},
+                          {"collection": "annoSchema", "name": "schema_ttl",
+                           "differences": ["expireAfterSeconds"]}],
+                         sorted(report["different"], key=lambda index: index["name"]))
+        self.assertEqual([{"collection": "humanAnno", "name": "doc_id_1"}], report["extra"])
+        self.assertEqual([([("doc_id", 1), ("_id", 1)], "human_doc_id", {"background": True})],
+                         db["humanAnno"].created)
+        self.assertEqual([], db["annoSchema"].created)
+
+
+if __name__ == '__main__':
+    unittest.main()
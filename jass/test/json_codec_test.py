@@ -0,0 +1,102 @@
+import datetime
+import json
+import math
+import os
+import unittest
+
+from flask import Flask, jsonify, request
+
+from jass import batch_storage
+from jass import json_codec
+from jass import settings
+from jass.utility_rest import CodecJSONEncoder, CodecJSONDecoder
+
+
+class TestJsonCodec(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+        json_codec.resetCodec()
+
+    def tearDown(self):
+        os.environ.pop("JsonCodec", None)
+        json_codec.resetCodec()
+
+    def codecs(self):
+        """
+        Yields each available backend, set as the current one.
+        """
+        for codec in [json_codec.STDLIB, json_codec.ORJSON]:
+            os.environ["JsonCodec"] = codec
+            json_codec.resetCodec()
+            if json_codec.getCodec() == codec:
+                yield codec
+
+    def test_roundTrip(self):
+        annotations = [{"begin": i, "end": i + 0.5, "label": "é{0}".format(i), "tags": [None, True, {"a": []}]}
+                       for i in range(3)]
+        for codec in self.codecs():
+            data = json_codec.dumpb(annotations)
+            self.assertEqual(annotations, json_codec.loads(data), codec)
+            self.assertEqual(annotations, json_codec.loads(memoryview(data)), codec)
+            self.assertEqual(annotations, json_codec.loads(json_codec.dumps(annotations)), codec)
+            # The standard library escapes non ASCII characters, as Flask does.
+            self.assertEqual(b'{"a":1,"b":"\\u00e9"}' if codec == json_codec.STDLIB else b'{"a":1,"b":"\xc3\xa9"}',
+                             json_codec.dumpb({"a": 1, "b": "é"}), codec)
+            self.assertEqual('{"a":1,"b":2}', json_codec.dumps({"b": 2, "a": 1}, sortKeys=True), codec)
+
+    def test_stdlibFallback(self):
+        for codec in self.codecs():
+            # Not supported by orjson.
+            self.assertEqual('{"1":%d}' % 2 ** 64, json_codec.dumps({1: 2 ** 64}), codec)
+            self.assertEqual(2 ** 64, json_codec.loads(str(2 ** 64)), codec)
+            self.assertTrue(json_codec.loads("[NaN]")[0] != json_codec.loads("[NaN]")[0], codec)
+            self.assertRaises(json.JSONDecodeError, lambda: json_codec.loads(b'{"a":'))
+            date = datetime.datetime(2017, 1, 2)
+            self.assertEqual('"2017-01-02"', json_codec.dumps(date, default=lambda d: d.strftime("%Y-%m-%d")), codec)
+            self.assertRaises(TypeError, lambda: json_codec.dumps(object()))
+
+    def test_nonFiniteFloats(self):
+        annotations = [{"a": float("nan"), "b": [float("inf"), None]}, {"c": {"d": -float("inf")}, "e": None}]
+        for codec in self.codecs():
+            # Written as the standard library does, not as null.
+            self.assertEqual(b'[{"a":NaN,"b":[Infinity,null]},{"c":{"d":-Infinity},"e":null}]',
+                             json_codec.dumpb(annotations), codec)
+            self.assertEqual('[NaN]', json_codec.dumps([float("nan")]), codec)
+            self.assertEqual(b'[1.5,null]', json_codec.dumpb([1.5, None]), codec)
+            for encoding in batch_storage.ENCODINGS:
+                data = batch_storage.encodeChunk(annotations, encoding)
+                decoded = list(batch_storage.decodeChunk(data, {"count": 2}, encoding=encoding))
+                self.assertTrue(math.isnan(decoded[0]["a"]), encoding)
+                self.assertEqual([float("inf"), None], decoded[0]["b"], encoding)
+                self.assertEqual({"d": -float("inf")}, decoded[1]["c"], encoding)
+
+    def test_loadConfig(self):
+        codec = json_codec.getCodec()
+        os.environ["JsonCodec"] = json_codec.STDLIB
+        self.assertEqual(codec, json_codec.getCodec())
+        # The backend is resolved again with the new configuration.
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+        self.assertEqual(json_codec.STDLIB, json_codec.getCodec())
+
+    def test_unknownCodec(self):
+        os.environ["JsonCodec"] = "yolo"
+        self.assertRaises(ValueError, json_codec.getCodec)
+
+    def test_flask(self):
+        app = Flask(__name__)
+        app.json_encoder = CodecJSONEncoder
+        app.json_decoder = CodecJSONDecoder
+        for codec in self.codecs():
+            with app.test_request_context(method="POST", data='{"b": [1, 2], "a": "é"}',
+                                          content_type="application/json"):
+                self.assertEqual({"a": "é", "b": [1, 2]}, request.get_json())
+                response = jsonify({"b": 1, "a": datetime.datetime(2017, 1, 2)})
+                self.assertEqual({"a": "Mon, 02 Jan 2017 00:00:00 GMT", "b": 1},
+                                 json.loads(response.get_data(as_text=True)), codec)
+
+
+if __name__ == '__main__':
+    unittest.main()
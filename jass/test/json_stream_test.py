@@ -0,0 +1,57 @@
+import unittest
+import io
+import json
+
+from jass.json_stream import iterJsonArray, iterNdjson, JsonStreamError
+
+
+class TestJsonStream(unittest.TestCase):
+
+    def decode(self, content, readSize=3):
+        return list(iterJsonArray(io.BytesIO(content.encode("UTF-8")), readSize))
+
+    def test_iterJsonArray(self):
+        annotations = [{"a": 1, "text": "café à l'été", "b": [1.5, None, True]},
+                       {"nested": {"c": "]},["}}, 12345, "str", [], {}]
+        content = json.dumps(annotations)
+        for readSize in [1, 2, 3, 7, 1024]:
+            self.assertEqual(annotations, self.decode(content, readSize),
+                             "Decoding failed with read size {0}".format(readSize))
+        # Multi byte characters split between two reads.
+        self.assertEqual(annotations, self.decode(json.dumps(annotations, ensure_ascii=False), 1))
+
+    def test_whitespace(self):
+        self.assertEqual([], self.decode("[]"))
+        self.assertEqual([], self.decode(" \n[ \n ] "))
+        self.assertEqual([1, 23, {"a": 456}], self.decode(" [ 1 ,\n23\t, {\"a\" : 456} ] "))
+
+    def test_invalid(self):
+        self.assertRaises(JsonStreamError, lambda: self.decode(""))
+        self.assertRaises(JsonStreamError, lambda: self.decode("{}"))
+        self.assertRaises(JsonStreamError, lambda: self.decode("[1,"))
+        self.assertRaises(JsonStreamError, lambda: self.decode("[1,]"))
+        self.assertRaises(JsonStreamError, lambda: self.decode("[1 2]"))
+        self.assertRaises(JsonStreamError, lambda: self.decode("[{\"a\":1}"))
+
+    def test_lazy(self):
+        # Elements must be yielded before the whole stream is read.
+        stream = io.BytesIO(b'[{"a":1},' + b' ' * 100000 + b'{"a":2}]')
+        elements = iterJsonArray(stream, 10)
+        self.assertEqual({"a": 1}, next(elements))
+        self.assertLess(stream.tell(), 100)
+
+    def test_iterNdjson(self):
+        content = '{"a": 1, "text": "café"}\n\n  \n{"b": [1, 2]}\r\n{"c": null}'.encode("UTF-8")
+        self.assertEqual([{"a": 1, "text": "café"}, {"b": [1, 2]}, {"c": None}], list(iterNdjson(io.BytesIO(content))))
+        with self.assertRaisesRegex(JsonStreamError, "line 2"):
+            list(iterNdjson(io.BytesIO(b'{"a": 1}\n{"a": \n')))
+        with self.assertRaisesRegex(JsonStreamError, "line 1"):
+            list(iterNdjson(io.BytesIO(b'[1, 2]\n')))
+        # Lines are read as they are decoded.
+        stream = io.BytesIO(b'{"a": 1}\n' + b'{"b": 2}\n' * 10000)
+        self.assertEqual({"a": 1}, next(iterNdjson(stream)))
+        self.assertLess(stream.tell(), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import time
+
+from jass import query_guard
+
+
+class TestQueryGuard(unittest.TestCase):
+
+    def setUp(self):
+        query_guard.resetState()
+
+    def test_findExpensiveOperator(self):
+        self.assertIsNone(query_guard.findExpensiveOperator({"doc_id": {"$in": ["a"]}, "a": 1}))
+        self.assertIsNone(query_guard.findExpensiveOperator({"label": {"$regex": "^spe"}}))
+        self.assertIsNone(query_guard.findExpensiveOperator({"label": {"$regex": "\\Aspe", "$options": "m"}}))
+        self.assertEqual("$where", query_guard.findExpensiveOperator({"$and": [{"a": 1}, {"$where": "true"}]}))
+        self.assertIn("unanchored", query_guard.findExpensiveOperator({"label": {"$regex": "spe"}}))
+        self.assertIn("unanchored", query_guard.findExpensiveOperator({"label": {"$not": {"$regex": "spe"}}}))
+        self.assertIn("case insensitive",
+                      query_guard.findExpensiveOperator({"label": {"$regex": "^spe", "$options": "i"}}))
+
+    def test_isCollectionScan(self):
+        self.assertFalse(query_guard.isCollectionScan(
+            {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "doc_id_1"}}))
+        self.assertTrue(query_guard.isCollectionScan(
+            {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}))
+        self.assertTrue(query_guard.isCollectionScan(
+            {"stage": "SUBPLAN", "inputStage": {"stage": "OR", "inputStages": [
+                {"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}}))
+
+    def test_shape(self):
+        self.assertEqual(query_guard._shape({"doc_id": {"$in": ["a", "b"]}, "$or": [{"a": 1}, {"b": "x"}]}),
+                         query_guard._shape({"doc_id": {"$in": ["c"]}, "$or": [{"a": 2}, {"b": "y"}]}))
+        self.assertNotEqual(query_guard._shape({"a": 1}), query_guard._shape({"b": 1}))
+
+    def test_explainQuery(self):
+        class Database(object):
+            def __init__(self, stage):
+                self.stage = stage
+                self.commands = []
+
+            def command(self, command):
+                self.commands.append(command)
+                return {"queryPlanner": {"winningPlan": {"stage": self.stage}},
+                        "executionStats": {"nReturned": 1, "totalDocsExamined": 1}}
+
+        # Expensive queries are not run, whatever the policy.
+        for query, stage in [({"$where": "true"}, "IXSCAN"), ({"a": 1}, "COLLSCAN")]:
+            db = Database(stage)
+            report = query_guard.explainQuery(db, "c", query, 100)
+            self.assertIsNotNone(report["guard"])
+            self.assertNotIn("nReturned", report)
+            self.assertEqual(["queryPlanner"], [command["verbosity"] for command in db.commands])
+
+        db = Database("IXSCAN")
+        report = query_guard.explainQuery(db, "c", {"a": 1}, 100)
+        self.assertIsNone(report["guard"])
+        self.assertEqual(1, report["nReturned"])
+        self.assertEqual(["queryPlanner", "executionStats"], [command["verbosity"] for command in db.commands])
+        self.assertEqual([100, 100], [command["explain"]["maxTimeMS"] for command in db.commands])
+
+    def test_throttle(self):
+        # Burst of max(rate, 1) queries, then one query per 1/rate seconds.
+        self.assertTrue(query_guard._acquire(1, 0))
+        self.assertFalse(query_guard._acquire(1, 0))
+        query_guard.resetState()
+        start = time.monotonic()
+        for i in range(30):
+            self.assertTrue(query_guard._acquire(20, 1))
+        self.assertGreater(time.monotonic() - start, 0.4)
+        self.assertFalse(query_guard._acquire(0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import json
+import logging
+import os
+from pymongo import MongoClient
+
+from jass import custom_logger
+from jass import settings
+from jass.simple_rest import APP
+
+
+class TestSimpleRest(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+
+        c = MongoClient(settings.GetConfigValue("ServiceStockageAnnotations", "MONGO_HOST"),
+                        int(settings.GetConfigValue("ServiceStockageAnnotations", "MongoPort")),
+                        connect=False)
+        c.drop_database(settings.GetConfigValue("ServiceStockageAnnotations", "MongoDb"))
+        c.close()
+        self.client = APP.test_client()
+
+    def request(self, method, url, body=None, headers=None):
+        # Errors are HTML pages unless JSON is accepted.
+        headers = dict(headers or {}, Accept="application/json")
+        res = self.client.open(url, method=method, data=None if body is None else json.dumps(body),
+                               content_type="application/json", headers=headers)
+        return res.status_code, json.loads(res.get_data(as_text=True) or "null"), res
+
+    def test_updateDocumentVersion(self):
+        status, res, r = self.request("POST", "/document", {"@context": "testing_context"})
+        docId = res["id"]
+        status, doc, r = self.request("GET", "/document/{0}".format(docId))
+        version = r.headers["ETag"]
+        status, res, r = self.request("PUT", "/document/{0}".format(docId), dict(doc, a=1))
+        self.assertEqual(200, status)
+        # The _version of the body is not a precondition, If-Match is.
+        status, res, r = self.request("PUT", "/document/{0}".format(docId), dict(doc, a=2))
+        self.assertEqual(200, status)
+        current = r.headers["ETag"]
+        status, res, r = self.request("PUT", "/document/{0}".format(docId), dict(doc, a=3),
+                                      headers={"If-Match": version})
+        self.assertEqual(412, status)
+        status, res, r = self.request("PUT", "/document/{0}".format(docId), dict(doc, a=3),
+                                      headers={"If-Match": current})
+        self.assertEqual(200, status)
+
+    def test_moveAnnotation(self):
+        status, res, r = self.request("POST", "/document", {"@context": "testing_context"})
+        self.assertEqual(201, status)
+        docId = res["id"]
+        status, res, r = self.request("POST", "/document", {"@context": "testing_context"})
+        otherId = res["id"]
+        status, res, r = self.request("POST", "/document/{0}/annotation".format(docId), {"@context": "test", "a": 1})
+        self.assertEqual(201, status)
+        annoId = res["id"]
+        etags = {}
+        for strDocId in [docId, otherId]:
+            status, res, r = self.request("GET", "/document/{0}/annotations".format(strDocId))
+            etags[strDocId] = r.headers["ETag"]
+
+        # The annotation is moved to the other document.
+        status, res, r = self.request("PUT", "/document/{0}/annotation/{1}".format(otherId, annoId),
+                                      {"id": annoId, "@context": "test", "a": 2})
+        self.assertEqual(200, status)
+        status, res, r = self.request("GET", "/document/{0}/annotation/{1}".format(otherId, annoId))
+        self.assertEqual(200, status)
+        self.assertEqual(otherId, res["doc_id"])
+        self.assertEqual(2, res["a"])
+        for strDocId, count in [(docId, 0), (otherId, 1)]:
+            status, res, r = self.request("GET", "/document/{0}/annotations/count".format(strDocId))
+            self.assertEqual(count, res["count"])
+            # The annotations of both documents changed.
+            status, res, r = self.request("GET", "/document/{0}/annotations".format(strDocId),
+                                          headers={"If-None-Match": etags[strDocId]})
+            self.assertEqual(200, status)
+            self.assertEqual(count, len(res["data"]))
+
+    def test_logRequestBody(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        log = logging.getLogger(custom_logger.__name__)
+        level = log.level
+        log.addHandler(handler)
+        log.setLevel(logging.DEBUG)
+        os.environ["LogMaxMessageLength"] = "200"
+        custom_logger.resetOptions()
+        try:
+            status, res, r = self.request("POST", "/document", {"@context": "logged_context"})
+            self.assertEqual(201, status)
+            docId = res["id"]
+            self.assertTrue(any("logged_context" in record.getMessage() for record in records))
+
+            del records[:]
+            status, res, r = self.request("POST", "/document", {"@context": "x" * 300})
+            self.assertEqual(201, status)
+            self.assertFalse(any("xxx" in record.getMessage() for record in records))
+            self.assertTrue(any("Not logged" in record.getMessage() for record in records))
+
+            # The upload is streamed, thus not read to be logged.
+            del records[:]
+            res = self.client.post("/document/{0}/annotations".format(docId),
+                                   data='{"a": "ndjson_line"}\n{"a": 2}\n', content_type="application/x-ndjson",
+                                   headers={"Accept": "application/json"})
+            self.assertEqual(2, json.loads(res.get_data(as_text=True))["nCreated"])
+            self.assertFalse(any("ndjson_line" in record.getMessage() for record in records))
+        finally:
+            log.removeHandler(handler)
+            log.setLevel(level)
+            os.environ.pop("LogMaxMessageLength", None)
+            custom_logger.resetOptions()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,11 @@ import os
 import json
 from pymongo import MongoClient
 
-from jass.storage_manager import StorageManager
+from jass.storage_manager import StorageManager, VERSION_FIELD
+from bson.objectid import ObjectId
 from jass import settings
 from jass.storage_exception import *
+from jass.test.concurrency_test import runThreads
 
 
 # other useful tools.
@@ -38,6 +40,17 @@ class TestStorageManager(unittest.TestCase):
     def test_connect(self):
         self.assertEqual(self.d.isConnected(), True)
 
+    def test_connectionPool(self):
+        other = StorageManager()
+        other.setCollection(settings.GetConfigValue("ServiceStockageAnnotations", "documentCollection"))
+        other.connect()
+        self.assertIs(self.d.client, other.client, "Managers should borrow the same client")
+        other.disconnect()
+        self.assertFalse(other.isConnected())
+        # The shared client must still be usable after a manager released it.
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        self.assertNotEqual(None, self.d.getMongoDocument(id))
+
     def l(self, strContent):
         # shortcut to load json
         return json.loads(strContent)
@@ -91,6 +104,66 @@ class TestStorageManager(unittest.TestCase):
         newStrDoc = '{"_id" : "%s" , "@context":"%s"}' % (id, context)
         self.assertRaises(MongoDocumentException, lambda: self.d.updateMongoDocument(self.l(newStrDoc)))
 
+    def test_updateMongoDocumentVersion(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        version = self.d.getMongoDocument(id)[VERSION_FIELD]
+        doc = self.l('{"_id": "%s", "@context": "v2"}' % id)
+        self.assertEqual(id, self.d.updateMongoDocument(doc, expectedVersion=version))
+        self.assertNotEqual(version, doc[VERSION_FIELD])
+        self.assertEqual(doc[VERSION_FIELD], self.d.getMongoDocument(id)[VERSION_FIELD])
+        # Someone else updated the document since version was read.
+        try:
+            self.d.updateMongoDocument(self.l('{"_id": "%s", "@context": "v3"}' % id), expectedVersion=version)
+            self.fail("The update should have been refused")
+        except MongoDocumentException as e:
+            self.assertEqual(6, e.code)
+        self.assertEqual("v2", self.d.getMongoDocument(id)["@context"])
+        self.assertEqual(id, self.d.updateMongoDocument(self.l('{"_id": "%s", "@context": "v3"}' % id),
+                                                        expectedVersion=["yolo", doc[VERSION_FIELD]]))
+        try:
+            self.d.updateMongoDocument(self.l('{"_id": "%s", "@context": "v3"}' % str(ObjectId())),
+                                       expectedVersion=version)
+            self.fail("The document does not exist")
+        except MongoDocumentException as e:
+            self.assertEqual(5, e.code)
+
+    def test_concurrentUpdates(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        version = self.d.getMongoDocument(id)[VERSION_FIELD]
+        updated = []
+
+        def update(i):
+            # One manager per thread, as for concurrent requests.
+            man = StorageManager()
+            man.setCollection(settings.GetConfigValue("ServiceStockageAnnotations", "documentCollection"))
+            man.connect()
+            try:
+                man.updateMongoDocument(self.l('{"_id": "%s", "@context": "%d"}' % (id, i)),
+                                        expectedVersion=version)
+                updated.append(i)
+            except MongoDocumentException as e:
+                self.assertEqual(6, e.code)
+            finally:
+                man.disconnect()
+
+        self.assertEqual([], runThreads(update))
+        # Only one update could replace the version read by all the threads.
+        self.assertEqual(1, len(updated))
+        self.assertEqual(str(updated[0]), self.d.getMongoDocument(id)["@context"])
+
+    def test_getMongoDocumentVersion(self):
+        id = self.d.createMongoDocument(self.l('{"@context":"testing_context"}'))
+        # Cached by this process.
+        version = self.d.getMongoDocument(id)[VERSION_FIELD]
+        self.assertEqual(version, self.d.getMongoDocumentVersion(id))
+        # Updated by another process, whose writes do not invalidate our cache.
+        coll = self.d.client[self.d.mongoDb][self.d.mongoCollection]
+        coll.update_one({"_id": ObjectId(id)}, {"$set": {VERSION_FIELD: "v2", "@context": "v2"}})
+        self.assertEqual("v2", self.d.getMongoDocumentVersion(id))
+        self.assertEqual(version, self.d.getMongoDocument(id)[VERSION_FIELD])
+        self.assertEqual("v2", self.d.getMongoDocument(id, version="v2")["@context"])
+        self.assertEqual(None, self.d.getMongoDocumentVersion("yolo"))
+
     def test_deleteMongoDocument(self):
         self.d.deleteMongoDocument("yolo")
         self.assertFalse(self.d.deleteMongoDocument("yolo"),
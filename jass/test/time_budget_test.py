@@ -0,0 +1,39 @@
+import io
+import os
+import time
+import unittest
+
+import pymongo.errors
+
+from jass import settings
+from jass import time_budget
+
+
+class TestTimeBudget(unittest.TestCase):
+
+    def setUp(self):
+        settings.Settings.Instance().LoadConfig(
+            os.path.join(os.path.dirname(__file__), "..", "..", "configs", "test", "config.ini"))
+
+    def test_getBudgetMS(self):
+        self.assertEqual(120000, time_budget.getBudgetMS("documentAnnotationS"))
+        self.assertEqual(30000, time_budget.getBudgetMS("document"))
+        self.assertEqual(30000, time_budget.getBudgetMS(None))
+
+    def test_current(self):
+        time_budget.setCurrent(10)
+        self.assertEqual(10, time_budget.getCurrent())
+        time_budget.setCurrent(None)
+        self.assertIsNone(time_budget.getCurrent())
+
+    def test_deadlineReader(self):
+        reader = time_budget.DeadlineReader(io.BytesIO(b"0123456789"), 50)
+        self.assertEqual(b"01234", reader.read(5))
+        time.sleep(0.1)
+        with self.assertRaises(pymongo.errors.ExecutionTimeout) as cm:
+            reader.read(5)
+        self.assertTrue(time_budget.isTimeout(cm.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
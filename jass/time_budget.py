@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+Time budgets of MongoDB operations.
+
+Each route has a budget in milliseconds, configured in the TimeBudgets
+section: keys are the names of the Flask endpoints (lower case), and default
+applies to the others. 0 means no limit.
+::
+
+    [TimeBudgets]
+    default = 30000
+    documentannotations = 120000
+
+The budget of the current request is set for the thread handling it, and
+storage managers connected during the request apply it to every operation:
+maxTimeMS for find and aggregate, and a deadline for each GridFS file read.
+MongoDB aborts an operation exceeding its budget, which is reported as a
+time out (StorageException 4) instead of holding the worker. Deletes are not
+limited, since MongoDB 3.4 deletes do not take maxTimeMS.
+"""
+
+import threading
+import time
+
+import pymongo.errors
+
+import jass.settings as settings
+
+SECTION = "TimeBudgets"
+DEFAULT_KEY = "default"
+
+# Code of MongoDB ExceededTimeLimit errors.
+EXCEEDED_TIME_LIMIT = 50
+
+_local = threading.local()
+
+
+def getBudgetMS(endpoint):
+    """
+    :param endpoint: Name of a Flask endpoint, or None.
+    :return: Budget of the route in milliseconds, None if not limited.
+    """
+    budgets = settings.GetConfigSection(SECTION)
+    value = budgets.get(str(endpoint).lower(), budgets.get(DEFAULT_KEY))
+    if not value or int(value) <= 0:
+        return None
+    return int(value)
+
+
+def setCurrent(budgetMS):
+    """
+    Sets the budget of the requests handled by the current thread.
+    """
+    _local.budgetMS = budgetMS
+
+
+def getCurrent():
+    """
+    :return: Budget of the current thread in milliseconds, None if not limited.
+    """
+    return getattr(_local, "budgetMS", None)
+
+
+def isTimeout(e):
+    """
+    :return: True if the exception means an operation exceeded its budget.
+    """
+    return isinstance(e, pymongo.errors.ExecutionTimeout)
+
+
+class DeadlineReader(object):
+    """
+    File object wrapper raising ExecutionTimeout if reading is not finished
+    before its deadline. GridFS reads do not support maxTimeMS.
+    """
+
+    def __init__(self, fileObj, budgetMS):
+        self.fileObj = fileObj
+        self.deadline = time.monotonic() + budgetMS / 1000.0
+
+    def read(self, size=-1):
+        if time.monotonic() > self.deadline:
+            raise pymongo.errors.ExecutionTimeout("GridFS read exceeded its time budget",
+                                                  EXCEEDED_TIME_LIMIT)
+        return self.fileObj.read(size)
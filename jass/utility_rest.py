@@ -25,12 +25,18 @@ from flask import redirect
 from flask import make_response
 from flask import Markup
 from flask import current_app
+from flask.json import JSONEncoder
+from flask.json import JSONDecoder
 import pytz
 
 
 # -- Project specific --------------------------------------------------------
 import jass.settings as settings
 import jass.error as error
+import jass.json_codec as json_codec
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
 
 
 class UnknownServiceError(Exception):
@@ -38,6 +44,27 @@ class UnknownServiceError(Exception):
     pass
 
 
+class CodecJSONEncoder(JSONEncoder):
+    """
+    Flask JSON encoder (jsonify) using json_codec. Pretty printed responses
+    keep the encoder of Flask.
+    """
+
+    def encode(self, o):
+        if self.indent is not None:
+            return super().encode(o)
+        return json_codec.dumps(o, default=self.default, sortKeys=self.sort_keys)
+
+
+class CodecJSONDecoder(JSONDecoder):
+    """
+    Flask JSON decoder (request.json, request.get_json) using json_codec.
+    """
+
+    def decode(self, s, _w=None):
+        return json_codec.loads(s)
+
+
 # ----------------------------------------------------------------------------
 def request_wants_json():
     """
@@ -52,6 +79,20 @@ def request_wants_json():
         request.accept_mimetypes['text/html']
 
 
+def request_wants_ndjson():
+    """
+    Check if the client asked for newline delimited JSON, either with the
+    format=ndjson parameter or with the Accept header.
+    """
+    if request.args.get('format') == 'ndjson':
+        return True
+    best = request.accept_mimetypes.best_match([NDJSON_MIMETYPE,
+                                                'application/json'])
+    return best == NDJSON_MIMETYPE and \
+        request.accept_mimetypes[best] > \
+        request.accept_mimetypes['application/json']
+
+
 def get_canarie_api_response(service_name ,template_path,canarie_api_request):
     """
     Provide a valid HTML response for the CANARIE API request based on the
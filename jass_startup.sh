@@ -1,5 +1,33 @@
 #!/usr/bin/env bash
 
 # Used to start up jass from docker using gunicorn
+#
+# Each worker process handles JASS_THREADS requests at once (gthread workers):
+# threads wait on MongoDB without holding the GIL, thus requests waiting on I/O
+# do not queue behind each other. JASS_THREADS=1 gives the previous sync
+# workers. Keep JASS_THREADS below MongoMaxPoolSize.
+#
+# JASS_WORKER_CLASS=gevent uses greenlets instead of threads. The application
+# is then loaded by each worker after gevent patched the standard library, not
+# preloaded, so that its locks are gevent locks.
+#
+# JASS_ASYNC_WORKERS > 0 also starts the asynchronous app (jass.async_rest) on
+# port 5001, whose workers serve many reads with a single thread. The reverse
+# proxy sends it the read routes it serves (see jass/async_rest.py).
+JASS_WORKERS=${JASS_WORKERS:-4}
+JASS_THREADS=${JASS_THREADS:-8}
+JASS_WORKER_CLASS=${JASS_WORKER_CLASS:-gthread}
+JASS_ASYNC_WORKERS=${JASS_ASYNC_WORKERS:-0}
+
 python create_db_if_not_exist.py
-gunicorn -w 4 -preload -b 0.0.0.0:5000 jass.simple_rest:APP --log-config=logging.conf
+if [ "$JASS_WORKER_CLASS" = "gevent" ]; then
+    WORKER_OPTIONS="-k gevent --worker-connections ${JASS_WORKER_CONNECTIONS:-100}"
+elif [ "$JASS_THREADS" -gt 1 ]; then
+    WORKER_OPTIONS="-k gthread --threads $JASS_THREADS -preload"
+else
+    WORKER_OPTIONS="-k sync -preload"
+fi
+if [ "$JASS_ASYNC_WORKERS" -gt 0 ]; then
+    gunicorn -w $JASS_ASYNC_WORKERS -k aiohttp.worker.GunicornWebWorker -b 0.0.0.0:5001 jass.async_rest:APP --log-config=logging.conf &
+fi
+gunicorn -w $JASS_WORKERS $WORKER_OPTIONS -b 0.0.0.0:5000 jass.simple_rest:APP --log-config=logging.conf
@@ -44,6 +44,10 @@ setup(
     packages=['jass'],
 
     install_requires=REQUIREMENTS,
+    extras_require={
+        # zstd compression of large storage batches (BatchCompression).
+        'zstd': ['zstandard>=0.9'],
+    },
     zip_safe=False,
 
     exclude_package_data={'jass': ['.hg', '.hglf']},